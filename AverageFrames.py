@@ -4,7 +4,7 @@ from icecube.icetray import I3Units
 from icecube.taxi_reader import taxi_tools
 from I3Tray import I3Tray
 from icecube import icetray, dataio, dataclasses, taxi_reader, radcube
-from icecube.icetray.i3logging import log_info
+from icecube.icetray.i3logging import log_info, log_warn
 import matplotlib.gridspec as gridspec
 
 
@@ -14,15 +14,10 @@ import numpy as np
 import sys
 import argparse
 
+from FrameCatalog import catalogSelection
+from NoiseTools import FrameArray, dbmHzFromAmplitude, frequencyGrid, printCacheStatistics
+from Spectrogram import Spectrogram, plotWaterfall
 
-#Input i3 file with the data 
-parser = argparse.ArgumentParser()
-parser.add_argument("input", type=str, nargs="+", default=[], help="List of i3 files")
-args = parser.parse_args()
-
-filename = args.input
-
-#Input i3 file with the data 
 
 #Set the trace length
 WaveformLengths = [1024] 
@@ -31,46 +26,52 @@ WaveformLengths = [1024]
 class AnalyzeQframes(icetray.I3Module):
     def __init__(self, ctx):  
         icetray.I3Module.__init__(self, ctx) 
+        self.AddParameter("Spectrogram", "Options of the Spectrogram accumulator (dict), no spectrogram if None", None)
+        self.AddParameter("SpectrogramOutput", "Name of the spectrogram file", "spectrogram.npz")
         self.NEntries = 0
         self.NFreqBins = int(WaveformLengths[0]/ 2 + 1)
-        self.plotdBm = np.zeros(self.NFreqBins)
-        self.plotFreqs = np.zeros(self.NFreqBins)
-        self.channel_averages = {}  # Dictionary to store the average spectrum for each channel
+        self.frameArray = FrameArray()
+        self.binning = None
+        self.sumdBm = None  # Sum of the spectra, shape (antennas, channels, frequency bins)
+
+    def Configure(self):
+        self.spectrogramOptions = self.GetParameter("Spectrogram")
+        self.spectrogramOutput = self.GetParameter("SpectrogramOutput")
+        self.spectrogram = None
 
     def SpectrumAverage(self, frame, name):
         antennaDataMap = frame[name]  # This is a container that holds all antenna info
-        for iant, antkey in enumerate(antennaDataMap.keys()):
-            channelMap = antennaDataMap[antkey]
-            for ichan, chkey in enumerate(channelMap.keys()):
-                fft = channelMap[chkey].GetFFTData()  # This container holds time series and spectrum
-                spectrum = fft.GetFrequencySpectrum()
-                freqs, amps = radcube.RadTraceToPythonList(spectrum)
-                amps = [radcube.GetDbmHzFromFourierAmplitude(abs(thisAmp), spectrum.binning, 50 * I3Units.ohm) for thisAmp in amps]
-
-                # Use (iant, ichan) as the key to differentiate data for each antenna and channel
-                if (iant, ichan) not in self.channel_averages:
-                # Create separate lists for each antenna and channel if not present
-                    self.channel_averages[(iant, ichan)] = {
-                        'sumFreqs': np.zeros(self.NFreqBins),
-                        'sumdBm': np.zeros(self.NFreqBins),
-                        'NEntries': 0
-                    }
-                # Sum the frequencies and dBm values for each channel of each antenna
-                self.channel_averages[(iant, ichan)]['sumFreqs'] += np.array(freqs)
-                self.channel_averages[(iant, ichan)]['sumdBm'] += np.array(amps)
-                self.channel_averages[(iant, ichan)]['NEntries'] += 1
-        
- 
+        # Amplitude spectra of all the antennas and channels at once
+        amps, binning = self.frameArray.amplitudeSpectrum(antennaDataMap)
+        dBm = dbmHzFromAmplitude(amps, binning, 50 * I3Units.ohm)
+
+        if self.sumdBm is None:
+            # Allocated once, with the layout of the first frame
+            self.sumdBm = np.zeros(dBm.shape)
+            self.binning = binning
+            if self.spectrogramOptions is not None:
+                self.spectrogram = Spectrogram(dBm.shape, **self.spectrogramOptions)
+        # Sum the dBm values for each channel of each antenna
+        self.sumdBm += dBm
+        self.NEntries += 1
+        if self.spectrogram is not None:
+            # Online mean and variance in the time (or LST) bin of the frame
+            time = np.datetime64(frame["RadioTaxiTime"].date_time, "ns")
+            self.spectrogram.add(time, dBm)
+
     def Physics(self, frame):
         self.SpectrumAverage(frame, "ArtifactsRemoved")
         
     def Finish(self):
+        if self.sumdBm is None:
+            log_warn("No frame passed the selection, no average spectrum is written")
+            return
+        avg_freqs = frequencyGrid(self.sumdBm.shape[-1], self.binning)
+        averages = self.sumdBm / self.NEntries
         plt.figure(figsize=(20, 15))
         for iant in range(3):
             for ichan in range(2):
-                channel_data = self.channel_averages[(iant, ichan)]
-                avg_freqs = channel_data['sumFreqs'] / channel_data['NEntries']
-                avg_dBm = channel_data['sumdBm'] / channel_data['NEntries']
+                avg_dBm = averages[iant, ichan]
                 # Create a subplot for the current antenna
                 plt.subplot(3, 1, iant+1)
                 if ichan == 0:
@@ -88,22 +89,22 @@ class AnalyzeQframes(icetray.I3Module):
         plt.xlabel("Frequency [MHz]")
         plt.legend()
         plt.savefig("spectral_average_antenna.png")
+        # The dBm/Hz offset of every frame is taken from radcube once per binning
+        printCacheStatistics()
+
+        if self.spectrogram is not None:
+            self.spectrogram.save(self.spectrogramOutput, avg_freqs / I3Units.megahertz)
+            plotWaterfall(self.spectrogram, avg_freqs / I3Units.megahertz,
+                          os.path.splitext(self.spectrogramOutput)[0] + ".png")
+            print("{0} frames outside the time range of the spectrogram".format(self.spectrogram.outside))
      
     
 
-tray = I3Tray()
-
-tray.AddModule("I3Reader", "reader",
-         FilenameList = filename) 
-
 # Choosing soft trigger only 
 def select_soft(frame):
     trigger_info = frame['SurfaceFilters']
     return trigger_info["soft_flag"].condition_passed
 
-# Add the module to the tray
-tray.Add(select_soft, "select_soft",
-         streams=[icetray.I3Frame.DAQ])
 
 # Select data with trace length equal to 1024
 def select_TraceLength(frame):
@@ -113,27 +114,77 @@ def select_TraceLength(frame):
         return True  # This will indicate that the frame should be saved to the selected stream
     else:
         return False  
-    
-# Add the module to the tray
-tray.Add(select_TraceLength, "select_TraceLength",
-         streams=[icetray.I3Frame.DAQ])
-
-# Removing TAXI artifacts 
-tray.Add(
-    radcube.modules.RemoveTAXIArtifacts, "ArtifactRemover",
-    InputName="RadioTAXIWaveform",
-    OutputName="ArtifactsRemoved",
-    medianOverCascades=True,
-    BaselineValue=0,
-    RemoveBinSpikes=True,
-    BinSpikeDeviance=int(2**12),
-    RemoveNegativeBins=True
-    )
-
-tray.AddModule("I3NullSplitter","splitter",
-               SubEventStreamName="RadioEvent"
-               )
-
-tray.AddModule(AnalyzeQframes, "Plotter")
-
-tray.Execute()
+
+
+# Options of the spectrogram, shared with Pipeline.py
+def addSpectrogramArguments(parser):
+    parser.add_argument("--spectrogram", type=str, choices=["time", "lst"], default=None,
+                        help="Also accumulate the spectra in bins of UTC time or of local sidereal time")
+    parser.add_argument("--start", type=str, default=None, help="Start of the time bins (e.g. 2023-01-01)")
+    parser.add_argument("--end", type=str, default=None, help="End of the time bins")
+    parser.add_argument("--timeBin", type=str, default="1D", help="Width of the time bins (e.g. 1h, 1D)")
+    parser.add_argument("--lstBins", type=int, default=96, help="Number of local sidereal time bins")
+    parser.add_argument("--spectrogramOutput", type=str, default="spectrogram.npz", help="Name of the spectrogram file")
+
+
+# Spectrogram parameter of AnalyzeQframes from the parsed options (None without --spectrogram)
+def spectrogramOptions(parser, args):
+    if args.spectrogram == "time" and (args.start is None or args.end is None):
+        parser.error("--spectrogram time needs --start and --end")
+    if args.spectrogram == "lst":
+        return dict(mode="lst", nbBins=args.lstBins)
+    if args.spectrogram == "time":
+        return dict(mode="time", start=args.start, end=args.end, binWidth=args.timeBin)
+    return None
+
+
+if __name__ == "__main__":
+    #Input i3 file with the data 
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input", type=str, nargs="+", default=[], help="List of i3 files")
+    addSpectrogramArguments(parser)
+    args = parser.parse_args()
+    spectrogram = spectrogramOptions(parser, args)
+
+    filename = args.input
+
+    tray = I3Tray()
+
+    # With up-to-date frame catalogs (FrameCatalog.py) the selection is read from them
+    # and the files without selected frames are not read
+    filename, selection = catalogSelection(filename, traceLength=1024)
+
+    tray.AddModule("I3Reader", "reader",
+             FilenameList = filename) 
+
+    # Add the module to the tray
+    if selection is None:
+        tray.Add(select_soft, "select_soft",
+                 streams=[icetray.I3Frame.DAQ])
+        tray.Add(select_TraceLength, "select_TraceLength",
+                 streams=[icetray.I3Frame.DAQ])
+    else:
+        tray.Add(selection, "select_catalog",
+                 streams=[icetray.I3Frame.DAQ])
+
+    # Removing TAXI artifacts 
+    tray.Add(
+        radcube.modules.RemoveTAXIArtifacts, "ArtifactRemover",
+        InputName="RadioTAXIWaveform",
+        OutputName="ArtifactsRemoved",
+        medianOverCascades=True,
+        BaselineValue=0,
+        RemoveBinSpikes=True,
+        BinSpikeDeviance=int(2**12),
+        RemoveNegativeBins=True
+        )
+
+    tray.AddModule("I3NullSplitter","splitter",
+                   SubEventStreamName="RadioEvent"
+                   )
+
+    tray.AddModule(AnalyzeQframes, "Plotter",
+                   Spectrogram=spectrogram,
+                   SpectrogramOutput=args.spectrogramOutput)
+
+    tray.Execute()
@@ -5,68 +5,136 @@ Test to make I3 files from TAXI binaries.
 Run with command (use no file extension for the OUTPUT_NAME):
 ./BinToI3File_UsingTAXIScripts.py BIN_FILE_NAME --output OUTPUT_NAME
 
+Directories, globs and lists of .bin or .bin.tgz files are converted in parallel, each output being named
+after its input (RUN.bin.tgz -> OUTPUT_DIR/RUN). Inputs whose output is newer than the input are skipped:
+./BinToI3File_UsingTAXIScripts.py RAW_DATA_DIR --outputDir OUTPUT_DIR --jobs 8
+
 - BSF 14/07/2023
 """
 
 import argparse
+import glob
+import multiprocessing
 import numpy as np
 import os
+import shutil
 import tarfile
+import tempfile
 from os import listdir
 from os.path import isfile, join
 
 
 ABS_PATH_HERE = str(os.path.dirname(os.path.realpath(__file__)))
 
-from icecube import dataclasses, dataio, icetray
-from icecube.icetray.i3logging import log_info, log_debug, log_warn, log_fatal
-from icecube.taxi_reader import taxi_tools
-from icecube.taxi_reader.data_processing import i3_converter
-
-
-parser = argparse.ArgumentParser()
-parser.add_argument("input", type=str, help="Name of .bin file to convert")
-parser.add_argument("--serdesDelayFile", type=str, default=None, help="Name of file for Serdes delay (if applicable)")
-parser.add_argument("--output", type=str, default=None, help="Name of the output file")
-args = parser.parse_args()
-
-infilename = args.input
-outfilename = "Data"
-
-if not isfile(args.input):
-    raise ValueError("Input file does not exist... Try again.")
-
-if args.serdesDelayFile is None:
-    delay = None
-    timestamps = None
-
-
-# Right now just define serdes_delay and serdes_timestamps as None b/c I don't think they are needed...
-i3_converter.radio2i3(infilename, outfilename, serdes_delay=None, serdes_timestamps=None)
-
-#This is for a .bin.tgz file:
 
-"""
-#Extract the .bin.tgz file
-input_tgz = args.input
-output_directory="/home/storres/work/Carmen_data/BackgroundAnalysis/NewData/prueba"
-
-with tarfile.open(input_tgz, "r:gz") as tar:
-    tar.extractall(path=output_directory)
-
-print(f"{input_tgz} extracted successfully to {output_directory}")
-
-input_bin = os.path.join(output_directory, os.path.splitext(os.path.basename(input_tgz))[0])
-output_i3 = os.path.join(output_directory, os.path.splitext(os.path.basename(input_bin))[0])
-
-
-if args.serdesDelayFile is None:
-    delay = None
-    timestamps = None
-
-    
-# Right now just define serdes_delay and serdes_timestamps as None b/c I don't think they are needed...
-i3_converter.radio2i3(input_bin, output_i3, serdes_delay=None, serdes_timestamps=None)
-
-print(f"{input_bin} converted to {output_i3}")
-"""
+BIN_EXTENSIONS = (".bin", ".bin.tgz", ".bin.tar.gz")
+# Extensions of the files written by radio2i3
+I3_EXTENSIONS = (".i3", ".i3.gz", ".i3.bz2", ".i3.zst")
+
+
+# Input files given as files, directories (all the TAXI binaries inside) or glob patterns
+def findInputs(names):
+    inputs = []
+    for name in names:
+        if os.path.isdir(name):
+            inputs += sorted(join(name, entry) for entry in listdir(name) if entry.endswith(BIN_EXTENSIONS))
+        elif isfile(name):
+            inputs.append(name)
+        else:
+            matches = sorted(glob.glob(name))
+            if not matches:
+                raise ValueError("Input file {0} does not exist... Try again.".format(name))
+            inputs += [match for match in matches if isfile(match)]
+    # A file given twice (e.g. by a directory and a pattern) is converted once
+    return list(dict.fromkeys(inputs))
+
+
+# Name of the output (without extension) of an input file: RUN.bin or RUN.bin.tgz -> outputDir/RUN
+def outputName(infilename, outputDir):
+    name = os.path.basename(infilename)
+    for extension in BIN_EXTENSIONS[::-1]:
+        if name.endswith(extension):
+            name = name[:-len(extension)]
+            break
+    return join(outputDir, name)
+
+
+# Files written by radio2i3 for the output name, which adds its own extension. Only the I3 extensions
+# are matched, so an input next to its output (RUN.bin and RUN.i3.gz) is never taken for it.
+def outputFiles(output):
+    return [output + extension for extension in I3_EXTENSIONS if isfile(output + extension)]
+
+
+# The conversion is up to date if an output exists and is newer than the input
+def isUpToDate(infilename, output):
+    files = outputFiles(output)
+    return len(files) > 0 and min(os.path.getmtime(name) for name in files) >= os.path.getmtime(infilename)
+
+
+# Copies the .bin member of a .bin.tgz file to directory, reading the archive as a stream, so neither
+# the whole archive nor the other members are extracted. Returns the name of the extracted file.
+def extractBin(input_tgz, directory, blockSize=1 << 22):
+    with tarfile.open(input_tgz, "r|gz") as tar:
+        for member in tar:
+            if member.isfile() and member.name.endswith(".bin"):
+                input_bin = join(directory, os.path.basename(member.name))
+                with tar.extractfile(member) as source, open(input_bin, "wb") as target:
+                    shutil.copyfileobj(source, target, blockSize)
+                return input_bin
+    raise ValueError("No .bin file in {0}".format(input_tgz))
+
+
+# Converts one TAXI binary (task = (input, output, tmpDir)). The output is first written under a temporary
+# name and renamed when the conversion succeeded, so an interrupted conversion is never taken as up to date.
+def convertFile(task):
+    # Imported here, so the selection of the inputs does not need IceTray
+    from icecube.taxi_reader.data_processing import i3_converter
+
+    infilename, output, tmpDir = task
+    workDir = tempfile.mkdtemp(prefix="taxi_", dir=tmpDir)
+    try:
+        input_bin = infilename
+        if not infilename.endswith(".bin"):
+            input_bin = extractBin(infilename, workDir)
+        partial = output + ".part"
+        # Right now just define serdes_delay and serdes_timestamps as None b/c I don't think they are needed...
+        i3_converter.radio2i3(input_bin, partial, serdes_delay=None, serdes_timestamps=None)
+        for name in glob.glob(glob.escape(partial) + "*"):
+            os.replace(name, output + name[len(partial):])
+    finally:
+        shutil.rmtree(workDir)
+    print(f"{infilename} converted to {output}")
+    return output
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input", type=str, nargs="+", help="Names of .bin or .bin.tgz files, directories or glob patterns to convert")
+    parser.add_argument("--serdesDelayFile", type=str, default=None, help="Name of file for Serdes delay (if applicable)")
+    parser.add_argument("--output", type=str, default=None, help="Name of the output file, for a single input")
+    parser.add_argument("--outputDir", type=str, default=".", help="Directory of the outputs, named after the inputs")
+    parser.add_argument("--tmpDir", type=str, default=None, help="Directory where the .bin members of the archives are extracted")
+    parser.add_argument("--jobs", type=int, default=1, help="Number of worker processes")
+    parser.add_argument("--force", action="store_true", help="Also convert the files whose output is up to date")
+    args = parser.parse_args()
+
+    inputs = findInputs(args.input)
+    if args.output is not None and len(inputs) != 1:
+        parser.error("--output can only be used with a single input, use --outputDir")
+    os.makedirs(args.outputDir, exist_ok=True)
+    tmpDir = args.outputDir if args.tmpDir is None else args.tmpDir
+
+    tasks = []
+    for infilename in inputs:
+        output = args.output if args.output is not None else outputName(infilename, args.outputDir)
+        if not args.force and isUpToDate(infilename, output):
+            print(f"{output} is up to date, skipping {infilename}")
+            continue
+        tasks.append((infilename, output, tmpDir))
+
+    if args.jobs > 1 and len(tasks) > 1:
+        with multiprocessing.Pool(min(args.jobs, len(tasks))) as pool:
+            list(pool.imap_unordered(convertFile, tasks))
+    else:
+        for task in tasks:
+            convertFile(task)
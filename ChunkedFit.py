@@ -0,0 +1,124 @@
+"""
+Out-of-core version of the processing of CurveFit.py, for RMS series that do not fit in memory.
+
+The data is read in time-ordered chunks (RmsStore.iterRms) and goes through the same steps as
+BackgroundOscillation: cleanData, movingAverage, setTimeWindow and fitAll. Only the sums of the normal
+equations of the fit (and optionally a LstFold) are kept, so the memory does not depend on the length
+of the series. The results are the same as the in-memory version:
+  - the cleaning thresholds need the minimum of every channel over the rows kept by the previous channels,
+    so they are computed first with one pass over the data per channel;
+  - the rows of the previous chunks that are still inside the moving window are carried to the next chunk;
+  - the moving averages are centered after the fit, by shifting the sums of the normal equations.
+"""
+
+import numpy as np
+import pandas as pd
+
+from RmsStore import iterRms
+from SinusFit import FREQUENCIES, NormalEquations, toSeconds
+from SiderealFold import LstFold, localSiderealTime
+
+
+# Rolling mean or median of a series given in chunks, equal to the pandas rolling of the whole series
+# (up to the rounding of the running sums of the mean). window is a number of rows, or a time span such
+# as "2h" for the rows in (t - window, t].
+class RollingWindow():
+
+    def __init__(self, window, statistic="mean"):
+        self.window = window
+        self.statistic = statistic
+        self.time = None
+        self.values = None
+
+    # time: datetime64, shape (rows,); values: shape (rows, channels). Returns the statistic of the new rows.
+    def update(self, time, values):
+        nbTail = 0
+        if self.time is not None:
+            nbTail = len(self.time)
+            time = np.concatenate([self.time, time])
+            values = np.concatenate([self.values, values])
+        if isinstance(self.window, str):
+            frame = pd.DataFrame(values, index=pd.DatetimeIndex(time))
+            keep = len(time) - np.searchsorted(time, time[-1] - pd.Timedelta(self.window).to_timedelta64(),
+                                               side="right") if len(time) else 0
+        else:
+            frame = pd.DataFrame(values)
+            keep = min(self.window - 1, len(time))
+        rolling = frame.rolling(self.window)
+        result = rolling.median() if self.statistic == "median" else rolling.mean()
+        self.time, self.values = time[len(time) - keep:], values[len(values) - keep:]
+        return result.to_numpy()[nbTail:]
+
+
+# Time and RMS values (rows, antennas * channels) of the chunks, checking that the times are ordered.
+# For a multi-band file, the values of the band with index band.
+def readChunks(name, start=None, end=None, chunkSize=1 << 20, band=0):
+    last = None
+    for data in iterRms(name, start, end, chunkSize=chunkSize):
+        data = data.band(band)
+        time = np.asarray(data.time, dtype="datetime64[ns]")
+        if len(time) == 0:
+            continue
+        if np.any(time[1:] < time[:-1]) or (last is not None and time[0] < last):
+            raise ValueError("The times of {0} are not ordered, the chunked fit needs time-ordered data".format(name))
+        last = time[-1]
+        yield time, np.asarray(data.rms, dtype=float).reshape(len(time), -1)
+
+
+# Thresholds of cleanData: the minimum of every channel over the rows kept by the previous channels, plus n
+def cleaningThresholds(name, start=None, end=None, n=17, chunkSize=1 << 20, band=0):
+    thresholds = []
+    ich = 0
+    while True:
+        minimum = np.inf
+        nbChannels = 0
+        for time, rms in readChunks(name, start, end, chunkSize, band):
+            nbChannels = rms.shape[1]
+            mask = np.all(rms[:, :ich] <= thresholds, axis=1)
+            minimum = min(minimum, np.nanmin(rms[mask, ich], initial=np.inf))
+        thresholds.append(minimum + n)
+        ich += 1
+        if ich >= nbChannels:
+            return np.array(thresholds)
+
+
+# Fit of the centered moving average of all the channels between startTime and endTime (excluded), as
+# BackgroundOscillation.fitAll after processData and setTimeWindow. The input is read in chunks of
+# chunkSize frames. With foldBins, the cleaned RMS values are also folded in local sidereal time; the sidereal
+# times of the chunks are only cached on disk (lstCache), not in memory.
+# Returns the SinusFit and the LstFold (or None).
+def chunkedFit(name, startTime, endTime, window=150, statistic="mean", n=17, chunkSize=1 << 20,
+               foldBins=None, foldRange=(0., 100.), lstCache=None, freqs=FREQUENCIES, band=0):
+    thresholds = cleaningThresholds(name, startTime, endTime, n, chunkSize, band)
+    start, end = np.datetime64(startTime, "ns"), np.datetime64(endTime, "ns")
+    rolling = RollingWindow(window, statistic)
+    equations = NormalEquations(len(thresholds), freqs)
+    fold = None if foldBins is None else LstFold(foldBins, len(thresholds), foldRange)
+    sums = np.zeros(len(thresholds))
+    counts = np.zeros(len(thresholds), dtype=np.int64)
+    offset = None
+
+    for time, rms in readChunks(name, startTime, endTime, chunkSize, band):
+        kept = np.all(rms <= thresholds, axis=1)
+        time, rms = time[kept], rms[kept]
+        averages = rolling.update(time, rms)
+        inWindow = (time > start) & (time < end)
+        time, rms, averages = time[inWindow], rms[inWindow], averages[inWindow]
+        if len(time) == 0:
+            continue
+        finite = np.isfinite(averages)
+        sums += np.where(finite, averages, 0).sum(axis=0)
+        counts += finite.sum(axis=0)
+        valid = np.all(finite, axis=1)
+        if offset is None and np.any(valid):
+            # Provisional centering, so the sums of squares do not lose precision
+            offset = averages[valid].mean(axis=0)
+        if np.any(valid):
+            equations.add(toSeconds(time[valid]), averages[valid] - offset)
+        if fold is not None:
+            fold.add(localSiderealTime(time, cacheDir=lstCache, useCache=False), rms)
+
+    if offset is not None:
+        with np.errstate(invalid="ignore", divide="ignore"):
+            equations.subtract(sums / counts - offset)
+    return equations.solve(), fold
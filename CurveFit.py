@@ -5,9 +5,6 @@ import matplotlib.gridspec as gridspec
 import matplotlib.dates
 from datetime import datetime
 import pandas as pd
-from scipy.optimize import leastsq
-from scipy.optimize import curve_fit
-from icecube.icetray import I3Units
 
 from astropy.visualization import astropy_mpl_style, quantity_support
 plt.style.use(astropy_mpl_style)
@@ -20,41 +17,34 @@ from astropy.coordinates import SkyCoord, EarthLocation, AltAz, Angle
 import matplotlib.pyplot as plt
 import argparse
 
-#Input i3 file with the data 
-parser = argparse.ArgumentParser()
-parser.add_argument("input", type=str, help="Name of .npz file")
-args = parser.parse_args()
-
-filename = args.input
-
-year1 = "2022"
-year2 = "2023"
-
+from ChunkedFit import chunkedFit
+from RmsStore import openRms
+from SinusFit import DAY, SIDEREAL_FREQUENCY, SOLAR_FREQUENCY, fitSinus, resampleSinus, toSeconds, trackSinus
+from SiderealFold import LstFold, localSiderealTime
+from Periodogram import lombScargle
 
 #This class reads the NPZ file with the RMS values and creates a DataFrame, then 
 #it cleans the data and calculates a moving average to finally fits a sinusoidal function.
 class BackgroundOscillation():
     
-    def __init__(self, filename):
+    # For a dataset directory, only the data between startTime and endTime is read
+    def __init__(self, filename, startTime=None, endTime=None, band=0):
         self.time = []
         self.rms = []
         self.ant = 3
         self.pol = 2
         self.window = 150
+        self.rollingStatistic = "mean"
         self.df = pd.DataFrame()
-        self.readNpz(filename)
+        self.readNpz(filename, startTime, endTime, band)
         print("reading the data ... from ", filename)
         
-    def readNpz(self, filename):
-        data = np.load(filename, allow_pickle=True)
-        self.time = data["time"]
-        self.rms = np.array([
-            data["rms10"],
-            data["rms11"],
-            data["rms20"],
-            data["rms21"],
-            data["rms30"],
-            data["rms31"]])
+    # Reads the RMS file (any layout), self.rms gets one row per antenna and channel: rms10, rms11, rms20 ...
+    # For a multi-band file, only the band with index band is read.
+    def readNpz(self, filename, startTime=None, endTime=None, band=0):
+        data = openRms(filename, startTime, endTime).band(band)
+        self.time = data.time
+        self.rms = data.rms.reshape(len(data), -1).T
 
     # proessData calls the toPandas method to convert the data into a Pandas DataFrame format.
     # Then calls the movingAverage method to calculate moving averages.
@@ -64,8 +54,14 @@ class BackgroundOscillation():
         self.movingAverage()
         print("processing the data...")
 
-    def setWindow(self, value):
-        self.window = value
+    # value is a number of samples, or a time span such as "2h" for a time-based window
+    def setWindow(self, value, statistic="mean"):
+        self.window = int(value) if str(value).isdigit() else value
+        self.rollingStatistic = statistic
+
+    # Names of the columns of all the antennas and channels: rms10, rms11, rms20 ...
+    def columns(self, prefix="rms"):
+        return ["{0}{1}{2}".format(prefix, 1+iant, ich) for iant in range(self.ant) for ich in range(self.pol)]
 
     # Function toPandas converts the loaded data into a structured Pandas DataFrame.
     def toPandas(self):
@@ -77,75 +73,136 @@ class BackgroundOscillation():
                 
     # This method is responsible for cleaning the data by removing outliers or erroneous values.
     # The method takes an optional argument n and calculates a threshold value by adding n to the minimum RMS.
+    # As before, the minimum of each channel is taken over the rows kept by the previous channels, but the
+    # cuts are combined in one boolean mask over the (N, 6) array and the DataFrame is filtered only once.
     def cleanData(self, n=17):
-        for iant in range(self.ant):
-            for ich in range(self.pol):
-                idx = "rms{0}{1}".format(1+iant, ich)
-                self.df = self.df[self.df[idx] <= np.min(self.df[idx]) + n]
+        rms = self.df[self.columns()].to_numpy(dtype=float)
+        mask = np.ones(len(rms), dtype=bool)
+        for i in range(rms.shape[1]):
+            mask &= rms[:, i] <= np.nanmin(rms[mask, i], initial=np.inf) + n
+        self.df = self.df[mask]
     
-    # MovingAverage calculates the moving average of RMS values using the rolling method of Pandas DataFrames.
+    # MovingAverage calculates the moving average of RMS values using the rolling method of Pandas DataFrames,
+    # for all the antennas and channels at once. With a time span window (e.g. "2h") the window covers the same
+    # time whatever the trigger rate. The rolling median is used instead if rollingStatistic is "median".
     # The calculated moving averages are stored in new columns named "average{ant}{pol}".
     def movingAverage(self):
-        for iant in range(self.ant):
-            for ich in range(self.pol):
-                idx = "{0}{1}".format(1+iant, ich)
-                self.df["average"+idx] = self.df["rms"+idx].rolling(self.window).mean()
+        columns = self.columns()
+        if isinstance(self.window, str):
+            if not self.df["time"].is_monotonic_increasing:
+                self.df = self.df.sort_values("time", axis=0, ascending=True)
+            rolling = self.df[["time"] + columns].rolling(self.window, on="time")
+        else:
+            rolling = self.df[columns].rolling(self.window)
+        averages = rolling.median() if self.rollingStatistic == "median" else rolling.mean()
+        self.df[self.columns("average")] = averages[columns].to_numpy()
                 
     
     def setTimeWindow(self, startTime, endTime):
         self.startTime = startTime
         self.endTime = endTime
-        self.df = self.df.sort_values("time", axis=0, ascending=True)
+        if not self.df["time"].is_monotonic_increasing:
+            self.df = self.df.sort_values("time", axis=0, ascending=True)
         self.df = self.df.loc[self.df['time'] > startTime]
         self.df = self.df.loc[self.df['time'] < endTime]
         
 
-    def fitSinus(self, time, rms):
-        
-        # val.timestamp() converts each datetime object val to a Unix timestamp 
-        # (a float representing the number of seconds since January 1, 1970).
-        t = np.array([val.timestamp() for val in time])
-        
-        # Initial Parameters
-        guess_mean = 0
-        guess_std = np.std(rms)
-        guess_phase = 0
-        guess_amp = guess_std / np.sqrt(2)
-        freq = 0.00001160576 #sidereal frequency = 1/{(23h*60min*60s)+(56min*60s)+4,0916s}
-        
-        guess_std2 = np.std(rms)
-        guess_phase2 = 0.5
-        guess_amp2 = 0.001
-        freq2 = 0.00001157407 #solar frequency = 1/(24h*60min*60s)
-
+    # Fits A1*sin(2*pi*f_sid*t + phi1) + A2*sin(2*pi*f_sol*t + phi2) + B to the centered moving average
+    # of all the channels at once, with an exact linear least squares solve.
+    # self.dataFit holds the fitted curves, one column per antenna and channel (rms10, rms11, rms20 ...).
+    def fitAll(self):
+        columns = self.columns("average")
+        averages = self.df[columns].to_numpy(dtype=float)
+        #Centered the data 
+        averages = averages - np.nanmean(averages, axis=0)
+        t = toSeconds(self.df["time"])
+        self.fit = fitSinus(t, averages)
+        #Recreate the fitted curve using the optimized parameters
+        self.dataFit = self.fit.evaluate(t)
+    
 
-        def sinusoidal_func(t, amp, phase, amp2, phase2, mean):
-            return amp * np.sin(2 * np.pi * freq * t + phase) + amp2 * np.sin(2 * np.pi * freq2 * t + phase2) + mean
+    # Sidereal and solar amplitudes and phases fitted in sliding windows (e.g. window="7D", step="1h"),
+    # for all the antennas and channels in a single pass over the cleaned RMS values
+    def trackSinus(self, window, step):
+        columns = self.columns()
+        t = toSeconds(self.df["time"])
+        return trackSinus(t, self.df[columns].to_numpy(dtype=float),
+                          pd.Timedelta(window).total_seconds(), pd.Timedelta(step).total_seconds())
 
-        # Parameter estimation using curve fit
-        initial_guess = [guess_amp, guess_phase, guess_amp2, guess_phase2, guess_mean]
-        param_bounds=([0,-np.inf,0,-np.inf,-np.inf],[np.inf,np.inf,np.inf,np.inf,np.inf])
-        popt, pcov = curve_fit(sinusoidal_func, t, rms, p0=initial_guess, bounds=param_bounds)
+    def plotTrack(self, track):
+        color = ["tab:green", "tab:blue"]
+        time = (track.time * 1e9).astype("datetime64[ns]")
+        fig, axes = plt.subplots(figsize=[20, 15], nrows=self.ant, ncols=2, sharex=True)
+        for iant in range(self.ant):
+            for ich in range(self.pol):
+                label = "Ant. {0}, Channel. {1}".format(1+iant, ich+1)
+                axes[iant, 0].plot(time, track.amp[:, 2*iant + ich], c=color[ich], label=label)
+                axes[iant, 1].plot(time, track.phase[:, 2*iant + ich], c=color[ich], label=label)
+            axes[iant, 0].set_ylabel("Sidereal amplitude")
+            axes[iant, 1].set_ylabel("Sidereal phase [rad]")
+            axes[iant, 0].legend(loc="upper right")
+        plt.tight_layout()
 
-        # Deviation standart of the parameters
-        perr = np.sqrt(np.diag(pcov))
+    # Folds the cleaned RMS values of all the antennas and channels in local sidereal time at the station
+    def foldLst(self, nbBins=96, valueRange=(0., 100.), cacheDir=None):
+        columns = self.columns()
+        lst = localSiderealTime(self.df["time"].to_numpy(), cacheDir=cacheDir)
+        fold = LstFold(nbBins, len(columns), valueRange)
+        fold.add(lst, self.df[columns].to_numpy(dtype=float))
+        return fold
 
-        est_amp, est_phase, est_amp2, est_phase2, est_mean = popt
-        est_amp_err, est_phase_err, est_amp2_err, est_phase2_err, est_mean_err= perr
+    def plotFold(self, fold):
+        color = ["tab:green", "tab:blue"]
+        fig, axes = plt.subplots(figsize=[20, 15], nrows=self.ant, ncols=1, sharex=True)
+        for iant in range(self.ant):
+            for ich in range(self.pol):
+                label = "Ant. {0}, Channel. {1}".format(1+iant, ich+1)
+                axes[iant].plot(fold.binCenters, fold.mean[:, 2*iant + ich], "-", c=color[ich], label="Mean " + label)
+                axes[iant].plot(fold.binCenters, fold.median[:, 2*iant + ich], "--", c=color[ich], label="Median " + label)
+            axes[iant].set_ylabel("RMS")
+            axes[iant].legend(loc="upper right")
+        axes[-1].set_xlabel("Local sidereal time [h]")
+        plt.tight_layout()
 
-        #Recreate the fitted curve using the optimized parameters
-        data_fit = sinusoidal_func(t, est_amp, est_phase, est_amp2, est_phase2, est_mean)
-        
+    # Lomb-Scargle periodogram of the cleaned RMS values of all the channels, fmin and fmax in cycles/day
+    def periodogram(self, fmin=0.9, fmax=1.1, oversampling=10):
+        columns = self.columns()
+        t = toSeconds(self.df["time"])
+        periodogram = lombScargle(t, self.df[columns].to_numpy(dtype=float), fmin / DAY, fmax / DAY, oversampling)
+        freqs, power, fap = periodogram.peaks()
+        for i, column in enumerate(columns):
+            print("{0}: peak at {1:.6f} cycles/day, power {2:.4g}, false alarm probability {3:.3g}".format(
+                column, freqs[i] * DAY, power[i], fap[i]))
+        return periodogram
 
-        print("Estimated Parameters:")
-        print("Amplitude 1: {0} +/- {1}".format(est_amp, est_amp_err))
-        print("Phase 1: {0} +/- {1}".format(est_phase, est_phase_err))
-        print("Mean: {0} +/- {1}".format(est_mean, est_mean_err))
-        print("Amplitude 2: {0} +/- {1}".format(est_amp2, est_amp2_err))
-        print("Phase 2: {0} +/- {1}".format(est_phase2, est_phase2_err))
+    def plotPeriodogram(self, periodogram):
+        color = ["tab:green", "tab:blue"]
+        fig, axes = plt.subplots(figsize=[20, 15], nrows=self.ant, ncols=1, sharex=True)
+        for iant in range(self.ant):
+            for ich in range(self.pol):
+                axes[iant].plot(periodogram.freqs * DAY, periodogram.power[2*iant + ich], c=color[ich],
+                                label="Ant. {0}, Channel. {1}".format(1+iant, ich+1))
+            axes[iant].axvline(SIDEREAL_FREQUENCY * DAY, ls="--", c="k", label="Sidereal day")
+            axes[iant].axvline(SOLAR_FREQUENCY * DAY, ls=":", c="k", label="Solar day")
+            axes[iant].set_ylabel("Power")
+            axes[iant].legend(loc="upper right")
+        axes[-1].set_xlabel("Frequency [cycles/day]")
+        plt.tight_layout()
 
-        return data_fit
-    
+    # Resampling uncertainties of the fit of fitAll, with whole days as blocks so the correlation
+    # introduced by the moving average is kept in every replica
+    def resampleFit(self, method="bootstrap", replicas=2000, jobs=1):
+        columns = self.columns("average")
+        averages = self.df[columns].to_numpy(dtype=float)
+        averages = averages - np.nanmean(averages, axis=0)
+        resampling = resampleSinus(toSeconds(self.df["time"]), averages, method, replicas, jobs)
+        ampLow, ampHigh = resampling.interval("amp")
+        phaseLow, phaseHigh = resampling.interval("phase")
+        for i, column in enumerate(columns):
+            print("{0}: Amplitude 1: {1} [{2}, {3}], Phase 1: {4} [{5}, {6}] (95% {7})".format(
+                column, resampling.fit.amp[i], ampLow[i], ampHigh[i],
+                resampling.fit.phase[i], phaseLow[i], phaseHigh[i], method))
+        return resampling
 
     def plotSinusFit(self, ax, time, data_fit, **kwargs):
         ax.plot_date(time, data_fit, **kwargs)
@@ -161,7 +218,7 @@ class BackgroundOscillation():
         time = self.df["time"]
         rms_centered = self.df["rms"+idx] - np.mean(self.df["rms"+idx])
         
-        data_fit = self.fitSinus(time, averageRms)
+        data_fit = pd.Series(self.dataFit[:, 2*iant + ich], index=averageRms.index)
         
            
         startTime2 = '2023-08-01'
@@ -180,20 +237,18 @@ class BackgroundOscillation():
         ax.plot_date(filtered_time, filtered_rms_centered, fmt=",", c=color[ich], alpha=0.5, label="Ant. {0}, Pol. {1}".format(1+iant, ich))
         ax.plot_date(filtered_time, filtered_averageRms, fmt=",", c=color2[ich], alpha=0.4, label="Moving average Ant. {0}, Channel. {1}".format(1+iant, ich+1))
         print("Ant. {0}, Pol. {1}".format(1+iant, ich+1))
+        self.fit.printParameters(2*iant + ich)
        
         
         self.plotSinusFit(ax, filtered_time, filtered_data_fit, lw=2, fmt="--", label="sinus fitting rmsAnt. {0}, Channel. {1}".format(1+iant, ich+1), c=color3[ich])
-        # Calculate the squared differences between original and fitted data
-        squared_diff = (averageRms - data_fit) ** 2
-        # Calculate the Mean Squared Error (MSE)
-        mse = np.mean(squared_diff)
-
-        print("Mean Squared Error:", mse)
+        # Mean Squared Error (MSE) between original and fitted data
+        print("Mean Squared Error:", self.fit.mse[2*iant + ich])
        
         
     def plotAll(self):
         fig = plt.figure(figsize=[20, 15])
         spec = gridspec.GridSpec(ncols=1, nrows=3)
+        self.fitAll()
         
         for iant in range(self.ant):
             ax = fig.add_subplot(spec[iant])
@@ -205,13 +260,89 @@ class BackgroundOscillation():
             plt.setp(ax.get_xticklabels(), visible=True)
         plt.tight_layout()
 
-bg = BackgroundOscillation(filename)
-startTime = '{0}-11-26'.format(year1)
-endTime = '{0}-09-25'.format(year2)
 
-bg.processData()
-bg.setTimeWindow(startTime=startTime, endTime=endTime)
-bg.plotAll()
-plt.savefig("/home/storres/work/GalacticNoiseAnalysis/fitting.png")
-plt.close()
+# Command line: reads the RMS values, fits them and writes the plots and results of the options.
+# Kept under the main guard, so the worker processes of --resample import the module without rerunning it.
+def main():
+    #Input i3 file with the data 
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input", type=str, help="Name of .npz file or of a day-partitioned dataset directory")
+    parser.add_argument("--band", type=int, default=0, help="Index of the band to fit, for the output of a multi-band run")
+    parser.add_argument("--window", type=str, default="150", help="Moving average window, a number of samples (150) or a time span (e.g. 2h)")
+    parser.add_argument("--rollingStatistic", type=str, choices=["mean", "median"], default="mean", help="Statistic of the moving window")
+    parser.add_argument("--trackWindow", type=str, default=None, help="Also track the fitted parameters in sliding windows of this width (e.g. 7D)")
+    parser.add_argument("--trackStep", type=str, default="1h", help="Step between the sliding windows (e.g. 1h)")
+    parser.add_argument("--foldBins", type=int, default=None, help="Also fold the RMS values in this number of local sidereal time bins")
+    parser.add_argument("--foldRange", type=float, nargs=2, default=[0., 100.], help="Range of the RMS values for the median of the fold")
+    parser.add_argument("--periodogram", type=float, nargs=2, default=None, metavar=("FMIN", "FMAX"),
+                        help="Also compute the Lomb-Scargle periodogram between these frequencies in cycles/day (e.g. 0.9 1.1)")
+    parser.add_argument("--resample", type=str, choices=["bootstrap", "jackknife"], default=None,
+                        help="Also estimate the uncertainties of the fit with a day-block bootstrap or a leave-one-day-out jackknife")
+    parser.add_argument("--replicas", type=int, default=2000, help="Number of bootstrap replicas")
+    parser.add_argument("--jobs", type=int, default=1, help="Number of processes for the resampling")
+    parser.add_argument("--chunkSize", type=int, default=None,
+                        help="Read the input in time-ordered chunks of this number of frames instead of loading it in memory. "
+                             "Only the fit (sinus_fit.npz) and the LST fold are computed")
+    parser.add_argument("--lstCache", type=str, default=None, help="Directory where the local sidereal times are cached")
+    args = parser.parse_args()
+
+    filename = args.input
+
+    year1 = "2022"
+    year2 = "2023"
+
+    startTime = '{0}-11-26'.format(year1)
+    endTime = '{0}-09-25'.format(year2)
+
+    if args.chunkSize is not None:
+        if args.trackWindow is not None or args.periodogram is not None or args.resample is not None:
+            parser.error("--trackWindow, --periodogram and --resample need the data in memory, they can not be used with --chunkSize")
+        window = int(args.window) if args.window.isdigit() else args.window
+        fit, fold = chunkedFit(filename, startTime, endTime, window, args.rollingStatistic, chunkSize=args.chunkSize,
+                               foldBins=args.foldBins, foldRange=args.foldRange, lstCache=args.lstCache, band=args.band)
+        columns = ["rms{0}{1}".format(1+iant, ich) for iant in range(3) for ich in range(2)]
+        for i, column in enumerate(columns):
+            print(column)
+            fit.printParameters(i)
+        fit.save("sinus_fit.npz")
+        if fold is not None:
+            fold.save("lst_fold.npz")
+        return
+
+    bg = BackgroundOscillation(filename, startTime, endTime, args.band)
+    bg.setWindow(args.window, args.rollingStatistic)
+
+    bg.processData()
+    bg.setTimeWindow(startTime=startTime, endTime=endTime)
+    bg.plotAll()
+    plt.savefig("/home/storres/work/GalacticNoiseAnalysis/fitting.png")
+    plt.close()
+
+    if args.trackWindow is not None:
+        track = bg.trackSinus(args.trackWindow, args.trackStep)
+        track.save("sinus_tracking.npz")
+        bg.plotTrack(track)
+        plt.savefig("sinus_tracking.png")
+        plt.close()
+
+    if args.foldBins is not None:
+        fold = bg.foldLst(args.foldBins, args.foldRange, args.lstCache)
+        fold.save("lst_fold.npz")
+        bg.plotFold(fold)
+        plt.savefig("lst_fold.png")
+        plt.close()
+
+    if args.periodogram is not None:
+        periodogram = bg.periodogram(*args.periodogram)
+        periodogram.save("periodogram.npz")
+        bg.plotPeriodogram(periodogram)
+        plt.savefig("periodogram.png")
+        plt.close()
+
+    if args.resample is not None:
+        resampling = bg.resampleFit(args.resample, args.replicas, args.jobs)
+        resampling.save("sinus_{0}.npz".format(args.resample))
+
 
+if __name__ == "__main__":
+    main()
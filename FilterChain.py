@@ -0,0 +1,189 @@
+"""
+NumPy version of the filter chain of NPZ.py and Histograms.py, for stacks of traces.
+
+The radcube chain is MedianFrequencyFilter (amplitude of every frequency bin replaced by the median of the
+amplitudes in a window around it, phase kept) followed by a Butterworth BandpassFilter applied in the frequency
+domain. FilterChain does the same steps on a whole block (..., samples) of artifact-free time series with one
+batched rFFT, a vectorized sliding median and a Butterworth response computed once per trace geometry.
+The TAXI artifact removal stays in IceTray.
+
+With several bands, applyBands keeps the rFFT and the median filter of every trace and only repeats the cheap
+Butterworth products, then goes back to the time domain with one batched inverse transform for all the bands.
+
+The response is zero-phase (magnitude only) and the median window convention (width in bins, windows cut at
+the edges of the spectrum) is not taken from radcube, so the chain is not assumed to reproduce the radcube
+modules. FilterValidation compares them frame by frame and writes the result in a validation file; the
+analyses only accept --engine numpy once a validation with the same median window and Butterworth order
+passed on real data.
+"""
+
+import itertools
+import json
+import os
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from NoiseTools import FrameArray, cutTraces, geometryCache
+
+
+VALIDATION_FILE = "filter_validation.json"
+VALIDATION_TOLERANCE = 1e-3  # Largest relative deviation of the subtraces noise
+
+
+# Magnitude response of the bandpass Butterworth filter of the given order on the rFFT bins of traces with
+# nbSamples samples every binning ns, limits in MHz: a low pass at the upper limit times a high pass at
+# the lower limit. Computed once per trace geometry and shared read-only.
+@geometryCache()
+def butterworthResponse(nbSamples, binning, order, limits):
+    freqs = np.fft.rfftfreq(nbSamples, binning) * 1e3  # MHz
+    low, high = limits
+    with np.errstate(divide="ignore", over="ignore"):
+        return 1 / np.sqrt(1 + (freqs / high)**(2 * order)) / np.sqrt(1 + (low / freqs)**(2 * order))
+
+
+# Median filter of spectra (..., bins): the amplitude of every bin becomes the median of the amplitudes
+# of the bins i - width//2 ... i + width//2 (cut at the edges of the spectrum), the phase is kept
+def medianFrequencyFilter(spectrum, width):
+    amplitude = np.abs(spectrum)
+    nbBins = amplitude.shape[-1]
+    half = width // 2
+    median = np.empty_like(amplitude)
+    if nbBins > 2 * half:
+        # The inner windows have an odd number of bins, their median is the middle element
+        windows = sliding_window_view(amplitude, 2 * half + 1, axis=-1)
+        median[..., half:nbBins - half] = np.partition(windows, half, axis=-1)[..., half]
+    for i in itertools.chain(range(min(half, nbBins)), range(max(nbBins - half, half), nbBins)):
+        median[..., i] = np.median(amplitude[..., max(0, i - half):i + half + 1], axis=-1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(amplitude > 0, spectrum * (median / amplitude), median)
+
+
+class FilterChain():
+
+    def __init__(self, medianWindow=20, butterworthOrder=13, filterLimits=(140., 190.), batchSize=256):
+        self.medianWindow = medianWindow
+        self.butterworthOrder = butterworthOrder
+        self.filterLimits = tuple(float(limit) for limit in filterLimits)
+        self.batchSize = batchSize
+
+    # Filtered time series of a block of traces (..., samples) sampled every binning ns.
+    # The traces are transformed by batches of batchSize to bound the temporary arrays.
+    def apply(self, traces, binning):
+        traces = np.asarray(traces, dtype=float)
+        nbSamples = traces.shape[-1]
+        response = butterworthResponse(nbSamples, float(binning), self.butterworthOrder, self.filterLimits)
+        flat = traces.reshape(-1, nbSamples)
+        filtered = np.empty_like(flat)
+        for lo in range(0, len(flat), self.batchSize):
+            spectrum = np.fft.rfft(flat[lo:lo + self.batchSize], axis=-1)
+            if self.medianWindow:
+                spectrum = medianFrequencyFilter(spectrum, self.medianWindow)
+            filtered[lo:lo + self.batchSize] = np.fft.irfft(spectrum * response, nbSamples, axis=-1)
+        return filtered.reshape(traces.shape)
+
+    # Filtered time series of a block of traces (..., samples) in every band, shape (..., bands, samples).
+    # bands: list of (low, high) limits in MHz, used instead of filterLimits. The spectrum and its median
+    # filter are computed once per trace and shared by all the bands.
+    def applyBands(self, traces, binning, bands):
+        traces = np.asarray(traces, dtype=float)
+        nbSamples = traces.shape[-1]
+        responses = np.stack([butterworthResponse(nbSamples, float(binning), self.butterworthOrder,
+                                                  tuple(float(limit) for limit in band)) for band in bands])
+        flat = traces.reshape(-1, nbSamples)
+        filtered = np.empty((len(flat), len(bands), nbSamples))
+        # The batches hold one inverse transform per band
+        batchSize = max(self.batchSize // len(bands), 1)
+        for lo in range(0, len(flat), batchSize):
+            spectrum = np.fft.rfft(flat[lo:lo + batchSize], axis=-1)
+            if self.medianWindow:
+                spectrum = medianFrequencyFilter(spectrum, self.medianWindow)
+            filtered[lo:lo + batchSize] = np.fft.irfft(spectrum[:, np.newaxis] * responses, nbSamples, axis=-1)
+        return filtered.reshape(traces.shape[:-1] + (len(bands), nbSamples))
+
+
+# Frame function comparing the NumPy chain applied to inputName with the radcube output referenceName.
+# Keeps the largest deviation of the traces (relative to the RMS of the radcube trace) and of the
+# subtraces noise values.
+class FilterValidation():
+
+    def __init__(self, chain, inputName="ArtifactsRemoved", referenceName="FilteredMap", lengthSubTraces=64, keep=10):
+        self.chain = chain
+        self.inputName = inputName
+        self.referenceName = referenceName
+        self.lengthSubTraces = lengthSubTraces
+        self.keep = keep
+        self.inputArray = FrameArray()
+        self.referenceArray = FrameArray()
+        self.counts = 0
+        self.traceDeviation = 0.
+        self.noiseDeviation = 0.
+
+    def __call__(self, frame):
+        traces = self.inputArray.timeSeries(frame[self.inputName])
+        reference = self.referenceArray.timeSeries(frame[self.referenceName])
+        filtered = self.chain.apply(traces, self.inputArray.binning)
+        scale = np.sqrt(np.mean(reference**2, axis=-1))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            deviation = np.max(np.abs(filtered - reference), axis=-1) / scale
+            noise = np.mean(cutTraces(filtered, self.lengthSubTraces, self.keep), axis=-1)
+            noiseReference = np.mean(cutTraces(reference, self.lengthSubTraces, self.keep), axis=-1)
+            noiseDeviation = np.abs(noise / noiseReference - 1)
+        self.traceDeviation = max(self.traceDeviation, np.nanmax(deviation))
+        self.noiseDeviation = max(self.noiseDeviation, np.nanmax(noiseDeviation))
+        self.counts += 1
+        return True
+
+    def passed(self, tolerance=VALIDATION_TOLERANCE):
+        return self.counts > 0 and self.noiseDeviation <= tolerance
+
+    def report(self, tolerance=VALIDATION_TOLERANCE):
+        print("Filter validation over {0} frames: largest trace deviation {1:.3g} (relative to the trace RMS), "
+              "largest subtraces noise deviation {2:.3g}, {3}".format(
+                  self.counts, self.traceDeviation, self.noiseDeviation,
+                  "passed" if self.passed(tolerance) else "failed (tolerance {0:g})".format(tolerance)))
+        return self.passed(tolerance)
+
+    # Adds the result to the validation file, replacing an older result for the same median window,
+    # Butterworth order and filter limits. The records are checked by isValidated before the NumPy engine is used.
+    def save(self, filename=VALIDATION_FILE, tolerance=VALIDATION_TOLERANCE):
+        record = {"medianWindow": self.chain.medianWindow, "butterworthOrder": self.chain.butterworthOrder,
+                  "filterLimits": [float(limit) for limit in self.chain.filterLimits], "frames": self.counts,
+                  "traceDeviation": float(self.traceDeviation), "noiseDeviation": float(self.noiseDeviation),
+                  "tolerance": tolerance, "passed": bool(self.passed(tolerance))}
+        records = [other for other in readValidations(filename) if validationKey(other) != validationKey(record)]
+        with open(filename, "w") as file:
+            json.dump({"validations": records + [record]}, file, indent=1)
+
+
+def validationKey(record):
+    return record.get("medianWindow"), record.get("butterworthOrder"), tuple(record.get("filterLimits", ()))
+
+
+# Validation records of a validation file, none if it does not exist
+def readValidations(filename=VALIDATION_FILE):
+    if not os.path.exists(filename):
+        return []
+    with open(filename) as file:
+        return json.load(file).get("validations", [])
+
+
+# True if the validation file records a passed comparison with the radcube modules for the same median
+# window, Butterworth order and filter limits (MHz)
+def isValidated(medianWindow, butterworthOrder, filterLimits, filename=VALIDATION_FILE):
+    key = (medianWindow, butterworthOrder, tuple(float(limit) for limit in filterLimits))
+    return any(bool(record.get("passed")) and record.get("frames", 0) > 0 and validationKey(record) == key
+               for record in readValidations(filename))
+
+
+# Error message of the command lines when the NumPy engine is requested without a passed validation for one
+# of the bands (list of (low, high) filter limits in MHz), else None
+def engineError(engine, medianWindow, butterworthOrder, bands, filename=VALIDATION_FILE):
+    if engine != "numpy":
+        return None
+    missing = [list(band) for band in bands if not isValidated(medianWindow, butterworthOrder, band, filename)]
+    if not missing:
+        return None
+    return ("--engine numpy has no passed validation in {0} for a median window of {1}, a Butterworth order of {2} "
+            "and the filter limits {3} MHz, run ./NPZ.py I3_FILE_NAMES --validateEngine --filterLimits LOW HIGH "
+            "on real data first for each of them".format(filename, medianWindow, butterworthOrder, missing))
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+"""
+Catalog of the DAQ frames of I3 files, stored next to each file as FILE.catalog.npz.
+
+For every DAQ frame the catalog keeps its frame number in the file (number of frames before it, not a byte
+offset), the RadioTaxiTime as int64 ns since the epoch and as the exact I3Time (UTC year and DAQ time in 0.1 ns),
+the soft trigger flag and the RadioTraceLength. Building it only deserializes these three small frame objects,
+never the waveforms. The catalog is not an index for random access: the I3Reader has no seek, so the files
+that are read are still read and decoded frame by frame. It only gives:
+  - the trigger and trace length selections as lookups (CatalogSelection replaces select_soft and
+    select_TraceLength in the trays),
+  - the list of the files without any selected frame, which are not read at all,
+  - the times of a period without opening the I3 files, in the same format as TimeValues.py.
+
+Run with command:
+./FrameCatalog.py build I3_FILE_NAMES --jobs 8
+./FrameCatalog.py times I3_FILE_NAMES --start 2023-04-05 --end 2023-04-16 --output time_values.txt
+"""
+
+import argparse
+import multiprocessing
+import os
+
+import numpy as np
+
+
+CATALOG_VERSION = 1
+
+# Time of the frames without RadioTaxiTime
+NO_TIME = np.iinfo(np.int64).min
+
+
+def catalogName(filename):
+    return filename + ".catalog.npz"
+
+
+# RadioTaxiTime of a frame in ns since the epoch, NO_TIME if the frame has none
+def frameTime(frame):
+    if "RadioTaxiTime" not in frame:
+        return NO_TIME
+    return np.datetime64(frame["RadioTaxiTime"].date_time, "ns").astype(np.int64)
+
+
+class FrameCatalog():
+
+    def __init__(self, frameNumber, time, soft, traceLength, year, daqTime):
+        self.frameNumber = np.asarray(frameNumber, dtype=np.int64)  # frames before it in the file
+        self.time = np.asarray(time, dtype=np.int64)  # ns since the epoch
+        self.soft = np.asarray(soft, dtype=bool)
+        self.traceLength = np.asarray(traceLength, dtype=np.int32)
+        self.year = np.asarray(year, dtype=np.int32)  # I3Time of the frames, 0 without time
+        self.daqTime = np.asarray(daqTime, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.frameNumber)
+
+    # Mask of the DAQ frames passing the selection of the analysis scripts: soft trigger (if soft), trace length
+    # equal to traceLength, different from 0 if traceLength is "nonzero", any if None, and start <= time < end
+    def select(self, soft=True, traceLength=1024, start=None, end=None):
+        mask = self.soft.copy() if soft else np.ones(len(self), dtype=bool)
+        if traceLength == "nonzero":
+            mask &= self.traceLength != 0
+        elif traceLength is not None:
+            mask &= self.traceLength == traceLength
+        if start is not None:
+            mask &= self.time >= np.datetime64(start, "ns").astype(np.int64)
+        if end is not None:
+            mask &= self.time < np.datetime64(end, "ns").astype(np.int64)
+        return mask
+
+    @property
+    def hasTime(self):
+        return self.time != NO_TIME
+
+    def save(self, output, fileSize):
+        tmpName = output + ".tmp.npz"
+        np.savez(tmpName, catalog_version=np.int64(CATALOG_VERSION), file_size=np.int64(fileSize),
+                 frameNumber=self.frameNumber, time=self.time, soft=self.soft, traceLength=self.traceLength,
+                 year=self.year, daqTime=self.daqTime)
+        os.replace(tmpName, output)
+
+
+# Reads the DAQ frames of an I3 file and writes its catalog. Only the time, trigger and trace length
+# objects of the frames are deserialized.
+def buildCatalog(filename):
+    from icecube import dataio, icetray
+
+    frameNumber, time, soft, traceLength, year, daqTime = [], [], [], [], [], []
+    file = dataio.I3File(filename)
+    count = 0
+    while file.more():
+        frame = file.pop_frame()
+        if frame.Stop == icetray.I3Frame.DAQ:
+            frameNumber.append(count)
+            time.append(frameTime(frame))
+            taxiTime = frame["RadioTaxiTime"] if "RadioTaxiTime" in frame else None
+            year.append(0 if taxiTime is None else taxiTime.utc_year)
+            daqTime.append(0 if taxiTime is None else taxiTime.utc_daq_time)
+            soft.append("SurfaceFilters" in frame and frame["SurfaceFilters"]["soft_flag"].condition_passed)
+            traceLength.append(frame["RadioTraceLength"].value if "RadioTraceLength" in frame else 0)
+        count += 1
+    file.close()
+    catalog = FrameCatalog(frameNumber, time, soft, traceLength, year, daqTime)
+    catalog.save(catalogName(filename), os.path.getsize(filename))
+    return catalog
+
+
+# Catalog of an I3 file, or None if it has no catalog or the file changed since the catalog was written
+def loadCatalog(filename):
+    name = catalogName(filename)
+    if not os.path.exists(name) or os.path.getmtime(name) < os.path.getmtime(filename):
+        return None
+    with np.load(name) as data:
+        if int(data["catalog_version"]) != CATALOG_VERSION or int(data["file_size"]) != os.path.getsize(filename):
+            return None
+        return FrameCatalog(data["frameNumber"], data["time"], data["soft"], data["traceLength"], data["year"], data["daqTime"])
+
+
+# Catalog of an I3 file, built if it is missing or out of date
+def getCatalog(filename):
+    catalog = loadCatalog(filename)
+    return buildCatalog(filename) if catalog is None else catalog
+
+
+# Replaces select_soft and select_TraceLength in a tray reading filenames in order: the DAQ frames are counted
+# and the precomputed selection of the catalogs is returned. The frame time is checked against the catalog,
+# so a file that does not match its catalog stops the tray instead of selecting the wrong frames.
+# The frames are not skipped by the reader, every frame of the files that are read is still decoded.
+class CatalogSelection():
+
+    def __init__(self, catalogs, soft=True, traceLength=1024):
+        self.time = np.concatenate([catalog.time for catalog in catalogs])
+        self.selected = np.concatenate([catalog.select(soft, traceLength) for catalog in catalogs])
+        self.count = 0
+
+    def __call__(self, frame):
+        i = self.count
+        self.count += 1
+        if i >= len(self.time) or frameTime(frame) != self.time[i]:
+            raise RuntimeError("DAQ frame {0} does not match the frame catalog, rebuild it with FrameCatalog.py".format(i))
+        return bool(self.selected[i])
+
+
+# Files that have at least one selected frame, and the CatalogSelection for them. Returns (filenames, None)
+# if one of the files has no up-to-date catalog, so the trays fall back to the frame selection modules.
+def catalogSelection(filenames, soft=True, traceLength=1024):
+    catalogs = [loadCatalog(filename) for filename in filenames]
+    if any(catalog is None for catalog in catalogs):
+        return filenames, None
+    keep = [i for i, catalog in enumerate(catalogs) if np.any(catalog.select(soft, traceLength))]
+    if not keep:
+        # The reader needs at least one file
+        keep = [0]
+    return [filenames[i] for i in keep], CatalogSelection([catalogs[i] for i in keep], soft, traceLength)
+
+
+# Catalogs of the files and the masks of their selected frames with start <= time < end. The frames without
+# RadioTaxiTime are dropped, as TimeValues.py skips them.
+def selectedFrames(filenames, soft=True, traceLength=None, start=None, end=None):
+    for filename in filenames:
+        catalog = getCatalog(filename)
+        yield catalog, catalog.select(soft, traceLength, start, end) & catalog.hasTime
+
+
+# Times (datetime64[ns]) of the selected frames of the files with start <= time < end, from their catalogs
+def selectedTimes(filenames, soft=True, traceLength=None, start=None, end=None):
+    times = [catalog.time[mask] for catalog, mask in selectedFrames(filenames, soft, traceLength, start, end)]
+    return np.concatenate(times).astype("datetime64[ns]") if times else np.empty(0, dtype="datetime64[ns]")
+
+
+# Writes the RadioTaxiTime of the selected frames as the str of their I3Time, one per line, as TimeValues.py
+def writeTimes(filenames, output="time_values.txt", soft=True, traceLength=None, start=None, end=None):
+    from icecube import dataclasses
+
+    values = []
+    for catalog, mask in selectedFrames(filenames, soft, traceLength, start, end):
+        values += [str(dataclasses.I3Time(int(year), int(daqTime))) for year, daqTime in zip(catalog.year[mask], catalog.daqTime[mask])]
+    with open(output, "w") as file:
+        file.write("\n".join(values))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build = subparsers.add_parser("build", help="Write the catalog of the i3 files that have none or an outdated one")
+    build.add_argument("input", type=str, nargs="+", help="List of i3 files")
+    build.add_argument("--jobs", type=int, default=1, help="Number of worker processes")
+    build.add_argument("--force", action="store_true", help="Also rebuild the catalogs that are up to date")
+    times = subparsers.add_parser("times", help="Write the times of the soft trigger frames, from the catalogs")
+    times.add_argument("input", type=str, nargs="+", help="List of i3 files")
+    times.add_argument("--start", type=str, default=None, help="First time (e.g. 2023-04-05)")
+    times.add_argument("--end", type=str, default=None, help="End of the period, excluded")
+    times.add_argument("--traceLength", type=int, default=None, help="Only keep the frames with this trace length")
+    times.add_argument("--output", type=str, default="time_values.txt", help="Name of the output text file")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        todo = [filename for filename in args.input if args.force or loadCatalog(filename) is None]
+        print("{0} catalogs to build, {1} up to date".format(len(todo), len(args.input) - len(todo)))
+        if args.jobs > 1 and len(todo) > 1:
+            with multiprocessing.Pool(min(args.jobs, len(todo))) as pool:
+                list(pool.imap_unordered(buildCatalog, todo))
+        else:
+            for filename in todo:
+                buildCatalog(filename)
+    else:
+        writeTimes(args.input, args.output, True, args.traceLength, args.start, args.end)
@@ -13,107 +13,131 @@ import matplotlib.pyplot as plt
 import numpy as np
 import sys
 import argparse
+import shutil
+import tempfile
 
-#Input i3 file with the data 
-parser = argparse.ArgumentParser()
-parser.add_argument("input", type=str, nargs="+", default=[], help="List of i3 files")
-args = parser.parse_args()
+from FilterChain import VALIDATION_FILE, FilterChain, engineError
+from FrameCatalog import catalogSelection
+from NoiseHistogram import NoiseHistogram, QuantileSketch, mergeHistograms, plotHistograms, saveHistograms
+from NoiseTools import FrameArray, cutTraces, printCacheStatistics, traceRms
+from ResultCache import ResultCache, runFiles
 
-filename = args.input
+# Default processing configuration, part of the key of the result cache
+CONFIG = {
+    "analysis": "NoiseCalculation",
+    "trigger": "soft_flag",
+    "traceLength": "nonzero",
+    "engine": "radcube",  # Filter chain: radcube modules or FilterChain
+    "medianWindow": 20,
+    "butterworthOrder": 13,
+    "filterLimits": [140, 190],  # MHz
+    "lengthSubTraces": 64,
+    "keepSubTraces": 10,
+    "histogramRange": [0., 200.],  # ADC
+    "histogramBins": 4000,
+    "sketchAccuracy": None,  # Relative accuracy of the quantile sketch, no sketch if None
+    "nbAntennas": 3,  # Shape of the histograms when no frame passes the selection
+    "nbChannels": 2,
+}
 
+
+# Accumulates the noise levels (standard RMS window and median of the subtraces) of every antenna and channel
+# in streaming histograms. The values of blockSize frames are buffered and added together, so the memory
+# does not depend on the number of frames.
 class NoiseCalculation(icetray.I3Module):
     def __init__(self, ctx):
         icetray.I3Module.__init__(self, ctx)
         self.AddParameter('InputName', 'InputName', 'InputName')
+        self.AddParameter('Output', 'Stores the histograms in this .npz file instead of plotting them', None)
+        self.AddParameter("LengthSubTraces", "Length of the subtraces", 64)
+        self.AddParameter("KeepSubTraces", "Number of lowest subtraces that are kept", 10)
+        self.AddParameter("FilterChain", "FilterChain applied to the input traces (None if they are already filtered)", None)
+        self.AddParameter("HistogramRange", "Range of the histograms in ADC", [0., 200.])
+        self.AddParameter("HistogramBins", "Number of bins of the histograms", 4000)
+        self.AddParameter("SketchAccuracy", "Relative accuracy of the quantile sketch (no sketch if None)", None)
+        self.AddParameter("BlockSize", "Number of frames added to the histograms at once", 1024)
+        self.AddParameter("NbAntennas", "Number of antennas of the histograms if no frame passes the selection", CONFIG["nbAntennas"])
+        self.AddParameter("NbChannels", "Number of channels of the histograms if no frame passes the selection", CONFIG["nbChannels"])
 
     def Configure(self):
         self.inputName = self.GetParameter('InputName')
+        self.output = self.GetParameter('Output')
+        self.lengthSubTraces = self.GetParameter("LengthSubTraces")
+        self.keepSubTraces = self.GetParameter("KeepSubTraces")
+        self.filterChain = self.GetParameter("FilterChain")
+        self.histogramRange = self.GetParameter("HistogramRange")
+        self.histogramBins = self.GetParameter("HistogramBins")
+        self.sketchAccuracy = self.GetParameter("SketchAccuracy")
+        self.blockSize = self.GetParameter("BlockSize")
+        self.nbAntennas = self.GetParameter("NbAntennas")
+        self.nbChannels = self.GetParameter("NbChannels")
         self.counts = 0
-        self.colors = ["c", "b", "m", "r", "y", "g"]
-        
-        self.noise_rms_step = []
-        self.noise_rms_window = []
+
+        # Created with the first frame, once the number of antennas and channels is known
+        self.histogram = None
+        self.sketch = None
+        self.block = None
+        self.nbBuffered = 0
+        self.frameArray = FrameArray()
+
+    def flush(self):
+        if self.nbBuffered > 0:
+            self.histogram.add(self.block[:self.nbBuffered])
+            if self.sketch is not None:
+                self.sketch.add(self.block[:self.nbBuffered])
+        self.nbBuffered = 0
 
     def GetNoise(self, frame):
         self.counts += 1
-        antennaDataMap = frame[self.inputName]
-        for iant, antkey in enumerate(antennaDataMap.keys()):
-            channelMap = antennaDataMap[antkey]
-            for ichan, chkey in enumerate(channelMap.keys()):
-                fft = channelMap[ichan].GetFFTData()
-                timeSeries = fft.GetTimeSeries()
-                # Noise RMS 
-                self.noise_rms_window.append(radcube.GetRMS(timeSeries))
-                
-                #Subtraces Method
-                noise_rms_step, noise_power_step = [], []
-                steps = np.arange(0, len(timeSeries), 64)
-                numberOfSubTraces = len(timeSeries)//64
-                for i in range(numberOfSubTraces - 1):
-                    noise_chopped = timeSeries.GetSubset(
-                        int(steps[i]), int(steps[i + 1])
-                    )
-                    noise_rms_step.append(
-                        radcube.GetRMS(noise_chopped)
-                        )
-                # We keep only 10 minimum value and average them.
-                # The rational is that RFI screw up the noise, but we can hardly have lower noise
-                noise_rms_step.sort()
-                self.noise_rms_step.append(
-                    np.median(noise_rms_step[:10]))
-                    
+        # All antennas and channels of the frame at once, shape (antennas, channels, samples)
+        traces = self.frameArray.timeSeries(frame[self.inputName])
+        if self.filterChain is not None:
+            traces = self.filterChain.apply(traces, self.frameArray.binning)
+        if self.histogram is None:
+            shape = (2,) + traces.shape[:-1]
+            self.histogram = NoiseHistogram(shape, self.histogramRange, self.histogramBins)
+            if self.sketchAccuracy is not None:
+                self.sketch = QuantileSketch(shape, self.sketchAccuracy)
+            self.block = np.empty((self.blockSize,) + shape)
+
+        # Noise RMS
+        self.block[self.nbBuffered, 0] = traceRms(traces)
+
+        #Subtraces Method
+        # We keep only 10 minimum value and average them.
+        # The rational is that RFI screw up the noise, but we can hardly have lower noise
+        noise_rms_step = cutTraces(traces, lengthSubTraces=self.lengthSubTraces, keep=self.keepSubTraces)
+        self.block[self.nbBuffered, 1] = np.median(noise_rms_step, axis=-1)
+        self.nbBuffered += 1
+        if self.nbBuffered == self.blockSize:
+            self.flush()
 
     def Physics(self, frame):
             self.GetNoise(frame)
            
 
     def Finish(self):
-        noise_step = np.asarray(self.noise_rms_step).reshape(self.counts, 3, 2)
-        noise_std = np.asarray(self.noise_rms_window).reshape(self.counts, 3, 2)
-        # Plotting the Histograms of the noise level
-        fig, ax = plt.subplots(
-                figsize=[10, 8], nrows=1, ncols=1, tight_layout=True
-                )
-        for iant in range(3):
-            for ich in range(2):
-                #Rms
-                ax.hist(
-                    noise_std[:, iant, ich], histtype="stepfilled", alpha=0.45,
-                    color=self.colors[2*iant + ich], bins="fd",
-                    label=f"Antenna {iant+1}, Channel {ich+1}",
-                    density=True
-                    )
-                #subtraces
-                ax.hist(
-                    noise_step[:, iant, ich], histtype="step", alpha=1,
-                    color=self.colors[2*iant + ich], bins="fd",
-                    label=f"Antenna {iant+1}, Channel {ich+1}, Subtraces",
-                    density=True
-                    )
-        ax.set_xlabel("Amplitude / ADC")
-        ax.set_ylabel("Normilized Counts")
-        ax.legend(ncol=2)
-        
-        # Save the plot to a file 
-        plt.title("Distributions of the noise level in the traces for each antenna channel")
-        plot_filename = "noise_histogram.png"
-        fig.savefig(plot_filename)
+        if self.histogram is None:
+            # No frame passed the selection
+            shape = (2, self.nbAntennas, self.nbChannels)
+            self.histogram = NoiseHistogram(shape, self.histogramRange, self.histogramBins)
+            if self.sketchAccuracy is not None:
+                self.sketch = QuantileSketch(shape, self.sketchAccuracy)
+        self.flush()
+        if self.output is not None:
+            saveHistograms(self.output, self.histogram, self.sketch)
+        else:
+            plotHistograms(self.histogram)
+        if self.filterChain is not None:
+            # The filter response is computed once per trace geometry
+            printCacheStatistics()
         
 
-tray = I3Tray()
-
-tray.AddModule("I3Reader", "reader",
-         FilenameList = filename)
-
 #Choosing soft trigger only 
 def select_soft(frame):
     trigger_info = frame['SurfaceFilters']
     return trigger_info["soft_flag"].condition_passed
 
-# add the module to the tray
-tray.Add(select_soft, "select_soft",
-         streams=[icetray.I3Frame.DAQ])
-
 def select_TraceLength(frame):
     TraceLength = frame['RadioTraceLength'].value
 
@@ -121,86 +145,171 @@ def select_TraceLength(frame):
         return True  # This will indicate that the frame should be saved to the selected stream
     else:
         return False  
-    
- #add the module to the tray
-tray.Add(select_TraceLength, "select_TraceLength",
-         streams=[icetray.I3Frame.DAQ])
-
-#Removing TAXI artifacts 
-tray.Add(
-    radcube.modules.RemoveTAXIArtifacts, "ArtifactRemover",
-    InputName="RadioTAXIWaveform",
-    OutputName="ArtifactsRemoved",
-    medianOverCascades=True,
-    RemoveBinSpikes=True,
-    BinSpikeDeviance=int(2**12),
-    RemoveNegativeBins=True
-    )
-
-"""def select_RMS(frame):
-    RMS = dataclasses.I3Double()
-    waveform = frame["ArtifactsRemoved"]
-    key = waveform.keys()[0]
-    wave_ant1 = waveform[key]
-    wave_ant1_ch0 = wave_ant1[0]
-    fft = wave_ant1_ch0.GetFFTData()
-    ts = fft.GetTimeSeries()
-    RMS = radcube.GetRMS(ts)
-    frame.Put("RMS", dataclasses.I3Double(RMS))
-    if RMS < 9000:
-        return True  # This will indicate that the frame should be saved to the selected stream
+
+
+# Runs the whole processing chain over the i3 files. The noise values are stored in output
+# if it is given, otherwise the histograms are plotted.
+def runTray(filename, output=None, config=CONFIG):
+    tray = I3Tray()
+
+    # With up-to-date frame catalogs (FrameCatalog.py) the selection is read from them
+    # and the files without selected frames are not read
+    filename, selection = catalogSelection(filename, traceLength="nonzero")
+
+    tray.AddModule("I3Reader", "reader",
+             FilenameList = filename)
+
+    if selection is not None:
+        tray.Add(selection, "select_catalog",
+                 streams=[icetray.I3Frame.DAQ])
     else:
-        return False
-    
-tray.Add(select_RMS, "select_RMS",
-         streams=[icetray.I3Frame.DAQ])"""
-
-tray.AddModule("I3NullSplitter","splitter",
-               SubEventStreamName="RadioEvent"
-               )
-
-tray.AddModule("MedianFrequencyFilter", "MedianFilter",
-            InputName="ArtifactsRemoved",
-            FilterWindowWidth=20,
-            OutputName="MedFilteredMap")
-
-# let's apply a bandpass filter to our signals
-tray.AddModule("BandpassFilter", "filter",
-               InputName="MedFilteredMap",
-               OutputName="FilteredMap",
-               ApplyInDAQ=False,
-               FilterType=radcube.eButterworth,
-               ButterworthOrder=13,
-               #FilterType=radcube.eBox,
-               FilterLimits=[140*I3Units.megahertz, 190*I3Units.megahertz] # note the use of I3Units!
-               )
-
-"""# let's plot the waveforms from one antenna in different stages of processing with an existing plotting module
-tray.AddModule(radcube.modules.RadcubePlotter, "plotter",
-               AntennaID = 1,
-               StationID = 1,
-               OutputDir = "/home/storres/work/GalacticNoiseAnalysis/",
-               ZoomToPulse = 0,
-               DataToPlot = [["RadioTAXIWaveform", 1, "Recorded waveforms", True, "dB"],
-                             ["ArtifactsRemoved", 1, "Artifacts removed", True, "dB"],
-                             ["MedFilteredMap", 1, "Median Foltered", True, "dB"],
-                             ["FilteredMap", 1, "After Bandpass Filter", True, "dB"],
-                            ]
-               )
-"""
-
-#Calculating RMS values and their histogram 
-tray.AddModule(
-        NoiseCalculation, "TheNoiseCalculator",
-        InputName="FilteredMap"
-        )
+        # add the module to the tray
+        tray.Add(select_soft, "select_soft",
+                 streams=[icetray.I3Frame.DAQ])
 
-"""# save the I3 files with all new objects to a new file, so we can use it for later processing or plotting
-tray.AddModule("I3Writer", "writer",
-                filename="/home/storres/work/GalacticNoiseAnalysis/newfile.i3",
-                streams=[icetray.I3Frame.DAQ, icetray.I3Frame.Physics] # we'll only save Q and P frames
-              )"""
+        #add the module to the tray
+        tray.Add(select_TraceLength, "select_TraceLength",
+                 streams=[icetray.I3Frame.DAQ])
 
-tray.Execute()
+    #Removing TAXI artifacts 
+    tray.Add(
+        radcube.modules.RemoveTAXIArtifacts, "ArtifactRemover",
+        InputName="RadioTAXIWaveform",
+        OutputName="ArtifactsRemoved",
+        medianOverCascades=True,
+        RemoveBinSpikes=True,
+        BinSpikeDeviance=int(2**12),
+        RemoveNegativeBins=True
+        )
+
+    """def select_RMS(frame):
+        RMS = dataclasses.I3Double()
+        waveform = frame["ArtifactsRemoved"]
+        key = waveform.keys()[0]
+        wave_ant1 = waveform[key]
+        wave_ant1_ch0 = wave_ant1[0]
+        fft = wave_ant1_ch0.GetFFTData()
+        ts = fft.GetTimeSeries()
+        RMS = radcube.GetRMS(ts)
+        frame.Put("RMS", dataclasses.I3Double(RMS))
+        if RMS < 9000:
+            return True  # This will indicate that the frame should be saved to the selected stream
+        else:
+            return False
         
-   
\ No newline at end of file
+    tray.Add(select_RMS, "select_RMS",
+             streams=[icetray.I3Frame.DAQ])"""
+
+    tray.AddModule("I3NullSplitter","splitter",
+                   SubEventStreamName="RadioEvent"
+                   )
+
+    # The NumPy engine filters the artifact-free traces inside NoiseCalculation
+    chain = None
+    if config.get("engine", "radcube") == "numpy":
+        chain = FilterChain(config["medianWindow"], config["butterworthOrder"], config["filterLimits"])
+    else:
+        tray.AddModule("MedianFrequencyFilter", "MedianFilter",
+                    InputName="ArtifactsRemoved",
+                    FilterWindowWidth=config["medianWindow"],
+                    OutputName="MedFilteredMap")
+
+        # let's apply a bandpass filter to our signals
+        tray.AddModule("BandpassFilter", "filter",
+                       InputName="MedFilteredMap",
+                       OutputName="FilteredMap",
+                       ApplyInDAQ=False,
+                       FilterType=radcube.eButterworth,
+                       ButterworthOrder=config["butterworthOrder"],
+                       #FilterType=radcube.eBox,
+                       FilterLimits=[limit*I3Units.megahertz for limit in config["filterLimits"]] # note the use of I3Units!
+                       )
+
+    """# let's plot the waveforms from one antenna in different stages of processing with an existing plotting module
+    tray.AddModule(radcube.modules.RadcubePlotter, "plotter",
+                   AntennaID = 1,
+                   StationID = 1,
+                   OutputDir = "/home/storres/work/GalacticNoiseAnalysis/",
+                   ZoomToPulse = 0,
+                   DataToPlot = [["RadioTAXIWaveform", 1, "Recorded waveforms", True, "dB"],
+                                 ["ArtifactsRemoved", 1, "Artifacts removed", True, "dB"],
+                                 ["MedFilteredMap", 1, "Median Foltered", True, "dB"],
+                                 ["FilteredMap", 1, "After Bandpass Filter", True, "dB"],
+                                ]
+                   )
+    """
+
+    #Calculating RMS values and their histogram 
+    tray.AddModule(
+            NoiseCalculation, "TheNoiseCalculator",
+            InputName="FilteredMap" if chain is None else "ArtifactsRemoved",
+            FilterChain=chain,
+            Output=output,
+            LengthSubTraces=config["lengthSubTraces"],
+            KeepSubTraces=config["keepSubTraces"],
+            HistogramRange=config["histogramRange"],
+            HistogramBins=config["histogramBins"],
+            SketchAccuracy=config["sketchAccuracy"],
+            NbAntennas=config["nbAntennas"],
+            NbChannels=config["nbChannels"]
+            )
+
+    """# save the I3 files with all new objects to a new file, so we can use it for later processing or plotting
+    tray.AddModule("I3Writer", "writer",
+                    filename="/home/storres/work/GalacticNoiseAnalysis/newfile.i3",
+                    streams=[icetray.I3Frame.DAQ, icetray.I3Frame.Physics] # we'll only save Q and P frames
+                  )"""
+
+    tray.Execute()
+
+
+# Worker of the parallel and cached modes: runs the tray over one shard of files and returns its partial result
+def runShard(shard):
+    filename, output, config = shard
+    runTray(filename, output, config)
+    return output
+
+
+if __name__ == "__main__":
+    #Input i3 file with the data 
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input", type=str, nargs="+", default=[], help="List of i3 files")
+    parser.add_argument("--jobs", type=int, default=1, help="Number of worker processes (1 runs a single tray)")
+    parser.add_argument("--cacheDir", type=str, default=None, help="Directory of the per-file result cache (no cache if not given)")
+    parser.add_argument("--cacheSize", type=float, default=20, help="Maximum size of the cache in GB")
+    parser.add_argument("--engine", type=str, choices=["radcube", "numpy"], default=CONFIG["engine"], help="Filter chain: radcube modules or NumPy (FilterChain.py)")
+    parser.add_argument("--validationFile", type=str, default=VALIDATION_FILE, help="Result of NPZ.py --validateEngine, needed by --engine numpy")
+    parser.add_argument("--output", type=str, default=None, help="Store the histograms in this .npz file instead of plotting them")
+    parser.add_argument("--histogramRange", type=float, nargs=2, default=CONFIG["histogramRange"], help="Range of the histograms in ADC")
+    parser.add_argument("--histogramBins", type=int, default=CONFIG["histogramBins"], help="Number of bins of the histograms")
+    parser.add_argument("--sketchAccuracy", type=float, default=CONFIG["sketchAccuracy"], help="Also keep a quantile sketch with this relative accuracy (e.g. 0.01)")
+    args = parser.parse_args()
+
+    error = engineError(args.engine, CONFIG["medianWindow"], CONFIG["butterworthOrder"], [CONFIG["filterLimits"]], args.validationFile)
+    if error is not None:
+        parser.error(error)
+
+    filename = args.input
+    config = dict(CONFIG,
+                  engine=args.engine,
+                  histogramRange=args.histogramRange,
+                  histogramBins=args.histogramBins,
+                  sketchAccuracy=args.sketchAccuracy)
+
+    if args.jobs == 1 and args.cacheDir is None:
+        runTray(filename, args.output, config)
+    else:
+        cache = None if args.cacheDir is None else ResultCache(args.cacheDir, args.cacheSize * 1024**3)
+        tmpdir = tempfile.mkdtemp(prefix="NoiseHistograms_")
+        try:
+            partials = runFiles(filename, config, runShard, tmpdir, cache, args.jobs)
+            # The histograms of the workers are merged by adding their counts
+            histogram, sketch = mergeHistograms(partials)
+            if args.output is not None:
+                saveHistograms(args.output, histogram, sketch)
+            else:
+                plotHistograms(histogram)
+        finally:
+            shutil.rmtree(tmpdir)
+            if cache is not None:
+                cache.evict()
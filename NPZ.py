@@ -13,25 +13,34 @@ import matplotlib.pyplot as plt
 import numpy as np
 import sys
 import argparse
+import shutil
+import tempfile
 
-#Input i3 file with the data 
-parser = argparse.ArgumentParser()
-parser.add_argument("input", type=str, nargs="+", default=[], help="List of i3 files")
-args = parser.parse_args()
+from FilterChain import VALIDATION_FILE, FilterChain, FilterValidation, engineError
+from FrameCatalog import catalogSelection
+from NoiseTools import FrameArray, cutTraces, printCacheStatistics
+from ResultCache import ResultCache, runFiles
+from RmsStore import RmsDataset, RmsWriter, loadRms, mergeRms
+from TraceStore import TraceWriter
 
-filename = args.input
+# Selected trigger and trace length
+TRIGGER = "soft_flag"
+TRACE_LENGTH = 1024
 
-
-#Subtraces method
-def cutTraces(radTrace, lengthSubTraces=64, mode="rms"):
-    steps = np.arange(0, len(radTrace), lengthSubTraces)
-    nbSubTraces = len(radTrace) / lengthSubTraces
-    temp = []
-    for i in range(int(nbSubTraces)-1):
-        chopped = radTrace.GetSubset(int(steps[i]), int(steps[i + 1]))
-        temp.append(radcube.GetRMS(chopped))
-        temp.sort()
-    return temp
+# Default processing configuration. Every value that changes the output is in here,
+# since the whole dictionary is part of the key of the result cache.
+CONFIG = {
+    "analysis": "GalacticBackground",
+    "trigger": TRIGGER,
+    "traceLength": TRACE_LENGTH,
+    "engine": "radcube",  # Filter chain: radcube modules or FilterChain
+    "medianWindow": 20,
+    "butterworthOrder": 13,
+    "filterLimits": [140, 190],  # MHz
+    "bands": None,  # List of [low, high] MHz bands computed in one pass instead of filterLimits
+    "lengthSubTraces": 64,
+    "keepSubTraces": 10,
+}
 
 #This class uses the subtraces method to obtain the RMS values in each antenna and channel, and stores them in a .npz file
 class GalacticBackground(icetray.I3Module):
@@ -40,34 +49,58 @@ class GalacticBackground(icetray.I3Module):
         self.AddParameter('InputName', 'InputName', "InputName")
         self.AddParameter('Output', 'Output', "Output")
         self.AddParameter("ApplyInDAQ", "ApplyInDAQ", False)
+        self.AddParameter("LengthSubTraces", "Length of the subtraces", 64)
+        self.AddParameter("KeepSubTraces", "Number of lowest subtraces that are averaged", 10)
+        self.AddParameter("ChunkSize", "Number of frames kept in memory before they are flushed to disk", 65536)
+        self.AddParameter("FilterChain", "FilterChain applied to the input traces (None if they are already filtered)", None)
+        self.AddParameter("Bands", "List of (low, high) bands in MHz filtered by the FilterChain, None for filterLimits", None)
+        self.AddParameter("TraceStore", "Directory where the filtered traces are also stored (TraceStore.py), None to not store them", None)
     
     def Configure(self):
         self.inputName = self.GetParameter('InputName')
         self.output = self.GetParameter('Output')
         self.applyinDAQ = self.GetParameter("ApplyInDAQ")
+        self.lengthSubTraces = self.GetParameter("LengthSubTraces")
+        self.keepSubTraces = self.GetParameter("KeepSubTraces")
+        self.chunkSize = self.GetParameter("ChunkSize")
+        self.filterChain = self.GetParameter("FilterChain")
+        self.bands = self.GetParameter("Bands")
+        if self.bands is not None and self.filterChain is None:
+            log_fatal("The Bands of GalacticBackground are filtered by its FilterChain, which is not set")
+        self.traceStore = self.GetParameter("TraceStore")
+        if self.traceStore is not None and self.bands is not None:
+            log_fatal("The TraceStore of GalacticBackground holds the traces of a single band")
+        self.traceWriter = None
 
-        self.timeOutput = []
-        self.baselineRms = []
+        # Times and RMS values are streamed to disk in fixed-size chunks
+        self.writer = None
+        self.frameArray = FrameArray()
         
         print("... I am starting")
 
     def RunForOneFrame(self, frame):
         time = frame["RadioTaxiTime"]
-        time_new = np.datetime64(time.date_time).astype(datetime)
-        self.timeOutput.append(time_new)
-
-        antennaDataMap = frame[self.inputName]
-        rmsTraces = []
-        for iant, antkey in enumerate(antennaDataMap.keys()):
-            channelMap = antennaDataMap[antkey]
-            antenna_polarization_data = []
-            for ichan, chkey in enumerate(channelMap.keys()):
-                fft = channelMap[ichan].GetFFTData()
-                timeSeries = fft.GetTimeSeries()
-                noises = cutTraces(timeSeries, lengthSubTraces=64)
-                rms_value = np.mean(noises[:10]) 
-                self.baselineRms.append(rms_value)
-                
+        time_new = np.datetime64(time.date_time, "ns").astype(np.int64)
+
+        # All antennas and channels of the frame at once, shape (antennas, channels, samples)
+        traces = self.frameArray.timeSeries(frame[self.inputName])
+        if self.writer is None:
+            self.writer = RmsWriter(self.output, chunkSize=self.chunkSize, bands=self.bands,
+                                    antennas=self.frameArray.antennas, channels=self.frameArray.channels)
+        if self.bands is not None:
+            # Shape (antennas, channels, bands, samples), one spectrum per trace for all the bands
+            traces = self.filterChain.applyBands(traces, self.frameArray.binning, self.bands)
+        elif self.filterChain is not None:
+            traces = self.filterChain.apply(traces, self.frameArray.binning)
+        if self.traceStore is not None:
+            if self.traceWriter is None:
+                self.traceWriter = TraceWriter(self.traceStore, nbSamples=traces.shape[-1], binning=self.frameArray.binning,
+                                               antennas=self.frameArray.antennas, channels=self.frameArray.channels)
+            self.traceWriter.append(time_new, traces)
+        noises = np.mean(cutTraces(traces, lengthSubTraces=self.lengthSubTraces, keep=self.keepSubTraces), axis=-1)
+        if self.bands is not None:
+            noises = np.moveaxis(noises, -1, 0)
+        self.writer.append(time_new, noises)
  
     def DAQ(self, frame):
         if self.applyinDAQ:
@@ -78,85 +111,187 @@ class GalacticBackground(icetray.I3Module):
             self.RunForOneFrame(frame)
             
     def Finish(self):
-        timeOutput = np.asarray(self.timeOutput)
-        baselineRms = np.asarray(self.baselineRms)
-        # Reshape baselineRms to have dimensions (self.counts, 3, 2)
-        baselineRms_reshaped = baselineRms.reshape(-1, 3, 2)
+        if self.writer is None:
+            # No frame passed the selection, the output is still written
+            self.writer = RmsWriter(self.output, chunkSize=self.chunkSize, bands=self.bands)
         # Save the data
-        np.savez(self.output,
-                 time=timeOutput,
-                 # Extract data for each antenna and polarization
-                 rms10 = baselineRms_reshaped[:, 0, 0],
-                 rms11 = baselineRms_reshaped[:, 0, 1],
-                 rms20 = baselineRms_reshaped[:, 1, 0],
-                 rms21 = baselineRms_reshaped[:, 1, 1],
-                 rms30 = baselineRms_reshaped[:, 2, 0],
-                 rms31 = baselineRms_reshaped[:, 2, 1]
-                 )
-
-tray = I3Tray()
-
-tray.AddModule("I3Reader", "reader",
-         FilenameList = filename) 
+        self.writer.close()
+        if self.traceStore is not None:
+            if self.traceWriter is None:
+                self.traceWriter = TraceWriter(self.traceStore)
+            self.traceWriter.close()
+        if self.filterChain is not None:
+            # The filter response is computed once per trace geometry
+            printCacheStatistics()
 
 #Choosing soft trigger only 
 def select_soft(frame):
     trigger_info = frame['SurfaceFilters']
-    return trigger_info["soft_flag"].condition_passed
-
-# add the module to the tray
-tray.Add(select_soft, "select_soft",
-         streams=[icetray.I3Frame.DAQ])
+    return trigger_info[TRIGGER].condition_passed
 
 #Select data with trace length different than 0
 def select_TraceLength(frame):
     TraceLength = frame['RadioTraceLength'].value
 
-    if TraceLength == 1024:
+    if TraceLength == TRACE_LENGTH:
         return True  # This will indicate that the frame should be saved to the selected stream
     else:
         return False  
-    
-#add the module to the tray
-tray.Add(select_TraceLength, "select_TraceLength",
-         streams=[icetray.I3Frame.DAQ])
-
-
-#Removing TAXI artifacts 
-tray.Add(
-    radcube.modules.RemoveTAXIArtifacts, "ArtifactRemover",
-    InputName="RadioTAXIWaveform",
-    OutputName="ArtifactsRemoved",
-    medianOverCascades=True,
-    RemoveBinSpikes=True,
-    BinSpikeDeviance=int(2**12),
-    RemoveNegativeBins=True
-    )
-
-tray.AddModule("I3NullSplitter","splitter",
-               SubEventStreamName="RadioEvent"
-               )
-
-tray.AddModule("MedianFrequencyFilter", "MedianFilter",
-            InputName="ArtifactsRemoved",
-            FilterWindowWidth=20,
-            OutputName="MedFilteredMap")
-
-# let's apply a bandpass filter to our signals
-tray.AddModule("BandpassFilter", "filter",
-               InputName="MedFilteredMap",
-               OutputName="FilteredMap",
-               ApplyInDAQ=False,
-               FilterType=radcube.eButterworth,
-               ButterworthOrder=13,
-               #FilterType=radcube.eBox,
-               FilterLimits=[140*I3Units.megahertz, 190*I3Units.megahertz] 
-               )
-
-tray.AddModule(GalacticBackground, "TheGalaxyObserverDeconvolved",
-               InputName="FilteredMap",
-               Output="GalOscillation_Deconvolved_140-190_New.npz"
-               )
-
-tray.Execute()
 
+
+# Runs the whole processing chain over the i3 files and stores the RMS values in output.
+# With validate, the NumPy filter chain is also compared with the radcube modules and the result is written
+# in the validation file. With traceStore, the filtered traces are also stored in this directory.
+def runTray(filename, output, config=CONFIG, validate=False, traceStore=None, validationFile=VALIDATION_FILE):
+    tray = I3Tray()
+
+    # With up-to-date frame catalogs (FrameCatalog.py) the selection is read from them
+    # and the files without selected frames are not read
+    filename, selection = catalogSelection(filename, traceLength=TRACE_LENGTH)
+
+    tray.AddModule("I3Reader", "reader",
+             FilenameList = filename) 
+
+    if selection is not None:
+        tray.Add(selection, "select_catalog",
+                 streams=[icetray.I3Frame.DAQ])
+    else:
+        # add the module to the tray
+        tray.Add(select_soft, "select_soft",
+                 streams=[icetray.I3Frame.DAQ])
+
+        #add the module to the tray
+        tray.Add(select_TraceLength, "select_TraceLength",
+                 streams=[icetray.I3Frame.DAQ])
+
+    #Removing TAXI artifacts 
+    tray.Add(
+        radcube.modules.RemoveTAXIArtifacts, "ArtifactRemover",
+        InputName="RadioTAXIWaveform",
+        OutputName="ArtifactsRemoved",
+        medianOverCascades=True,
+        RemoveBinSpikes=True,
+        BinSpikeDeviance=int(2**12),
+        RemoveNegativeBins=True
+        )
+
+    tray.AddModule("I3NullSplitter","splitter",
+                   SubEventStreamName="RadioEvent"
+                   )
+
+    # The NumPy engine filters the artifact-free traces inside GalacticBackground.
+    # The multi-band mode needs it, so the spectrum of a trace is shared by the bands.
+    chain = None
+    if config.get("engine", "radcube") == "numpy":
+        chain = FilterChain(config["medianWindow"], config["butterworthOrder"], config["filterLimits"])
+    else:
+        tray.AddModule("MedianFrequencyFilter", "MedianFilter",
+                    InputName="ArtifactsRemoved",
+                    FilterWindowWidth=config["medianWindow"],
+                    OutputName="MedFilteredMap")
+
+        # let's apply a bandpass filter to our signals
+        tray.AddModule("BandpassFilter", "filter",
+                       InputName="MedFilteredMap",
+                       OutputName="FilteredMap",
+                       ApplyInDAQ=False,
+                       FilterType=radcube.eButterworth,
+                       ButterworthOrder=config["butterworthOrder"],
+                       #FilterType=radcube.eBox,
+                       FilterLimits=[limit*I3Units.megahertz for limit in config["filterLimits"]]
+                       )
+
+    validation = None
+    if validate and chain is None:
+        # Compares the NumPy engine with the radcube modules on every frame
+        validation = FilterValidation(FilterChain(config["medianWindow"], config["butterworthOrder"], config["filterLimits"]),
+                                      lengthSubTraces=config["lengthSubTraces"], keep=config["keepSubTraces"])
+        tray.Add(validation, "validate_engine",
+                 streams=[icetray.I3Frame.Physics])
+
+    tray.AddModule(GalacticBackground, "TheGalaxyObserverDeconvolved",
+                   InputName="FilteredMap" if chain is None else "ArtifactsRemoved",
+                   FilterChain=chain,
+                   Bands=config.get("bands"),
+                   TraceStore=traceStore,
+                   Output=output,
+                   LengthSubTraces=config["lengthSubTraces"],
+                   KeepSubTraces=config["keepSubTraces"]
+                   )
+
+    tray.Execute()
+
+    if validation is not None:
+        validation.report()
+        validation.save(validationFile)
+
+
+# Worker of the parallel and cached modes: runs the tray over one shard of files and returns its partial NPZ
+def runShard(shard):
+    filename, output, config = shard
+    runTray(filename, output, config)
+    return output
+
+
+if __name__ == "__main__":
+    #Input i3 file with the data 
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input", type=str, nargs="+", default=[], help="List of i3 files")
+    parser.add_argument("--output", type=str, default="GalOscillation_Deconvolved_140-190_New.npz", help="Name of the output .npz file")
+    parser.add_argument("--jobs", type=int, default=1, help="Number of worker processes (1 runs a single tray)")
+    parser.add_argument("--shardSize", type=int, default=1, help="Number of i3 files processed by each worker task")
+    parser.add_argument("--cacheDir", type=str, default=None, help="Directory of the per-file result cache (no cache if not given)")
+    parser.add_argument("--cacheSize", type=float, default=20, help="Maximum size of the cache in GB")
+    parser.add_argument("--dataset", type=str, default=None, help="Also add the results to this day-partitioned dataset")
+    parser.add_argument("--engine", type=str, choices=["radcube", "numpy"], default=CONFIG["engine"], help="Filter chain: radcube modules or NumPy (FilterChain.py)")
+    parser.add_argument("--traceStore", type=str, default=None, help="Also store the filtered traces in this directory (TraceStore.py, single tray)")
+    parser.add_argument("--validateEngine", action="store_true", help="Compare the NumPy filter chain with the radcube modules (single tray) and record the result")
+    parser.add_argument("--validationFile", type=str, default=VALIDATION_FILE, help="Result of --validateEngine, needed by --engine numpy")
+    parser.add_argument("--filterLimits", type=float, nargs=2, default=CONFIG["filterLimits"], help="Bandpass limits in MHz")
+    parser.add_argument("--bands", type=float, nargs=2, action="append", default=None, metavar=("LOW", "HIGH"),
+                        help="Compute the RMS in this band in MHz instead of --filterLimits, can be repeated (needs --engine numpy)")
+    parser.add_argument("--butterworthOrder", type=int, default=CONFIG["butterworthOrder"], help="Order of the Butterworth filter")
+    parser.add_argument("--medianWindow", type=int, default=CONFIG["medianWindow"], help="Window width of the median frequency filter")
+    parser.add_argument("--lengthSubTraces", type=int, default=CONFIG["lengthSubTraces"], help="Length of the subtraces")
+    parser.add_argument("--keepSubTraces", type=int, default=CONFIG["keepSubTraces"], help="Number of lowest subtraces that are averaged")
+    args = parser.parse_args()
+
+    filename = args.input
+    config = dict(CONFIG,
+                  engine=args.engine,
+                  filterLimits=args.filterLimits,
+                  bands=args.bands,
+                  butterworthOrder=args.butterworthOrder,
+                  medianWindow=args.medianWindow,
+                  lengthSubTraces=args.lengthSubTraces,
+                  keepSubTraces=args.keepSubTraces)
+
+    if args.validateEngine and (args.jobs != 1 or args.cacheDir is not None or args.engine != "radcube" or args.bands is not None):
+        parser.error("--validateEngine runs a single tray with the radcube modules, it can not be used with --jobs, --cacheDir, --bands or --engine numpy")
+
+    if args.bands is not None and args.engine != "numpy":
+        parser.error("--bands filters the traces with the NumPy engine, it needs --engine numpy")
+    bands = [args.filterLimits] if args.bands is None else args.bands
+    error = engineError(args.engine, args.medianWindow, args.butterworthOrder, bands, args.validationFile)
+    if error is not None:
+        parser.error(error)
+
+    if args.traceStore is not None and (args.jobs != 1 or args.cacheDir is not None or args.bands is not None):
+        parser.error("--traceStore runs a single tray for a single band, it can not be used with --jobs, --cacheDir or --bands")
+
+    if args.jobs == 1 and args.cacheDir is None:
+        runTray(filename, args.output, config, args.validateEngine, args.traceStore, args.validationFile)
+    else:
+        cache = None if args.cacheDir is None else ResultCache(args.cacheDir, args.cacheSize * 1024**3)
+        # Shards the file list over a pool of processes, each running the same tray, and merges their outputs
+        tmpdir = tempfile.mkdtemp(prefix="GalOscillation_", dir=os.path.dirname(os.path.abspath(args.output)))
+        try:
+            partials = runFiles(filename, config, runShard, tmpdir, cache, args.jobs, args.shardSize)
+            mergeRms(partials, args.output)
+        finally:
+            shutil.rmtree(tmpdir)
+            if cache is not None:
+                cache.evict()
+
+    if args.dataset is not None:
+        RmsDataset(args.dataset).add(loadRms(args.output))
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+"""
+Streaming, mergeable histograms of the noise levels of Histograms.py.
+
+NoiseHistogram accumulates the values of every method (standard RMS window and subtraces), antenna and channel
+in fixed-range histograms, with one underflow and one overflow bin, so adding a frame is a single bincount and
+the memory does not depend on the number of frames. QuantileSketch optionally keeps, with constant memory,
+log-spaced buckets (as DDSketch) whose quantiles have a relative error below relativeAccuracy over the whole
+positive range. Both are plain counts: results of parallel workers or of different days are merged by adding them.
+
+Saved histograms can be merged and plotted with:
+./NoiseHistogram.py HISTOGRAM_FILES --output MERGED.npz --plot noise_histogram.png
+"""
+
+import argparse
+
+import numpy as np
+
+
+METHODS = ["window", "subtraces"]
+
+
+# Counts of values in cells of shape `shape` (e.g. methods, antennas, channels), with the value axis last.
+# Bin 0 counts the values below the range and the last bin the values above it.
+class NoiseHistogram():
+
+    def __init__(self, shape, valueRange=(0., 200.), nbBins=4000):
+        self.valueRange = tuple(float(value) for value in valueRange)
+        self.counts = np.zeros(tuple(shape) + (nbBins + 2,), dtype=np.int64)
+        self.sums = np.zeros(tuple(shape))
+        self.sums2 = np.zeros(tuple(shape))
+
+    @property
+    def nbBins(self):
+        return self.counts.shape[-1] - 2
+
+    @property
+    def edges(self):
+        return np.linspace(self.valueRange[0], self.valueRange[1], self.nbBins + 1)
+
+    # values: shape (..., *shape), e.g. one frame or a block of frames. Non finite values are skipped.
+    def add(self, values):
+        shape = self.counts.shape[:-1]
+        values = np.asarray(values, dtype=float).reshape((-1,) + shape)
+        cell = np.broadcast_to(np.arange(np.prod(shape)).reshape(shape), values.shape)
+        valid = np.isfinite(values)
+        cell, values = cell[valid], values[valid]
+        low, high = self.valueRange
+        index = np.clip(np.floor((values - low) / (high - low) * self.nbBins), -1, self.nbBins).astype(np.int64) + 1
+        size = self.counts.size
+        self.counts += np.bincount(cell * self.counts.shape[-1] + index, minlength=size).reshape(self.counts.shape)
+        self.sums += np.bincount(cell, weights=values, minlength=self.sums.size).reshape(shape)
+        self.sums2 += np.bincount(cell, weights=values**2, minlength=self.sums.size).reshape(shape)
+
+    def merge(self, other):
+        if self.counts.shape != other.counts.shape or self.valueRange != other.valueRange:
+            raise ValueError("Only histograms with the same binning can be merged")
+        self.counts += other.counts
+        self.sums += other.sums
+        self.sums2 += other.sums2
+
+    @property
+    def total(self):
+        return self.counts.sum(axis=-1)
+
+    # Number of values below and above the range of every cell
+    @property
+    def underflow(self):
+        return self.counts[..., 0]
+
+    @property
+    def overflow(self):
+        return self.counts[..., -1]
+
+    @property
+    def mean(self):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return self.sums / self.total
+
+    @property
+    def std(self):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.sqrt(np.maximum(self.sums2 / self.total - self.mean**2, 0))
+
+    # Quantiles q (0 ... 1) of every cell, interpolated linearly inside the bins. Values outside the range
+    # are put at its limits.
+    def quantile(self, q):
+        cumulative = np.cumsum(self.counts, axis=-1)
+        target = np.asarray(q, dtype=float) * self.total
+        index = np.sum(cumulative < target[..., np.newaxis], axis=-1)
+        index = np.minimum(index, self.counts.shape[-1] - 1)
+        inBin = np.take_along_axis(self.counts, index[..., np.newaxis], axis=-1)[..., 0]
+        below = np.take_along_axis(cumulative, index[..., np.newaxis], axis=-1)[..., 0] - inBin
+        low, high = self.valueRange
+        width = (high - low) / self.nbBins
+        with np.errstate(invalid="ignore", divide="ignore"):
+            fraction = np.where(inBin > 0, (target - below) / inBin, 0.)
+        value = low + width * (index - 1 + fraction)
+        return np.where(self.total > 0, np.clip(value, low, high), np.nan)
+
+    # Counts regrouped by `factor` neighbouring bins (the under and overflow bins are dropped, see underflow and
+    # overflow), with the edges
+    def rebinned(self, factor):
+        nbBins = self.nbBins // factor * factor
+        counts = self.counts[..., 1:nbBins + 1].reshape(self.counts.shape[:-1] + (nbBins // factor, factor)).sum(axis=-1)
+        return counts, self.edges[:nbBins + 1:factor]
+
+    def save(self, output, **extra):
+        np.savez(output, counts=self.counts, sums=self.sums, sums2=self.sums2,
+                 valueRange=np.asarray(self.valueRange), **extra)
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as data:
+            histogram = cls(data["counts"].shape[:-1], tuple(data["valueRange"]), data["counts"].shape[-1] - 2)
+            histogram.counts[:] = data["counts"]
+            histogram.sums[:] = data["sums"]
+            histogram.sums2[:] = data["sums2"]
+            sketch = QuantileSketch.load(data) if "sketchCounts" in data.files else None
+        return histogram, sketch
+
+
+# Log-bucketed counts of positive values: bucket i holds the values in (gamma^(i-1), gamma^i] with
+# gamma = (1 + a) / (1 - a), so the quantiles are given with a relative error below a = relativeAccuracy.
+# Values below minValue go to the first bucket, values above maxValue to the last one.
+class QuantileSketch():
+
+    def __init__(self, shape, relativeAccuracy=0.01, minValue=1e-3, maxValue=1e5):
+        self.relativeAccuracy = relativeAccuracy
+        self.minValue = minValue
+        self.maxValue = maxValue
+        self.logGamma = np.log((1 + relativeAccuracy) / (1 - relativeAccuracy))
+        self.offset = int(np.ceil(np.log(minValue) / self.logGamma))
+        nbBuckets = int(np.ceil(np.log(maxValue) / self.logGamma)) - self.offset + 1
+        self.counts = np.zeros(tuple(shape) + (nbBuckets,), dtype=np.int64)
+
+    def add(self, values):
+        shape = self.counts.shape[:-1]
+        values = np.asarray(values, dtype=float).reshape((-1,) + shape)
+        cell = np.broadcast_to(np.arange(np.prod(shape)).reshape(shape), values.shape)
+        valid = np.isfinite(values) & (values > 0)
+        cell, values = cell[valid], values[valid]
+        index = np.ceil(np.log(values) / self.logGamma).astype(np.int64) - self.offset
+        index = np.clip(index, 0, self.counts.shape[-1] - 1)
+        self.counts += np.bincount(cell * self.counts.shape[-1] + index,
+                                   minlength=self.counts.size).reshape(self.counts.shape)
+
+    def merge(self, other):
+        if self.counts.shape != other.counts.shape or self.relativeAccuracy != other.relativeAccuracy \
+                or self.minValue != other.minValue:
+            raise ValueError("Only sketches with the same accuracy and range can be merged")
+        self.counts += other.counts
+
+    # Quantiles q (0 ... 1) of every cell
+    def quantile(self, q):
+        total = self.counts.sum(axis=-1)
+        cumulative = np.cumsum(self.counts, axis=-1)
+        rank = np.asarray(q, dtype=float) * (total - 1)
+        index = np.minimum(np.sum(cumulative <= rank[..., np.newaxis], axis=-1), self.counts.shape[-1] - 1)
+        gamma = np.exp(self.logGamma)
+        value = 2 * np.exp((index + self.offset) * self.logGamma) / (gamma + 1)
+        return np.where(total > 0, value, np.nan)
+
+    def items(self):
+        return {"sketchCounts": self.counts,
+                "sketchParameters": np.array([self.relativeAccuracy, self.minValue, self.maxValue])}
+
+    @classmethod
+    def load(cls, data):
+        relativeAccuracy, minValue, maxValue = data["sketchParameters"]
+        sketch = cls(data["sketchCounts"].shape[:-1], relativeAccuracy, minValue, maxValue)
+        sketch.counts[:] = data["sketchCounts"]
+        return sketch
+
+
+# Saves a histogram and its sketch (if any) in one .npz file
+def saveHistograms(output, histogram, sketch=None):
+    histogram.save(output, **({} if sketch is None else sketch.items()))
+
+
+# Merges saved histograms (and their sketches, if all of them have one)
+def mergeHistograms(filenames):
+    histogram, sketch = NoiseHistogram.load(filenames[0])
+    for filename in filenames[1:]:
+        otherHistogram, otherSketch = NoiseHistogram.load(filename)
+        histogram.merge(otherHistogram)
+        sketch = None if sketch is None or otherSketch is None else sketch
+        if sketch is not None:
+            sketch.merge(otherSketch)
+    return histogram, sketch
+
+
+# Width of the plotting bins given by the Freedman-Diaconis rule (2 IQR / n^(1/3)) of a cell,
+# as a number of histogram bins
+def fdFactor(histogram, cell):
+    q1, q3 = histogram.quantile(0.25)[cell], histogram.quantile(0.75)[cell]
+    width = 2 * (q3 - q1) / max(histogram.total[cell], 1)**(1 / 3.)
+    binWidth = (histogram.valueRange[1] - histogram.valueRange[0]) / histogram.nbBins
+    return max(int(width / binWidth), 1) if np.isfinite(width) else 1
+
+
+# Plotting the Histograms of the noise level, from the accumulated histograms of shape (methods, antennas, channels).
+# The numbers of values outside the range, which are not drawn, are given in the labels.
+def plotHistograms(histogram, plot_filename="noise_histogram.png"):
+    import matplotlib.pyplot as plt
+
+    colors = ["c", "b", "m", "r", "y", "g"]
+    fig, ax = plt.subplots(
+            figsize=[10, 8], nrows=1, ncols=1, tight_layout=True
+            )
+    nbAntennas, nbChannels = histogram.counts.shape[1:3]
+    styles = [dict(histtype="stepfilled", alpha=0.45, suffix=""),
+              dict(histtype="step", alpha=1, suffix=", Subtraces")]
+    for iant in range(nbAntennas):
+        for ich in range(nbChannels):
+            # Rms, then subtraces
+            for method, style in enumerate(styles):
+                counts, edges = histogram.rebinned(fdFactor(histogram, (method, iant, ich)))
+                ax.hist(
+                    edges[:-1], bins=edges, weights=counts[method, iant, ich],
+                    histtype=style["histtype"], alpha=style["alpha"],
+                    color=colors[(nbChannels*iant + ich) % len(colors)],
+                    label=f"Antenna {iant+1}, Channel {ich+1}{style['suffix']} "
+                          f"({histogram.underflow[method, iant, ich]} below, {histogram.overflow[method, iant, ich]} above range)",
+                    density=True
+                    )
+    ax.set_xlabel("Amplitude / ADC")
+    ax.set_ylabel("Normilized Counts")
+    ax.legend(ncol=2)
+
+    # Save the plot to a file
+    plt.title("Distributions of the noise level in the traces for each antenna channel")
+    fig.savefig(plot_filename)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input", type=str, nargs="+", help="List of histogram .npz files written by Histograms.py")
+    parser.add_argument("--output", type=str, default=None, help="Name of the merged .npz file")
+    parser.add_argument("--plot", type=str, default=None, help="Name of the plot of the merged histograms")
+    args = parser.parse_args()
+
+    histogram, sketch = mergeHistograms(args.input)
+    if args.output is not None:
+        saveHistograms(args.output, histogram, sketch)
+    if args.plot is not None:
+        plotHistograms(histogram, args.plot)
+    quantiles = histogram.quantile(0.5) if sketch is None else sketch.quantile(0.5)
+    for method, name in enumerate(METHODS):
+        for iant in range(quantiles.shape[1]):
+            for ich in range(quantiles.shape[2]):
+                print("{0}, Antenna {1}, Channel {2}: {3} values ({4} below, {5} above range), mean {6:.3f}, median {7:.3f}".format(
+                    name, iant + 1, ich + 1, histogram.total[method, iant, ich], histogram.underflow[method, iant, ich],
+                    histogram.overflow[method, iant, ich], histogram.mean[method, iant, ich], quantiles[method, iant, ich]))
@@ -0,0 +1,145 @@
+import functools
+
+import numpy as np
+
+
+# Functions memoized with geometryCache, by name
+memoizedFunctions = {}
+
+
+# Process-wide LRU memoization of the arrays that only depend on the trace geometry (length, binning,
+# filter type, order and limits), such as filter responses, frequency axes and dBm/Hz offsets.
+# The arrays are shared by all the callers, so they are made read-only.
+def geometryCache(maxsize=32):
+    def decorator(function):
+        @functools.wraps(function)
+        def compute(*args):
+            value = function(*args)
+            if isinstance(value, np.ndarray):
+                value.setflags(write=False)
+            return value
+        cached = functools.lru_cache(maxsize)(compute)
+        memoizedFunctions[function.__name__] = cached
+        return cached
+    return decorator
+
+
+# Hits and misses of the memoized functions, as functools cache_info tuples by name
+def cacheStatistics():
+    return {name: function.cache_info() for name, function in memoizedFunctions.items()}
+
+
+def printCacheStatistics():
+    for name, info in cacheStatistics().items():
+        print("{0}: {1} hits, {2} misses, {3}/{4} entries".format(name, info.hits, info.misses, info.currsize, info.maxsize))
+
+
+# Pulls every channel of an antenna data map into one (antennas, channels, samples) array.
+# The buffer is allocated once and reused as long as the station layout and trace length do not change,
+# so the statistics of a frame can be computed with broadcast operations over the whole block.
+class FrameArray():
+
+    def __init__(self):
+        self.buffer = None
+        self.binning = None  # Binning of the last traces read
+        self.antennas = None  # Antenna and channel ids of the last traces read, along the first two axes
+        self.channels = None
+
+    # Radcube traces of every antenna and channel, the ids of the map are kept
+    def readTraces(self, antennaDataMap, getTrace):
+        antennas, channelIds, channels = [], [], []
+        for antkey in antennaDataMap.keys():
+            channelMap = antennaDataMap[antkey]
+            antennas.append(int(antkey.antenna))
+            channelIds.append([int(chkey) for chkey in channelMap.keys()])
+            channels.append([getTrace(channelMap[chkey].GetFFTData()) for chkey in channelMap.keys()])
+        self.antennas = np.array(antennas)
+        # All the antennas have the same channels
+        self.channels = np.array(channelIds[0])
+        self.binning = channels[0][0].binning
+        return channels
+
+    def timeSeries(self, antennaDataMap):
+        return self.fill(self.readTraces(antennaDataMap, lambda fftData: fftData.GetTimeSeries()))
+
+    # Amplitudes of the frequency spectra, together with the frequency binning
+    def amplitudeSpectrum(self, antennaDataMap):
+        channels = self.readTraces(antennaDataMap, lambda fftData: fftData.GetFrequencySpectrum())
+        return self.fill(channels, transform=np.abs), self.binning
+
+    # Values of one radcube trace. radcube has no accessor for a whole map, so every trace is read with
+    # one RadTraceToPythonList call.
+    @staticmethod
+    def traceValues(radTrace):
+        from icecube import radcube
+        return radcube.RadTraceToPythonList(radTrace)[1]
+
+    # The values of all the traces are converted, transformed and copied into the buffer at once,
+    # with shape (antennas, channels, samples)
+    def fill(self, channels, transform=None):
+        values = np.asarray([[self.traceValues(radTrace) for radTrace in antenna] for antenna in channels])
+        if self.buffer is None or self.buffer.shape != values.shape:
+            self.buffer = np.empty(values.shape)
+        self.buffer[...] = values if transform is None else transform(values)
+        return self.buffer
+
+
+# Frequency axis of a spectrum with nbBins bins. Only needed once, when the average spectrum is plotted,
+# so it is not memoized.
+def frequencyGrid(nbBins, binning):
+    return np.arange(nbBins) * binning
+
+
+# Offset in dBm/Hz of a unit Fourier amplitude given by getDbmHz(amplitude, binning, resistance). The
+# function is also evaluated at a second amplitude, to check that it is 20*log10|A| plus this offset.
+def linearDbmHzOffset(getDbmHz, binning, resistance):
+    offset = getDbmHz(1., binning, resistance)
+    slope = getDbmHz(10., binning, resistance) - offset
+    if not np.isclose(slope, 20., rtol=0, atol=1e-9):
+        raise ValueError("The dBm/Hz of a Fourier amplitude is not 20*log10|A| plus a constant "
+                         "(got {0} dB per decade)".format(slope))
+    return offset
+
+
+# Offset in dBm/Hz of a unit Fourier amplitude, taken from radcube once per (binning, resistance)
+@geometryCache()
+def dbmHzOffset(binning, resistance):
+    from icecube import radcube
+    return linearDbmHzOffset(radcube.GetDbmHzFromFourierAmplitude, binning, resistance)
+
+
+# Vectorized version of radcube.GetDbmHzFromFourierAmplitude for a whole array of amplitudes.
+# The spectral power goes with the squared amplitude, so in dB it is 20*log10|A| plus a constant.
+def dbmHzFromAmplitude(amplitudes, binning, resistance):
+    with np.errstate(divide="ignore"):
+        return 20 * np.log10(np.abs(amplitudes)) + dbmHzOffset(binning, resistance)
+
+
+# Standard RMS over the full trace (same definition as radcube.GetRMS), along the last axis
+def traceRms(traces):
+    traces = np.asarray(traces, dtype=float)
+    return np.sqrt(np.mean(traces**2, axis=-1))
+
+
+# RMS of every subtrace of length lengthSubTraces, computed for all the windows at once.
+# traces can be a single trace or a block (..., samples); the result has shape (..., nbSubTraces).
+# As in the original loop over radTrace.GetSubset, the last window of the trace is not used.
+def subTraceRms(traces, lengthSubTraces=64):
+    traces = np.asarray(traces, dtype=float)
+    nbSubTraces = traces.shape[-1] // lengthSubTraces - 1
+    if nbSubTraces < 1:
+        raise ValueError("Trace of length {0} is too short for subtraces of length {1}".format(
+            traces.shape[-1], lengthSubTraces))
+    windows = traces[..., :nbSubTraces * lengthSubTraces].reshape(
+        traces.shape[:-1] + (nbSubTraces, lengthSubTraces))
+    return traceRms(windows)
+
+
+# Subtraces method: the keep lowest subtrace RMS values of each trace (not sorted).
+# The rational is that RFI screw up the noise, but we can hardly have lower noise.
+def cutTraces(traces, lengthSubTraces=64, keep=10):
+    rms = subTraceRms(traces, lengthSubTraces)
+    if keep is None or keep >= rms.shape[-1]:
+        return rms
+    # Partial selection is enough, we only need the keep smallest values
+    return np.partition(rms, keep - 1, axis=-1)[..., :keep]
@@ -0,0 +1,127 @@
+"""
+Fast Lomb-Scargle periodogram of the unevenly sampled RMS series.
+
+The soft trigger sampling is irregular, so the periodogram is computed with the method of Press & Rybicki
+(1989): the data are extirpolated onto a regular grid and the trigonometric sums of all the frequencies are
+obtained with one FFT, in O(N log N) instead of O(N * frequencies). The model includes a floating mean
+(Zechmeister & Kurster 2009) and the power uses the "standard" normalization, between 0 and 1.
+All the channels are done in the same call; the terms that only depend on the times are shared.
+"""
+
+import math
+
+import numpy as np
+
+from SinusFit import DAY, SIDEREAL_FREQUENCY, SOLAR_FREQUENCY
+
+
+# Spreads the values y (channels, samples) placed at the non integer positions x onto the regular grid
+# 0 ... N-1 with Lagrange weights of the M nearest grid points, so sums over the grid reproduce the sums
+# over the samples (Press & Rybicki 1989)
+def extirpolate(x, y, N, M=4):
+    result = np.zeros((y.shape[0], N), dtype=y.dtype)
+
+    def addAt(index, values):
+        for ich in range(values.shape[0]):
+            result[ich] += np.bincount(index, weights=values[ich].real, minlength=N)
+            if np.iscomplexobj(values):
+                result[ich] += 1j * np.bincount(index, weights=values[ich].imag, minlength=N)
+
+    integer = x % 1 == 0
+    addAt(x[integer].astype(np.int64), y[:, integer])
+    x, y = x[~integer], y[:, ~integer]
+
+    ilo = np.clip((x - M // 2).astype(np.int64), 0, N - M)
+    numerator = y * np.prod(x - ilo - np.arange(M)[:, np.newaxis], axis=0)
+    denominator = float(math.factorial(M - 1))
+    for j in range(M):
+        if j > 0:
+            denominator *= j / (j - M)
+        index = ilo + (M - 1 - j)
+        addAt(index, numerator / (denominator * (x - index)))
+    return result
+
+
+# Sums of h*sin(2 pi f t) and h*cos(2 pi f t) for f = f0 + k*df, k = 0 ... N-1, with one FFT.
+# t must start at 0. h has shape (channels, samples), the results (channels, N).
+def trigSum(t, h, df, N, f0=0., freqFactor=1, oversampling=5, Mfft=4):
+    df *= freqFactor
+    f0 *= freqFactor
+    Nfft = 1 << int(math.ceil(math.log2(N * oversampling)))
+    if f0 > 0:
+        h = h * np.exp(2j * np.pi * f0 * t)
+    tnorm = (t * Nfft * df) % Nfft
+    grid = extirpolate(tnorm, h.astype(complex), Nfft, Mfft)
+    fftgrid = np.fft.ifft(grid, axis=-1)[:, :N]
+    return Nfft * fftgrid.imag, Nfft * fftgrid.real
+
+
+class Periodogram():
+
+    def __init__(self, freqs, power, n, baseline):
+        self.freqs = freqs  # Hz
+        self.power = power  # shape (channels, frequencies)
+        self.n = n
+        self.baseline = baseline  # s
+
+    # Probability that noise alone gives a peak of this power somewhere in the scanned band,
+    # with the number of independent frequencies estimated as bandwidth * baseline
+    def falseAlarmProbability(self, power):
+        single = np.exp(0.5 * (self.n - 3) * np.log1p(-np.minimum(power, 1 - 1e-16)))
+        independent = max(1., (self.freqs[-1] - self.freqs[0]) * self.baseline)
+        return -np.expm1(independent * np.log1p(-single))
+
+    # Frequency, power and false alarm probability of the highest peak of every channel
+    def peaks(self):
+        index = np.argmax(self.power, axis=-1)
+        power = self.power[np.arange(len(index)), index]
+        return self.freqs[index], power, self.falseAlarmProbability(power)
+
+    # Power of every channel at the frequency freq (Hz), interpolated in the grid
+    def powerAt(self, freq):
+        return np.array([np.interp(freq, self.freqs, power) for power in self.power])
+
+    def save(self, output):
+        freqs, power, fap = self.peaks()
+        np.savez(output, freqs=self.freqs, power=self.power, n=self.n, baseline=self.baseline,
+                 peakFreqs=freqs, peakPower=power, peakFap=fap,
+                 siderealPower=self.powerAt(SIDEREAL_FREQUENCY), solarPower=self.powerAt(SOLAR_FREQUENCY))
+
+
+# Lomb-Scargle periodogram of all the channels between fmin and fmax (Hz). t: seconds, shape (samples,);
+# rms: shape (samples, channels). The grid step is 1 / (oversampling * baseline). Samples where a channel
+# is not finite are left out for all channels.
+def lombScargle(t, rms, fmin=0.9 / DAY, fmax=1.1 / DAY, oversampling=10):
+    t = np.asarray(t, dtype=float)
+    rms = np.asarray(rms, dtype=float)
+    if rms.ndim == 1:
+        rms = rms[:, np.newaxis]
+    valid = np.all(np.isfinite(rms), axis=1)
+    t, y = t[valid], rms[valid].T
+    t = t - t.min()
+    baseline = t.max()
+    df = 1. / (oversampling * baseline)
+    Nf = int(math.ceil((fmax - fmin) / df)) + 1
+    freqs = fmin + df * np.arange(Nf)
+
+    w = np.full((1, len(t)), 1. / len(t))
+    y = y - np.sum(w * y, axis=1, keepdims=True)
+    kwargs = dict(df=df, N=Nf, f0=fmin)
+    # Functions of the time shift tau, shared by all the channels
+    S, C = trigSum(t, w, **kwargs)
+    S2, C2 = trigSum(t, w, freqFactor=2, **kwargs)
+    Sh, Ch = trigSum(t, w * y, **kwargs)
+
+    tan2wt = (S2 - 2 * S * C) / (C2 - (C * C - S * S))
+    S2w = tan2wt / np.sqrt(1 + tan2wt * tan2wt)
+    C2w = 1 / np.sqrt(1 + tan2wt * tan2wt)
+    Cw = np.sqrt(0.5) * np.sqrt(1 + C2w)
+    Sw = np.sqrt(0.5) * np.sign(S2w) * np.sqrt(1 - C2w)
+
+    YY = np.sum(w * y**2, axis=1, keepdims=True)
+    YC = Ch * Cw + Sh * Sw
+    YS = Sh * Cw - Ch * Sw
+    CC = 0.5 * (1 + C2 * C2w + S2 * S2w) - (C * Cw + S * Sw)**2
+    SS = 0.5 * (1 - C2 * C2w - S2 * S2w) - (S * Cw - C * Sw)**2
+    power = (YC * YC / CC + YS * YS / SS) / YY
+    return Periodogram(freqs, power, len(t), baseline)
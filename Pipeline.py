@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+"""
+Single-pass processing of the I3 files for all the noise analyses.
+
+AverageFrames.py, Histograms.py, NPZ.py and TimeValues.py each read the files, select the soft trigger frames
+and remove the TAXI artifacts in their own tray. Pipeline runs these shared stages once and fans the frames out
+to the analysis sinks that are enabled. Every sink is a Sink with the module of the corresponding script, added
+to the tray after the stage of the preprocessing it reads:
+    times       TaxiTimeData: RadioTaxiTime of every soft trigger frame (TimeValues.py)
+    spectrum    AnalyzeQframes: average spectrum (and spectrogram) of the artifact-free traces (AverageFrames.py)
+    histograms  NoiseCalculation: histograms of the noise levels of the filtered traces (Histograms.py)
+    rms         GalacticBackground: subtraces RMS of the filtered traces (NPZ.py)
+The artifact removal runs once if a sink needs the traces, with the settings of NPZ.py and Histograms.py. The
+zero baseline of AverageFrames.py is not applied: it only shifts the traces by a constant, so the spectrum only
+differs from that of AverageFrames.py in the zero frequency bin. The median and bandpass filters only run if a
+sink needs the filtered traces. Every sink keeps the trace length selection of its script: all the lengths for the
+times, 1024 samples for the spectrum and the RMS values, any non-zero length for the histograms.
+
+Run with command:
+./Pipeline.py I3_FILE_NAMES --times time_values.txt --spectrum --histograms histograms.npz --rms OUTPUT_NAME.npz
+"""
+
+import argparse
+
+import numpy as np
+from I3Tray import I3Tray
+from icecube import icetray, dataio, dataclasses, taxi_reader, radcube
+from icecube.icetray import I3Units
+
+from AverageFrames import AnalyzeQframes, addSpectrogramArguments, spectrogramOptions
+from FilterChain import VALIDATION_FILE, FilterChain, engineError
+from FrameCatalog import catalogSelection
+from Histograms import CONFIG as HISTOGRAM_CONFIG, NoiseCalculation
+from NPZ import CONFIG as RMS_CONFIG, TRACE_LENGTH, GalacticBackground, select_soft
+from RmsStore import RmsDataset, loadRms
+from TimeValues import TaxiTimeData
+
+# Processing configuration of the filtered sinks, the keys shared by NPZ.py and Histograms.py have the same defaults
+CONFIG = dict(dict(HISTOGRAM_CONFIG, **RMS_CONFIG), analysis="Pipeline")
+
+
+# Traces of any non-zero length, the widest selection of the trace sinks
+def select_nonEmpty(frame):
+    return frame['RadioTraceLength'].value != 0
+
+
+# Condition of the sinks that only use the traces of TRACE_LENGTH samples
+def hasTraceLength(frame):
+    return frame['RadioTraceLength'].value == TRACE_LENGTH
+
+
+# FilterChain shared by the sinks: the output for the last block of traces is kept, so the sinks filtering
+# the same frame only pay for the transforms once. The shared output must not be modified by the sinks.
+class SharedFilterChain(FilterChain):
+
+    def __init__(self, *args, **kwargs):
+        FilterChain.__init__(self, *args, **kwargs)
+        self.lastInput = None
+        self.lastBinning = None
+        self.lastOutput = None
+
+    def apply(self, traces, binning):
+        if self.lastInput is not None and binning == self.lastBinning and np.array_equal(traces, self.lastInput):
+            return self.lastOutput
+        self.lastOutput = FilterChain.apply(self, traces, binning)
+        self.lastInput = np.array(traces)
+        self.lastBinning = binning
+        return self.lastOutput
+
+
+# Analysis fed by the pipeline. The options are the parameters of the module of its script. A sink reads the
+# frames at one stage of the shared preprocessing: the selected frames (traces False), the artifact-free
+# traces (filtered False) or the filtered traces (filtered True).
+class Sink():
+    name = None
+    traces = True
+    filtered = False
+
+    def __init__(self, **options):
+        self.options = options
+
+    # Adds the module of the sink. inputName and chain give the filtered traces, for the filtered sinks only.
+    def addTo(self, tray, config, inputName=None, chain=None):
+        raise NotImplementedError
+
+
+class TimesSink(Sink):
+    name = "times"
+    traces = False
+
+    def addTo(self, tray, config, inputName=None, chain=None):
+        tray.AddModule(TaxiTimeData, "Savingtimevalues", InputName="RadioTaxiTime", **self.options)
+
+
+class SpectrumSink(Sink):
+    name = "spectrum"
+
+    def addTo(self, tray, config, inputName=None, chain=None):
+        tray.AddModule(AnalyzeQframes, "Plotter",
+                       If=hasTraceLength,
+                       **self.options)
+
+
+class HistogramsSink(Sink):
+    name = "histograms"
+    filtered = True
+
+    def addTo(self, tray, config, inputName=None, chain=None):
+        tray.AddModule(NoiseCalculation, "TheNoiseCalculator",
+                       InputName=inputName,
+                       FilterChain=chain,
+                       LengthSubTraces=config["lengthSubTraces"],
+                       KeepSubTraces=config["keepSubTraces"],
+                       HistogramRange=config["histogramRange"],
+                       HistogramBins=config["histogramBins"],
+                       SketchAccuracy=config["sketchAccuracy"],
+                       NbAntennas=config["nbAntennas"],
+                       NbChannels=config["nbChannels"],
+                       **self.options)
+
+
+class RmsSink(Sink):
+    name = "rms"
+    filtered = True
+
+    def addTo(self, tray, config, inputName=None, chain=None):
+        tray.AddModule(GalacticBackground, "TheGalaxyObserverDeconvolved",
+                       If=hasTraceLength,
+                       InputName=inputName,
+                       FilterChain=chain,
+                       Bands=config.get("bands"),
+                       LengthSubTraces=config["lengthSubTraces"],
+                       KeepSubTraces=config["keepSubTraces"],
+                       **self.options)
+
+
+# Sinks by name, in the order their modules are added to the tray
+SINKS = {sink.name: sink for sink in [TimesSink, SpectrumSink, HistogramsSink, RmsSink]}
+
+
+# Runs the shared preprocessing once over the i3 files and adds every sink after the stage it reads.
+# sinks is a list of Sink objects.
+def runPipeline(filename, sinks, config=CONFIG):
+    sinks = sorted(sinks, key=lambda sink: list(SINKS).index(sink.name))
+    traceSinks = [sink for sink in sinks if sink.traces and not sink.filtered]
+    filteredSinks = [sink for sink in sinks if sink.filtered]
+    tray = I3Tray()
+
+    # The times are kept for every soft trigger frame, the other sinks need non-empty traces
+    traceLength = "nonzero" if all(sink.traces for sink in sinks) else None
+    filename, selection = catalogSelection(filename, traceLength=traceLength)
+
+    tray.AddModule("I3Reader", "reader",
+             FilenameList = filename)
+
+    if selection is not None:
+        tray.Add(selection, "select_catalog",
+                 streams=[icetray.I3Frame.DAQ])
+    else:
+        tray.Add(select_soft, "select_soft",
+                 streams=[icetray.I3Frame.DAQ])
+
+    for sink in sinks:
+        if not sink.traces:
+            sink.addTo(tray, config)
+
+    if traceSinks or filteredSinks:
+        tray.Add(select_nonEmpty, "select_nonEmpty",
+                 streams=[icetray.I3Frame.DAQ])
+
+        # Removing TAXI artifacts once for all the sinks, with the settings of NPZ.py and Histograms.py.
+        # The zero baseline of AverageFrames.py only changes the constant level of the traces, i.e. the
+        # zero frequency bin of the spectrum.
+        tray.Add(
+            radcube.modules.RemoveTAXIArtifacts, "ArtifactRemover",
+            InputName="RadioTAXIWaveform",
+            OutputName="ArtifactsRemoved",
+            medianOverCascades=True,
+            RemoveBinSpikes=True,
+            BinSpikeDeviance=int(2**12),
+            RemoveNegativeBins=True
+            )
+
+        tray.AddModule("I3NullSplitter","splitter",
+                       SubEventStreamName="RadioEvent"
+                       )
+
+        for sink in traceSinks:
+            sink.addTo(tray, config)
+
+    if filteredSinks:
+        # The NumPy engine filters the artifact-free traces inside the sinks, once per frame for all of them.
+        # The multi-band mode needs it.
+        chain = None
+        if config.get("engine", "radcube") == "numpy":
+            chain = SharedFilterChain(config["medianWindow"], config["butterworthOrder"], config["filterLimits"])
+        else:
+            tray.AddModule("MedianFrequencyFilter", "MedianFilter",
+                        InputName="ArtifactsRemoved",
+                        FilterWindowWidth=config["medianWindow"],
+                        OutputName="MedFilteredMap")
+
+            tray.AddModule("BandpassFilter", "filter",
+                           InputName="MedFilteredMap",
+                           OutputName="FilteredMap",
+                           ApplyInDAQ=False,
+                           FilterType=radcube.eButterworth,
+                           ButterworthOrder=config["butterworthOrder"],
+                           FilterLimits=[limit*I3Units.megahertz for limit in config["filterLimits"]]
+                           )
+        inputName = "FilteredMap" if chain is None else "ArtifactsRemoved"
+
+        for sink in filteredSinks:
+            sink.addTo(tray, config, inputName, chain)
+
+    tray.Execute()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input", type=str, nargs="+", default=[], help="List of i3 files")
+    parser.add_argument("--times", type=str, default=None, help="Write the times of the soft trigger frames in this text file")
+    parser.add_argument("--spectrum", action="store_true", help="Plot the average spectrum (spectral_average_antenna.png)")
+    addSpectrogramArguments(parser)
+    parser.add_argument("--histograms", type=str, default=None, help="Store the noise level histograms in this .npz file")
+    parser.add_argument("--rms", type=str, default=None, help="Store the subtraces RMS values in this .npz file")
+    parser.add_argument("--dataset", type=str, default=None, help="Also add the RMS values to this day-partitioned dataset")
+    parser.add_argument("--traceStore", type=str, default=None, help="Also store the filtered traces of the RMS values in this directory (TraceStore.py)")
+    parser.add_argument("--engine", type=str, choices=["radcube", "numpy"], default=CONFIG["engine"], help="Filter chain: radcube modules or NumPy (FilterChain.py)")
+    parser.add_argument("--validationFile", type=str, default=VALIDATION_FILE, help="Result of NPZ.py --validateEngine, needed by --engine numpy")
+    parser.add_argument("--filterLimits", type=float, nargs=2, default=CONFIG["filterLimits"], help="Bandpass limits in MHz")
+    parser.add_argument("--bands", type=float, nargs=2, action="append", default=None, metavar=("LOW", "HIGH"),
+                        help="Compute the RMS values in this band in MHz instead of --filterLimits, can be repeated (needs --engine numpy)")
+    parser.add_argument("--butterworthOrder", type=int, default=CONFIG["butterworthOrder"], help="Order of the Butterworth filter")
+    parser.add_argument("--medianWindow", type=int, default=CONFIG["medianWindow"], help="Window width of the median frequency filter")
+    parser.add_argument("--lengthSubTraces", type=int, default=CONFIG["lengthSubTraces"], help="Length of the subtraces")
+    parser.add_argument("--keepSubTraces", type=int, default=CONFIG["keepSubTraces"], help="Number of lowest subtraces that are kept")
+    parser.add_argument("--histogramRange", type=float, nargs=2, default=CONFIG["histogramRange"], help="Range of the histograms in ADC")
+    parser.add_argument("--histogramBins", type=int, default=CONFIG["histogramBins"], help="Number of bins of the histograms")
+    parser.add_argument("--sketchAccuracy", type=float, default=CONFIG["sketchAccuracy"], help="Also keep a quantile sketch with this relative accuracy (e.g. 0.01)")
+    args = parser.parse_args()
+
+    sinks = []
+    if args.times is not None:
+        sinks.append(TimesSink(Output=args.times))
+    if args.spectrum or args.spectrogram is not None:
+        sinks.append(SpectrumSink(Spectrogram=spectrogramOptions(parser, args), SpectrogramOutput=args.spectrogramOutput))
+    if args.histograms is not None:
+        sinks.append(HistogramsSink(Output=args.histograms))
+    if args.rms is not None:
+        sinks.append(RmsSink(Output=args.rms, TraceStore=args.traceStore))
+    if not sinks:
+        parser.error("No analysis enabled, give at least one of --times, --spectrum, --histograms and --rms")
+    if (args.dataset is not None or args.traceStore is not None) and args.rms is None:
+        parser.error("--dataset and --traceStore need --rms")
+    if args.bands is not None and args.engine != "numpy":
+        parser.error("--bands filters the traces with the NumPy engine, it needs --engine numpy")
+    # The histograms are always filtered with --filterLimits, the RMS values with --bands if given
+    bands = list(args.bands or [])
+    if args.bands is None or args.histograms is not None:
+        bands.append(args.filterLimits)
+    error = engineError(args.engine, args.medianWindow, args.butterworthOrder, bands, args.validationFile)
+    if error is not None:
+        parser.error(error)
+    if args.traceStore is not None and args.bands is not None:
+        parser.error("--traceStore holds the traces of a single band, it can not be used with --bands")
+
+    config = dict(CONFIG,
+                  engine=args.engine,
+                  filterLimits=args.filterLimits,
+                  bands=args.bands,
+                  butterworthOrder=args.butterworthOrder,
+                  medianWindow=args.medianWindow,
+                  lengthSubTraces=args.lengthSubTraces,
+                  keepSubTraces=args.keepSubTraces,
+                  histogramRange=args.histogramRange,
+                  histogramBins=args.histogramBins,
+                  sketchAccuracy=args.sketchAccuracy)
+
+    runPipeline(args.input, sinks, config)
+
+    if args.dataset is not None:
+        RmsDataset(args.dataset).add(loadRms(args.rms))
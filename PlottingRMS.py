@@ -21,50 +21,38 @@ from astropy.coordinates import SkyCoord, EarthLocation, AltAz, Angle
 import matplotlib.pyplot as plt
 import argparse
 
+from RmsStore import framesOfDays, openRms, targetDays
+
 #Input i3 file with the data 
 parser = argparse.ArgumentParser()
-parser.add_argument("input", type=str, help="Name of .npz file")
+parser.add_argument("input", type=str, help="Name of .npz file or of a day-partitioned dataset directory")
+parser.add_argument("--days", type=str, nargs="+", default=[], help="Target days, e.g. 2023-04-05 2023-04-07")
+parser.add_argument("--range", type=str, nargs=2, action="append", default=[], metavar=("FIRST", "LAST"),
+                    help="Range of target days, both included (can be repeated)")
+parser.add_argument("--band", type=int, default=0, help="Index of the band to plot, for the output of a multi-band run")
 args = parser.parse_args()
 
 filename = args.input
 
-data = np.load(filename, allow_pickle=True)
-
-# Get the data arrays
-time = data['time']
-rms10 = data['rms10']
-rms11 = data['rms11']
-rms20 = data['rms20']
-rms21 = data['rms21']
-rms30 = data['rms30']
-rms31 = data['rms31']
-
-
-# Define the target days
-target_days = [
-    datetime(2023, 4, 5),
-    datetime(2023, 4, 6),
-    datetime(2023, 4, 7),
-    datetime(2023, 4, 8),
-    datetime(2023, 4, 9),
-    datetime(2023, 4, 10),
-    datetime(2023, 4, 11),
-    datetime(2023, 4, 12),
-    datetime(2023, 4, 13),
-    datetime(2023, 4, 14),
-    datetime(2023, 4, 15)
-             ]
-
-# Get the indices of datetime objects for the target days
-filtered_indices = [index for index, dt in enumerate(time) if dt.date() in [day.date() for day in target_days]]
-
-time_filtered = time[filtered_indices]
-rms10_filtered = rms10[filtered_indices]
-rms11_filtered = rms11[filtered_indices]
-rms20_filtered = rms20[filtered_indices]
-rms21_filtered = rms21[filtered_indices]
-rms30_filtered = rms30[filtered_indices]
-rms31_filtered = rms31[filtered_indices]
+# Define the target days (default 2023-04-05 to 2023-04-15)
+target_days = targetDays(args.days, args.range)
+if len(target_days) == 0:
+    target_days = targetDays(ranges=[("2023-04-05", "2023-04-15")])
+
+# For a dataset directory only the partitions of the target days are read
+data = openRms(filename, days=target_days).band(args.band)
+
+# Get the indices of the frames in the target days, shared by all the antennas and channels
+filtered_indices = framesOfDays(data.time, target_days)
+
+time_filtered = data.time[filtered_indices]
+rms_filtered = data.rms[filtered_indices]
+rms10_filtered = rms_filtered[:, 0, 0]
+rms11_filtered = rms_filtered[:, 0, 1]
+rms20_filtered = rms_filtered[:, 1, 0]
+rms21_filtered = rms_filtered[:, 1, 1]
+rms30_filtered = rms_filtered[:, 2, 0]
+rms31_filtered = rms_filtered[:, 2, 1]
 
 
 plt.figure(figsize=(20, 15))
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+Per-file cache of the processing results of NPZ.py and Histograms.py.
+
+Each entry holds the partial result of one i3 file. It is keyed by the content of that file and by the
+full processing configuration (trigger selection, filters, subtraces parameters...), so a new run only
+recomputes the files that are new or changed. The key also holds CACHE_VERSION, to be increased whenever
+the processing code or the layout of the results change, so the entries of older code are not reused.
+The least recently used entries are removed when the cache grows above its size limit.
+
+Run with command:
+./ResultCache.py info --cacheDir CACHE_DIR
+./ResultCache.py clear --cacheDir CACHE_DIR
+"""
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+
+
+# Version of the processing code and of the cached results
+CACHE_VERSION = 1
+
+
+class ResultCache():
+
+    def __init__(self, directory, maxBytes=20 * 1024**3):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        os.makedirs(self.directory, exist_ok=True)
+        self.digestFile = os.path.join(self.directory, "digests.json")
+        self.digests = {}
+        self.digestsChanged = False
+        if os.path.exists(self.digestFile):
+            with open(self.digestFile) as file:
+                self.digests = json.load(file)
+
+    # SHA-256 of the file content. It is only recomputed when the size or the modification time
+    # of the file change, so unchanged files are not read again. New digests are kept in memory
+    # until saveDigests is called.
+    def fileDigest(self, filename):
+        path = os.path.realpath(filename)
+        stat = os.stat(path)
+        memo = self.digests.get(path)
+        if memo is not None and memo[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return memo[2]
+        sha = hashlib.sha256()
+        with open(path, "rb") as file:
+            for block in iter(lambda: file.read(1 << 20), b""):
+                sha.update(block)
+        self.digests[path] = [stat.st_size, stat.st_mtime_ns, sha.hexdigest()]
+        self.digestsChanged = True
+        return sha.hexdigest()
+
+    # Writes the digests computed since the last call, once for a whole file list
+    def saveDigests(self):
+        if not self.digestsChanged:
+            return
+        with open(self.digestFile + ".tmp", "w") as file:
+            json.dump(self.digests, file)
+        os.replace(self.digestFile + ".tmp", self.digestFile)
+        self.digestsChanged = False
+
+    def key(self, filename, config):
+        payload = json.dumps({"version": CACHE_VERSION, "file": self.fileDigest(filename), "config": config}, sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".npz")
+
+    # Name of the cached result, or None if the file has to be processed
+    def load(self, key):
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        os.utime(path)  # Mark the entry as recently used
+        return path
+
+    # Moves a result file into the cache and returns its new name
+    def store(self, key, filename):
+        path = self.path(key)
+        shutil.move(filename, path + ".tmp")
+        os.replace(path + ".tmp", path)
+        return path
+
+    def entries(self):
+        names = [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith(".npz")]
+        return sorted(names, key=os.path.getmtime)
+
+    def size(self):
+        return sum(os.path.getsize(name) for name in self.entries())
+
+    # Removes the least recently used entries until the cache fits in maxBytes
+    def evict(self):
+        entries = self.entries()
+        total = sum(os.path.getsize(name) for name in entries)
+        for name in entries:
+            if total <= self.maxBytes:
+                break
+            total -= os.path.getsize(name)
+            os.remove(name)
+
+    def clear(self):
+        for name in self.entries():
+            os.remove(name)
+        self.digests = {}
+        self.digestsChanged = False
+        if os.path.exists(self.digestFile):
+            os.remove(self.digestFile)
+
+
+# Returns the partial result of every input file, in the order of the file list. Files that are not in the
+# cache are processed by worker((files, output, config)), in a pool of processes when jobs > 1.
+# Without cache the files are grouped in shards of shardSize files, each shard giving one partial result.
+def runFiles(filenames, config, worker, tmpdir, cache=None, jobs=1, shardSize=1):
+    partials = [None] * len(filenames)
+    keys = {}
+    todo = []
+    for i, filename in enumerate(filenames):
+        if cache is not None:
+            keys[i] = cache.key(filename, config)
+            partials[i] = cache.load(keys[i])
+        if partials[i] is None:
+            todo.append(i)
+    if cache is not None:
+        cache.saveDigests()
+        # The results have to be stored file by file
+        shardSize = 1
+    shards = [todo[j:j + shardSize] for j in range(0, len(todo), shardSize)]
+    tasks = [([filenames[i] for i in shard], os.path.join(tmpdir, "part_{0:05d}.npz".format(shard[0])), config)
+             for shard in shards]
+    print("{0} files to process, {1} taken from the cache".format(len(todo), len(filenames) - len(todo)))
+
+    if jobs > 1 and len(tasks) > 1:
+        with multiprocessing.Pool(min(jobs, len(tasks))) as pool:
+            outputs = list(pool.imap(worker, tasks, chunksize=1))
+    else:
+        outputs = [worker(task) for task in tasks]
+
+    for shard, output in zip(shards, outputs):
+        partials[shard[0]] = output if cache is None else cache.store(keys[shard[0]], output)
+    return [partial for partial in partials if partial is not None]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["info", "clear"], help="Show the cache usage or invalidate the whole cache")
+    parser.add_argument("--cacheDir", type=str, required=True, help="Directory of the cache")
+    args = parser.parse_args()
+
+    cache = ResultCache(args.cacheDir)
+    if args.command == "clear":
+        cache.clear()
+        print("Cache {0} cleared".format(args.cacheDir))
+    else:
+        print("{0} entries, {1:.1f} MB".format(len(cache.entries()), cache.size() / 1024**2))
@@ -0,0 +1,411 @@
+#!/usr/bin/env python3
+"""
+Bounded-memory storage of the RMS values produced by NPZ.py.
+
+RmsWriter fills fixed-size preallocated chunks (int64 times in ns since the epoch, float32 RMS values)
+and appends them to a spool directory every time a chunk is full, so the memory used does not depend
+on the length of the dataset and an interrupted run keeps all the chunks already flushed.
+When the run finishes the spool is turned, chunk by chunk, into a .npz file.
+
+The .npz files use a versioned, pickle-free layout (FORMAT_VERSION):
+    format_version  file layout version
+    time            datetime64[ns] times of the frames, shape (frames,)
+    rms             float32 RMS values, shape (frames, antennas, channels)
+                    or (frames, bands, antennas, channels) for a multi-band run
+    antennas        antenna ids, channels: channel ids
+    bands           only for a multi-band run: (low, high) limits of the bands in MHz, shape (bands, 2)
+The members are stored uncompressed, so loadRms can memory map them and opening a file is almost free.
+Files written with the old layout (pickled datetime objects in time and one rms10 ... rms31 array per
+antenna and channel) are still read by loadRms.
+
+RmsDataset keeps the RMS values of a long archive partitioned by UTC day (one YYYY-MM-DD.npz file per day)
+with a sorted index of the days, so a time range query only opens the partitions it needs.
+
+An interrupted run can be turned into a .npz file, and RMS files added to a dataset, with:
+./RmsStore.py recover SPOOL_DIRECTORY --output OUTPUT_NAME.npz
+./RmsStore.py partition NPZ_FILE_NAMES --dataset DATASET_DIRECTORY
+"""
+
+import argparse
+import json
+import os
+import shutil
+import zipfile
+
+import numpy as np
+
+
+FORMAT_VERSION = 3  # 3: optional bands axis
+
+# Arrays of the layout used before FORMAT_VERSION 2
+RMS_KEYS = ["rms10", "rms11", "rms20", "rms21", "rms30", "rms31"]
+
+
+# Content of an RMS file. Without ids, antennas are numbered from 1 and channels from 0, as in the old rms10 ... rms31 names.
+# bands is None for a single-band file, else the (bands, 2) limits in MHz of the second axis of rms.
+class RmsData():
+
+    def __init__(self, time, rms, antennas=None, channels=None, version=FORMAT_VERSION, bands=None):
+        self.time = time
+        self.rms = rms
+        self.antennas = np.arange(1, rms.shape[-2] + 1) if antennas is None else antennas
+        self.channels = np.arange(rms.shape[-1]) if channels is None else channels
+        self.version = version
+        self.bands = bands
+
+    def __len__(self):
+        return len(self.time)
+
+    # Single-band data of the band with the given index (the data itself for a single-band file)
+    def band(self, index=0):
+        if self.bands is None:
+            if index != 0:
+                raise ValueError("Band {0} requested from single-band RMS data".format(index))
+            return self
+        return RmsData(self.time, self.rms[:, index], self.antennas, self.channels, self.version)
+
+
+# Writes an RMS file with the current layout
+def saveRms(output, time, rms, antennas=None, channels=None, bands=None):
+    data = RmsData(time, rms, antennas, channels)
+    members = {} if bands is None else {"bands": np.asarray(bands, dtype=float)}
+    np.savez(output,
+             format_version=np.int64(FORMAT_VERSION),
+             time=np.asarray(time, dtype="datetime64[ns]"),
+             rms=np.asarray(rms, dtype=np.float32),
+             antennas=np.asarray(data.antennas),
+             channels=np.asarray(data.channels),
+             **members)
+
+
+# Memory maps one member of an uncompressed .npz file
+def mmapNpyMember(filename, archive, name):
+    info = archive.getinfo(name + ".npy")
+    if info.compress_type != zipfile.ZIP_STORED:
+        raise ValueError("{0} in {1} is compressed and can not be memory mapped".format(name, filename))
+    with open(filename, "rb") as file:
+        # The local file header has its own copy of the name and extra field lengths
+        file.seek(info.header_offset + 26)
+        nameLength, extraLength = np.frombuffer(file.read(4), dtype="<u2")
+        file.seek(info.header_offset + 30 + int(nameLength) + int(extraLength))
+        version = np.lib.format.read_magic(file)
+        if version == (1, 0):
+            shape, fortran, dtype = np.lib.format.read_array_header_1_0(file)
+        else:
+            shape, fortran, dtype = np.lib.format.read_array_header_2_0(file)
+        offset = file.tell()
+    if np.prod(shape) == 0:
+        return np.empty(shape, dtype=dtype)
+    return np.memmap(filename, dtype=dtype, mode="r", offset=offset, shape=shape, order="F" if fortran else "C")
+
+
+# Loads an RMS file of any layout. Files with the current layout are memory mapped unless mmap is False,
+# old files are converted in memory.
+def loadRms(filename, mmap=True):
+    with np.load(filename) as data:
+        if "format_version" not in data.files:
+            return loadLegacyRms(filename)
+        version = int(data["format_version"])
+        if version > FORMAT_VERSION:
+            raise ValueError("{0} has format version {1}, newer than {2}".format(filename, version, FORMAT_VERSION))
+        antennas = data["antennas"]
+        channels = data["channels"]
+        bands = data["bands"] if "bands" in data.files else None
+        if not mmap:
+            return RmsData(data["time"], data["rms"], antennas, channels, version, bands)
+    with zipfile.ZipFile(filename) as archive:
+        time = mmapNpyMember(filename, archive, "time")
+        rms = mmapNpyMember(filename, archive, "rms")
+    return RmsData(time, rms, antennas, channels, version, bands)
+
+
+# Files of the first NPZ.py: one array per antenna and channel (rms10 ... rms31), and the times as an
+# object array of datetime, which can only be read with pickle
+def loadLegacyRms(filename):
+    with np.load(filename, allow_pickle=True) as data:
+        time = data["time"].astype("datetime64[ns]")
+        rms = np.stack([data[key] for key in RMS_KEYS], axis=-1).reshape(-1, 3, 2)
+    return RmsData(time, rms, version=1)
+
+
+# With bands (list of (low, high) limits in MHz), every frame has one RMS value per band, antenna and channel.
+# antennas and channels are the ids of the frames (FrameArray.antennas and channels), by default antennas are
+# numbered from 1 and channels from 0.
+class RmsWriter():
+
+    def __init__(self, output, nbAntennas=3, nbChannels=2, chunkSize=65536, bands=None, antennas=None, channels=None):
+        self.output = output
+        self.spool = output + ".spool"
+        self.chunkSize = chunkSize
+        if os.path.exists(self.spool):
+            raise IOError("{0} is left by an interrupted run, convert it with RmsStore.py or remove it".format(self.spool))
+        os.makedirs(self.spool)
+        antennas = list(range(1, nbAntennas + 1)) if antennas is None else [int(antenna) for antenna in antennas]
+        channels = list(range(nbChannels)) if channels is None else [int(channel) for channel in channels]
+        layout = {"antennas": antennas, "channels": channels}
+        shape = (len(antennas), len(channels))
+        if bands is not None:
+            layout["bands"] = [[float(low), float(high)] for low, high in bands]
+            shape = (len(bands),) + shape
+        with open(os.path.join(self.spool, "layout.json"), "w") as file:
+            json.dump(layout, file)
+        self.timeFile = open(os.path.join(self.spool, "time.i8"), "ab")
+        self.rmsFile = open(os.path.join(self.spool, "rms.f4"), "ab")
+
+        self.times = np.empty(chunkSize, dtype=np.int64)
+        self.rms = np.empty((chunkSize,) + shape, dtype=np.float32)
+        self.counts = 0
+
+    # time in ns since the epoch, rms with shape (antennas, channels), or (bands, antennas, channels)
+    def append(self, time, rms):
+        self.times[self.counts] = time
+        self.rms[self.counts] = rms
+        self.counts += 1
+        if self.counts == self.chunkSize:
+            self.flush()
+
+    def flush(self):
+        if self.counts == 0:
+            return
+        self.timeFile.write(self.times[:self.counts].tobytes())
+        self.rmsFile.write(self.rms[:self.counts].tobytes())
+        for file in (self.timeFile, self.rmsFile):
+            file.flush()
+            os.fsync(file.fileno())
+        self.counts = 0
+
+    # Writes the final .npz file and removes the spool
+    def close(self):
+        self.flush()
+        self.timeFile.close()
+        self.rmsFile.close()
+        writeNpz(self.spool, self.output, self.chunkSize)
+        shutil.rmtree(self.spool)
+
+
+# Memory maps the flushed chunks of a spool as RmsData, with RMS values of shape (frames, antennas, channels)
+# or (frames, bands, antennas, channels). A chunk only partially written by a crash is ignored.
+def readSpool(spool):
+    with open(os.path.join(spool, "layout.json")) as file:
+        layout = json.load(file)
+    antennas, channels = np.array(layout["antennas"]), np.array(layout["channels"])
+    shape = (len(antennas), len(channels))
+    bands = None
+    if "bands" in layout:
+        bands = np.array(layout["bands"], dtype=float).reshape(-1, 2)
+        shape = (len(bands),) + shape
+    timeName = os.path.join(spool, "time.i8")
+    rmsName = os.path.join(spool, "rms.f4")
+    counts = min(os.path.getsize(timeName) // 8, os.path.getsize(rmsName) // (4 * int(np.prod(shape))))
+    if counts == 0:
+        return RmsData(np.empty(0, dtype="datetime64[ns]"), np.empty((0,) + shape, dtype=np.float32), antennas, channels, bands=bands)
+    time = np.memmap(timeName, dtype=np.int64, mode="r", shape=(counts,)).view("datetime64[ns]")
+    rms = np.memmap(rmsName, dtype=np.float32, mode="r", shape=(counts,) + shape)
+    return RmsData(time, rms, antennas, channels, bands=bands)
+
+
+# Writes one array into an open .npz archive from an iterator of chunks, without holding it in memory
+def writeNpyMember(archive, name, dtype, shape, chunks):
+    header = {"descr": np.lib.format.dtype_to_descr(np.dtype(dtype)), "fortran_order": False, "shape": shape}
+    with archive.open(name + ".npy", "w", force_zip64=True) as member:
+        np.lib.format.write_array_header_2_0(member, header)
+        for chunk in chunks:
+            member.write(np.ascontiguousarray(chunk, dtype=dtype).tobytes())
+
+
+# Turns a spool into an RMS file with the current layout, chunk by chunk
+def writeNpz(spool, output, chunkSize=65536):
+    data = readSpool(spool)
+    time, rms = data.time, data.rms
+    steps = range(0, len(time), chunkSize)
+    members = [("format_version", np.int64(FORMAT_VERSION)), ("antennas", data.antennas), ("channels", data.channels)]
+    if data.bands is not None:
+        members.append(("bands", data.bands))
+    with zipfile.ZipFile(output, "w", compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+        for name, values in members:
+            writeNpyMember(archive, name, values.dtype, values.shape, [values])
+        writeNpyMember(archive, "time", time.dtype, time.shape, (time[i:i + chunkSize] for i in steps))
+        writeNpyMember(archive, "rms", rms.dtype, rms.shape, (rms[i:i + chunkSize] for i in steps))
+
+
+# Concatenates the partial results of the workers of NPZ.py, sorts them by RadioTaxiTime and writes one file
+# with the same layout as the serial output. The partials must have the same antennas, channels and bands.
+def mergeRms(partials, output):
+    data = [loadRms(partial) for partial in partials]
+    first = data[0]
+    for partial, part in zip(partials, data):
+        if not (np.array_equal(part.antennas, first.antennas) and np.array_equal(part.channels, first.channels)
+                and (part.bands is None) == (first.bands is None)
+                and (part.bands is None or np.array_equal(part.bands, first.bands))):
+            raise ValueError("{0} does not have the antennas, channels and bands of {1}".format(partial, partials[0]))
+    time = np.concatenate([part.time for part in data])
+    # Stable sort, so frames with the same time keep the order of the file list
+    order = np.argsort(time, kind="stable")
+    rms = np.concatenate([part.rms for part in data])
+    saveRms(output, time[order], rms[order], first.antennas, first.channels, first.bands)
+
+
+# RMS values partitioned by UTC day. index.npz holds the sorted days with the number of frames
+# and the first and last time of each partition.
+class RmsDataset():
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.indexName = os.path.join(directory, "index.npz")
+        self.index = {}
+        self.antennas = None
+        self.channels = None
+        self.bands = None
+        if os.path.exists(self.indexName):
+            with np.load(self.indexName) as index:
+                for day, counts, first, last in zip(index["days"], index["counts"], index["first"], index["last"]):
+                    self.index[day] = (counts, first, last)
+                self.antennas = index["antennas"]
+                self.channels = index["channels"]
+                self.bands = index["bands"] if "bands" in index.files else None
+
+    @property
+    def days(self):
+        return np.array(sorted(self.index), dtype="datetime64[D]")
+
+    def partitionName(self, day):
+        return os.path.join(self.directory, "{0}.npz".format(day))
+
+    # Adds RMS data to the dataset. Frames of days that are already in the dataset are merged with them,
+    # frames with the same time as a new one are replaced. Data without frames leaves the dataset unchanged.
+    def add(self, data):
+        if len(data.time) == 0:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        if self.index and (self.bands is None) != (data.bands is None):
+            raise ValueError("Single-band and multi-band RMS data can not be mixed in {0}".format(self.directory))
+        if self.index and not (np.array_equal(self.antennas, data.antennas) and np.array_equal(self.channels, data.channels)):
+            raise ValueError("RMS data of antennas {0} and channels {1} can not be added to {2}, which holds antennas {3} "
+                             "and channels {4}".format(list(data.antennas), list(data.channels), self.directory,
+                                                       list(self.antennas), list(self.channels)))
+        self.antennas, self.channels, self.bands = data.antennas, data.channels, data.bands
+        order = np.argsort(data.time, kind="stable")
+        time = np.asarray(data.time)[order]
+        dayKeys = time.astype("datetime64[D]")
+        bounds = np.flatnonzero(dayKeys[1:] != dayKeys[:-1]) + 1
+        for lo, hi in zip(np.r_[0, bounds], np.r_[bounds, len(time)]):
+            day = dayKeys[lo]
+            dayTime, dayRms = time[lo:hi], np.asarray(data.rms)[order[lo:hi]]
+            if day in self.index:
+                old = loadRms(self.partitionName(day), mmap=False)
+                keep = ~np.isin(old.time, dayTime)
+                dayTime = np.concatenate([old.time[keep], dayTime])
+                dayRms = np.concatenate([old.rms[keep], dayRms])
+                dayOrder = np.argsort(dayTime, kind="stable")
+                dayTime, dayRms = dayTime[dayOrder], dayRms[dayOrder]
+            # Written next to the partition and renamed, so an interrupted update leaves the old one
+            tmpName = self.partitionName(day) + ".tmp.npz"
+            saveRms(tmpName, dayTime, dayRms, self.antennas, self.channels, self.bands)
+            os.replace(tmpName, self.partitionName(day))
+            self.index[day] = (len(dayTime), dayTime[0], dayTime[-1])
+        self.writeIndex()
+
+    def writeIndex(self):
+        days = self.days
+        entries = [self.index[day] for day in days]
+        tmpName = self.indexName + ".tmp.npz"
+        members = {} if self.bands is None else {"bands": self.bands}
+        np.savez(tmpName,
+                 days=days,
+                 counts=np.array([entry[0] for entry in entries], dtype=np.int64),
+                 first=np.array([entry[1] for entry in entries], dtype="datetime64[ns]"),
+                 last=np.array([entry[2] for entry in entries], dtype="datetime64[ns]"),
+                 antennas=self.antennas,
+                 channels=self.channels,
+                 **members)
+        os.replace(tmpName, self.indexName)
+
+    # Slices (time, rms) of the partitions with start <= time < end, restricted to the given days if any,
+    # in time order. start and end can be anything accepted by np.datetime64 (e.g. "2023-04-05"), days a
+    # list of dates. Only the partitions of the requested days are opened.
+    def partitions(self, start=None, end=None, days=None):
+        selected = self.days
+        if days is not None:
+            selected = np.intersect1d(selected, np.asarray(days, dtype="datetime64[D]"))
+        if start is not None:
+            start = np.datetime64(start, "ns")
+            selected = selected[selected >= start.astype("datetime64[D]")]
+        if end is not None:
+            end = np.datetime64(end, "ns")
+            selected = selected[selected <= end.astype("datetime64[D]")]
+
+        for day in selected:
+            part = loadRms(self.partitionName(day))
+            lo = 0 if start is None else np.searchsorted(part.time, start, side="left")
+            hi = len(part) if end is None else np.searchsorted(part.time, end, side="left")
+            yield part.time[lo:hi], part.rms[lo:hi]
+
+    # RMS data with start <= time < end, restricted to the given days if any
+    def query(self, start=None, end=None, days=None):
+        times, rms = [], []
+        for partTime, partRms in self.partitions(start, end, days):
+            times.append(partTime)
+            rms.append(partRms)
+        if not times:
+            shape = (0, len(self.antennas), len(self.channels)) if self.antennas is not None else (0, 3, 2)
+            if self.bands is not None:
+                shape = shape[:1] + (len(self.bands),) + shape[1:]
+            return RmsData(np.empty(0, dtype="datetime64[ns]"), np.empty(shape, dtype=np.float32),
+                           self.antennas, self.channels, bands=self.bands)
+        return RmsData(np.concatenate(times), np.concatenate(rms), self.antennas, self.channels, bands=self.bands)
+
+
+# Loads RMS data from a file, or from a dataset directory restricted to a time range or a list of days
+def openRms(name, start=None, end=None, days=None):
+    if os.path.isdir(name):
+        return RmsDataset(name).query(start, end, days)
+    return loadRms(name)
+
+
+# Sorted unique days (datetime64[D]) of a list of days and of (first, last) ranges with both ends included
+def targetDays(days=(), ranges=()):
+    selected = [np.datetime64(day, "D") for day in days]
+    for first, last in ranges:
+        selected.extend(np.arange(np.datetime64(first, "D"), np.datetime64(last, "D") + 1))
+    return np.unique(np.asarray(selected, dtype="datetime64[D]"))
+
+
+# Indices of the frames whose UTC day is one of days
+def framesOfDays(time, days):
+    return np.flatnonzero(np.isin(np.asarray(time).astype("datetime64[D]"), np.asarray(days, dtype="datetime64[D]")))
+
+
+# Same rows as openRms, given in chunks of at most chunkSize frames read one at a time, so files and datasets
+# larger than the memory can be processed. Files are memory mapped, so only the current chunk is loaded.
+def iterRms(name, start=None, end=None, days=None, chunkSize=1 << 20):
+    if os.path.isdir(name):
+        dataset = RmsDataset(name)
+        parts = dataset.partitions(start, end, days)
+        antennas, channels, bands = dataset.antennas, dataset.channels, dataset.bands
+    else:
+        data = loadRms(name)
+        parts = [(data.time, data.rms)]
+        antennas, channels, bands = data.antennas, data.channels, data.bands
+    for time, rms in parts:
+        for lo in range(0, len(time), chunkSize):
+            yield RmsData(np.asarray(time[lo:lo + chunkSize]), np.asarray(rms[lo:lo + chunkSize]), antennas, channels,
+                          bands=bands)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    recover = subparsers.add_parser("recover", help="Turn the spool left by an interrupted run into a .npz file")
+    recover.add_argument("spool", type=str, help="Spool directory left by an interrupted run")
+    recover.add_argument("--output", type=str, required=True, help="Name of the output .npz file")
+    partition = subparsers.add_parser("partition", help="Add RMS files to a day-partitioned dataset")
+    partition.add_argument("input", type=str, nargs="+", help="List of .npz files")
+    partition.add_argument("--dataset", type=str, required=True, help="Directory of the dataset")
+    args = parser.parse_args()
+
+    if args.command == "recover":
+        writeNpz(args.spool, args.output)
+    else:
+        dataset = RmsDataset(args.dataset)
+        for filename in args.input:
+            dataset.add(loadRms(filename))
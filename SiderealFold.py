@@ -0,0 +1,133 @@
+"""
+Folding of the RMS values in local sidereal time (LST) at the station.
+
+The LST of the timestamps is computed with astropy in a single vectorized call, and cached per timestamp
+array (in memory, and on disk if a cache directory is given) so repeated runs do not pay astropy again.
+It is the only LST implementation, also used by the spectrograms of AverageFrames.py.
+LstFold accumulates the values of all the channels in LST bins: counts, sums and sums of squares for the
+mean and standard deviation, and a fixed-range histogram per bin for the median. All the accumulators are
+additive, so folds computed by different workers (or on different periods) can be merged.
+"""
+
+import hashlib
+import os
+
+import numpy as np
+
+
+# Approximate position of the prototype station at the Pierre Auger Observatory, Argentina
+STATION_LATITUDE = -35.2  # deg
+STATION_LONGITUDE = -69.3  # deg
+STATION_HEIGHT = 1400.  # m
+
+lstCache = {}
+
+
+# Local sidereal time in hours of an array of datetime64 times. With useCache=False the result is not kept
+# in memory (e.g. for the many small blocks of a stream, which are never asked again).
+def localSiderealTime(time, longitude=STATION_LONGITUDE, latitude=STATION_LATITUDE, height=STATION_HEIGHT,
+                      cacheDir=None, useCache=True):
+    time = np.asarray(time, dtype="datetime64[ns]")
+    sha = hashlib.sha1(time.view(np.int64).tobytes())
+    sha.update(repr((longitude, latitude, height)).encode())
+    key = sha.hexdigest()
+    if useCache and key in lstCache:
+        return lstCache[key]
+    cacheName = None if cacheDir is None else os.path.join(cacheDir, "lst_{0}.npy".format(key))
+    if cacheName is not None and os.path.exists(cacheName):
+        lst = np.load(cacheName)
+    else:
+        import astropy.units as u
+        from astropy.time import Time
+        from astropy.coordinates import EarthLocation
+        location = EarthLocation(lat=latitude*u.deg, lon=longitude*u.deg, height=height*u.m)
+        lst = Time(time, scale="utc", location=location).sidereal_time("mean").hour
+        if cacheName is not None:
+            os.makedirs(cacheDir, exist_ok=True)
+            np.save(cacheName, lst)
+    if useCache:
+        lstCache[key] = lst
+    return lst
+
+
+class LstFold():
+
+    def __init__(self, nbBins=96, nbChannels=6, valueRange=(0., 100.), nbValueBins=1000):
+        self.nbBins = nbBins
+        self.valueRange = valueRange
+        self.counts = np.zeros((nbBins, nbChannels), dtype=np.int64)
+        self.sums = np.zeros((nbBins, nbChannels))
+        self.sums2 = np.zeros((nbBins, nbChannels))
+        # Values outside valueRange are counted in the first or last bin
+        self.histogram = np.zeros((nbBins, nbChannels, nbValueBins), dtype=np.int64)
+
+    @property
+    def binCenters(self):
+        return (np.arange(self.nbBins) + 0.5) * 24. / self.nbBins
+
+    # lst: hours, shape (samples,); rms: shape (samples, channels). Non finite values are skipped.
+    def add(self, lst, rms):
+        rms = np.asarray(rms, dtype=float)
+        nbBins, nbChannels, nbValueBins = self.histogram.shape
+        lstBin = (np.floor(np.asarray(lst) / 24. * nbBins).astype(np.int64) % nbBins)[:, np.newaxis]
+        cell = lstBin * nbChannels + np.arange(nbChannels)
+        valid = np.isfinite(rms)
+        cell, values = cell[valid], rms[valid]
+
+        size = nbBins * nbChannels
+        self.counts += np.bincount(cell, minlength=size).reshape(nbBins, nbChannels)
+        self.sums += np.bincount(cell, weights=values, minlength=size).reshape(nbBins, nbChannels)
+        self.sums2 += np.bincount(cell, weights=values**2, minlength=size).reshape(nbBins, nbChannels)
+        low, high = self.valueRange
+        valueBin = np.clip(((values - low) / (high - low) * nbValueBins).astype(np.int64), 0, nbValueBins - 1)
+        self.histogram += np.bincount(cell * nbValueBins + valueBin,
+                                      minlength=size * nbValueBins).reshape(self.histogram.shape)
+
+    def merge(self, other):
+        if self.histogram.shape != other.histogram.shape or tuple(self.valueRange) != tuple(other.valueRange):
+            raise ValueError("Only folds with the same binning can be merged")
+        self.counts += other.counts
+        self.sums += other.sums
+        self.sums2 += other.sums2
+        self.histogram += other.histogram
+
+    @property
+    def mean(self):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return self.sums / self.counts
+
+    @property
+    def std(self):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.sqrt(np.maximum(self.sums2 / self.counts - self.mean**2, 0))
+
+    # Median from the histograms, interpolated linearly inside the value bin
+    @property
+    def median(self):
+        low, high = self.valueRange
+        width = (high - low) / self.histogram.shape[-1]
+        cumulative = np.cumsum(self.histogram, axis=-1)
+        half = self.counts[..., np.newaxis] / 2.
+        index = np.minimum(np.sum(cumulative < half, axis=-1), self.histogram.shape[-1] - 1)
+        below = np.take_along_axis(cumulative, index[..., np.newaxis], axis=-1)[..., 0] \
+            - np.take_along_axis(self.histogram, index[..., np.newaxis], axis=-1)[..., 0]
+        inBin = np.take_along_axis(self.histogram, index[..., np.newaxis], axis=-1)[..., 0]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            median = low + width * (index + (half[..., 0] - below) / inBin)
+        return np.where(self.counts > 0, median, np.nan)
+
+    def save(self, output):
+        np.savez(output, counts=self.counts, sums=self.sums, sums2=self.sums2, histogram=self.histogram,
+                 valueRange=np.asarray(self.valueRange), lst=self.binCenters,
+                 mean=self.mean, std=self.std, median=self.median)
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as data:
+            nbBins, nbChannels, nbValueBins = data["histogram"].shape
+            fold = cls(nbBins, nbChannels, tuple(data["valueRange"]), nbValueBins)
+            fold.counts[:] = data["counts"]
+            fold.sums[:] = data["sums"]
+            fold.sums2[:] = data["sums2"]
+            fold.histogram[:] = data["histogram"]
+        return fold
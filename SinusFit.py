@@ -0,0 +1,324 @@
+"""
+Linear least squares fit of the sidereal and solar modulation of the noise.
+
+With fixed frequencies the model A1*sin(w_sid*t + phi1) + A2*sin(w_sol*t + phi2) + B is linear in the
+sin/cos coefficients: a*sin(w*t) + b*cos(w*t) with A = sqrt(a^2 + b^2) and phi = arctan2(b, a).
+It is solved exactly, for all the channels at once, instead of iterating with curve_fit.
+"""
+
+from statistics import NormalDist
+
+import numpy as np
+
+
+SIDEREAL_FREQUENCY = 0.00001160576  # sidereal frequency = 1/{(23h*60min*60s)+(56min*60s)+4,0916s}
+SOLAR_FREQUENCY = 0.00001157407  # solar frequency = 1/(24h*60min*60s)
+FREQUENCIES = (SIDEREAL_FREQUENCY, SOLAR_FREQUENCY)
+DAY = 86400.
+
+
+# Seconds since the epoch of an array of datetime64 (or of a pandas Series of times)
+def toSeconds(time):
+    return np.asarray(time, dtype="datetime64[ns]").astype(np.int64) / 1e9
+
+
+# Regressors of the model, shape (samples, 5): sin and cos of each frequency, then the constant
+def designMatrix(t, freqs=FREQUENCIES):
+    t = np.asarray(t, dtype=float)
+    columns = []
+    for freq in freqs:
+        phase = 2 * np.pi * freq * t
+        columns += [np.sin(phase), np.cos(phase)]
+    columns.append(np.ones_like(t))
+    return np.stack(columns, axis=-1)
+
+
+# Amplitude and phase, with their errors, of a*sin + b*cos from the covariance of (a, b)
+def toPolar(a, b, varA, varB, covAB):
+    amp = np.hypot(a, b)
+    phase = np.arctan2(b, a)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ampErr = np.sqrt((a**2 * varA + b**2 * varB + 2 * a * b * covAB) / amp**2)
+        phaseErr = np.sqrt((b**2 * varA + a**2 * varB - 2 * a * b * covAB) / amp**4)
+    return amp, phase, ampErr, phaseErr
+
+
+# Parameters of the fit of every channel. coef has shape (5, channels) and cov (5, 5, channels),
+# the covariance is scaled by the residual variance as the pcov of curve_fit.
+class SinusFit():
+
+    def __init__(self, coef, XtXinv, rss, n, freqs=FREQUENCIES):
+        self.coef = coef
+        self.freqs = freqs
+        self.n = n
+        self.mse = rss / n
+        self.cov = XtXinv[:, :, np.newaxis] * (rss / max(n - len(coef), 1))
+
+        cov = self.cov
+        self.amp, self.phase, self.ampErr, self.phaseErr = toPolar(
+            coef[0], coef[1], cov[0, 0], cov[1, 1], cov[0, 1])
+        self.amp2, self.phase2, self.amp2Err, self.phase2Err = toPolar(
+            coef[2], coef[3], cov[2, 2], cov[3, 3], cov[2, 3])
+        self.mean = coef[4]
+        self.meanErr = np.sqrt(cov[4, 4])
+
+    # Fitted curve at the times t (seconds), shape (samples, channels)
+    def evaluate(self, t):
+        return designMatrix(t, self.freqs) @ self.coef
+
+    def printParameters(self, ich=0):
+        print("Estimated Parameters:")
+        print("Amplitude 1: {0} +/- {1}".format(self.amp[ich], self.ampErr[ich]))
+        print("Phase 1: {0} +/- {1}".format(self.phase[ich], self.phaseErr[ich]))
+        print("Mean: {0} +/- {1}".format(self.mean[ich], self.meanErr[ich]))
+        print("Amplitude 2: {0} +/- {1}".format(self.amp2[ich], self.amp2Err[ich]))
+        print("Phase 2: {0} +/- {1}".format(self.phase2[ich], self.phase2Err[ich]))
+
+    def save(self, output):
+        names = ["amp", "phase", "amp2", "phase2", "mean", "ampErr", "phaseErr", "amp2Err", "phase2Err", "meanErr", "mse"]
+        np.savez(output, coef=self.coef, cov=self.cov, n=self.n, freqs=np.asarray(self.freqs),
+                 **{name: getattr(self, name) for name in names})
+
+
+# Fits all the channels in one solve. t: seconds, shape (samples,); rms: shape (samples, channels).
+# Samples where a channel is not finite (e.g. the start of a moving average) are left out for all channels.
+def fitSinus(t, rms, freqs=FREQUENCIES):
+    t = np.asarray(t, dtype=float)
+    rms = np.asarray(rms, dtype=float)
+    if rms.ndim == 1:
+        rms = rms[:, np.newaxis]
+    valid = np.all(np.isfinite(rms), axis=1)
+    X = designMatrix(t[valid], freqs)
+    Y = rms[valid]
+    coef = np.linalg.lstsq(X, Y, rcond=None)[0]
+    rss = np.sum((Y - X @ coef)**2, axis=0)
+    return SinusFit(coef, np.linalg.pinv(X.T @ X), rss, len(Y), freqs)
+
+
+# Sums of the normal equations (X^T X, X^T Y, Y^T Y and the number of samples) of the model.
+# Samples can be added and removed, which gives sliding windows and chunked fits without keeping the data.
+class NormalEquations():
+
+    def __init__(self, nbChannels, freqs=FREQUENCIES):
+        nbParams = 2 * len(freqs) + 1
+        self.freqs = freqs
+        self.XtX = np.zeros((nbParams, nbParams))
+        self.XtY = np.zeros((nbParams, nbChannels))
+        self.YtY = np.zeros(nbChannels)
+        self.n = 0
+
+    # t: seconds, shape (samples,); rms: shape (samples, channels). sign=-1 removes the samples.
+    def add(self, t, rms, sign=1):
+        X = designMatrix(t, self.freqs)
+        Y = np.asarray(rms, dtype=float)
+        self.XtX += sign * (X.T @ X)
+        self.XtY += sign * (X.T @ Y)
+        self.YtY += sign * np.sum(Y**2, axis=0)
+        self.n += sign * len(Y)
+
+    def remove(self, t, rms):
+        self.add(t, rms, sign=-1)
+
+    def merge(self, other):
+        self.XtX += other.XtX
+        self.XtY += other.XtY
+        self.YtY += other.YtY
+        self.n += other.n
+
+    # Sums of the same samples with the constant offset (channels,) subtracted from the values.
+    # The last regressor is the constant, so X^T 1 is the last column of X^T X.
+    def subtract(self, offset):
+        offset = np.asarray(offset, dtype=float)
+        self.YtY += -2 * offset * self.XtY[-1] + self.n * offset**2
+        self.XtY -= np.outer(self.XtX[:, -1], offset)
+
+    def solve(self):
+        XtXinv = np.linalg.pinv(self.XtX)
+        coef = XtXinv @ self.XtY
+        # Residual sum of squares from the sums, since X^T X coef = X^T Y
+        rss = np.maximum(self.YtY - np.sum(coef * self.XtY, axis=0), 0)
+        return SinusFit(coef, XtXinv, rss, self.n, self.freqs)
+
+
+# Time series of the fitted parameters in sliding windows, one row per window step and one column per channel
+class SinusTrack():
+
+    def __init__(self, time, counts, nbChannels):
+        self.time = time
+        self.n = counts
+        names = ["amp", "phase", "amp2", "phase2", "mean", "ampErr", "phaseErr", "amp2Err", "phase2Err", "meanErr", "mse"]
+        for name in names:
+            setattr(self, name, np.full((len(time), nbChannels), np.nan))
+        self.names = names
+
+    def store(self, step, fit):
+        for name in self.names:
+            getattr(self, name)[step] = getattr(fit, name)
+
+    def save(self, output):
+        np.savez(output, time=self.time, n=self.n, **{name: getattr(self, name) for name in self.names})
+
+
+# Fits every window [end - window, end) with end moving by step (both in seconds) over the whole data.
+# Each sample enters and leaves the normal equation sums once, so the cost is linear in the number of
+# samples. The sums are recomputed every refresh steps to avoid the accumulation of rounding errors.
+# Windows with less than minSamples samples are left as NaN. The time of a step is the window center.
+def trackSinus(t, rms, window, step, freqs=FREQUENCIES, minSamples=50, refresh=1000):
+    t = np.asarray(t, dtype=float)
+    rms = np.asarray(rms, dtype=float)
+    if rms.ndim == 1:
+        rms = rms[:, np.newaxis]
+    valid = np.all(np.isfinite(rms), axis=1)
+    order = np.argsort(t[valid], kind="stable")
+    t, rms = t[valid][order], rms[valid][order]
+
+    ends = np.arange(t[0] + window, t[-1] + step, step) if len(t) else np.empty(0)
+    his = np.searchsorted(t, ends, side="left")
+    los = np.searchsorted(t, ends - window, side="left")
+    track = SinusTrack(ends - window / 2, his - los, rms.shape[1])
+
+    equations = NormalEquations(rms.shape[1], freqs)
+    lo = hi = 0
+    for k in range(len(ends)):
+        if k % refresh == 0:
+            equations = NormalEquations(rms.shape[1], freqs)
+            lo = hi = los[k]
+        equations.add(t[hi:his[k]], rms[hi:his[k]])
+        equations.remove(t[lo:los[k]], rms[lo:los[k]])
+        lo, hi = los[k], his[k]
+        if equations.n >= minSamples:
+            track.store(k, equations.solve())
+    return track
+
+
+# Sums of the normal equations of every UTC day (t in seconds since the epoch).
+# Returns the days and the arrays XtX (days, 5, 5), XtY (days, 5, channels), YtY (days, channels) and n (days,).
+def dailyNormalEquations(t, rms, freqs=FREQUENCIES):
+    t = np.asarray(t, dtype=float)
+    rms = np.asarray(rms, dtype=float)
+    if rms.ndim == 1:
+        rms = rms[:, np.newaxis]
+    valid = np.all(np.isfinite(rms), axis=1)
+    order = np.argsort(t[valid], kind="stable")
+    t, rms = t[valid][order], rms[valid][order]
+    dayKeys = np.floor(t / DAY)
+    days, starts = np.unique(dayKeys, return_index=True)
+    sums = []
+    for lo, hi in zip(starts, np.r_[starts[1:], len(t)]):
+        equations = NormalEquations(rms.shape[1], freqs)
+        equations.add(t[lo:hi], rms[lo:hi])
+        sums.append(equations)
+    return (days, np.array([eq.XtX for eq in sums]), np.array([eq.XtY for eq in sums]),
+            np.array([eq.YtY for eq in sums]), np.array([eq.n for eq in sums]))
+
+
+# Amplitudes, phases and mean of a batch of coefficients with shape (replicas, 5, channels)
+def sinusParameters(coef):
+    return {"amp": np.hypot(coef[:, 0], coef[:, 1]), "phase": np.arctan2(coef[:, 1], coef[:, 0]),
+            "amp2": np.hypot(coef[:, 2], coef[:, 3]), "phase2": np.arctan2(coef[:, 3], coef[:, 2]),
+            "mean": coef[:, 4]}
+
+
+# Day sums shared with the workers of the process pool
+dailySums = None
+
+
+def setDailySums(sums):
+    global dailySums
+    dailySums = sums
+
+
+# Fits of a batch of replicas, each one given by the weights of the days (replicas, days)
+def fitReplicas(weights):
+    days, XtX, XtY, YtY, n = dailySums
+    coef = np.linalg.solve(np.einsum("rd,dij->rij", weights, XtX), np.einsum("rd,dij->rij", weights, XtY))
+    return sinusParameters(coef)
+
+
+# Day-block bootstrap replicas: every replica draws the days with replacement
+def bootstrapBatch(task):
+    seed, size = task
+    nbDays = len(dailySums[0])
+    rng = np.random.default_rng(seed)
+    return fitReplicas(rng.multinomial(nbDays, np.full(nbDays, 1. / nbDays), size=size).astype(float))
+
+
+# Leave-one-day-out jackknife replicas for the days first ... last-1
+def jackknifeBatch(task):
+    first, last = task
+    nbDays = len(dailySums[0])
+    weights = np.ones((last - first, nbDays))
+    weights[np.arange(last - first), np.arange(first, last)] = 0
+    return fitReplicas(weights)
+
+
+# Replicas of the fitted parameters, each with shape (replicas, channels), and the fit of the full data
+class SinusResampling():
+
+    def __init__(self, method, replicas, fit):
+        self.method = method
+        self.replicas = replicas
+        self.fit = fit
+
+    # Replicas of a parameter; phases are unwrapped around the phase of the full fit
+    def values(self, name):
+        values = self.replicas[name]
+        if name.startswith("phase"):
+            center = getattr(self.fit, name)
+            values = center + np.angle(np.exp(1j * (values - center)))
+        return values
+
+    def standardError(self, name):
+        values = self.values(name)
+        if self.method == "jackknife":
+            nbDays = len(values)
+            return np.sqrt((nbDays - 1) / nbDays * np.sum((values - values.mean(axis=0))**2, axis=0))
+        return np.std(values, axis=0, ddof=1)
+
+    # Interval of a parameter at the confidence level: percentiles of the bootstrap replicas,
+    # or the full fit +/- z * standard error for the jackknife
+    def interval(self, name, level=0.95):
+        if self.method == "jackknife":
+            z = NormalDist().inv_cdf(0.5 + level / 2)
+            center = getattr(self.fit, name)
+            return center - z * self.standardError(name), center + z * self.standardError(name)
+        values = self.values(name)
+        return tuple(np.percentile(values, [50 * (1 - level), 50 * (1 + level)], axis=0))
+
+    def save(self, output):
+        np.savez(output, method=self.method, **{name: self.values(name) for name in self.replicas})
+
+
+# Day-block bootstrap or leave-one-day-out jackknife of the sinus fit. Days are resampled as blocks, so the
+# correlation between the samples of a day (e.g. from a moving average) is kept in every replica.
+# The replicas are solved in batches of batchSize, spread over a pool of jobs processes.
+def resampleSinus(t, rms, method="bootstrap", replicas=1000, jobs=1, seed=0, batchSize=250, freqs=FREQUENCIES):
+    import multiprocessing
+
+    if method == "bootstrap" and replicas < 1:
+        raise ValueError("The bootstrap needs at least one replica, not {0}".format(replicas))
+    sums = dailyNormalEquations(t, rms, freqs)
+    days, XtX, XtY, YtY, n = sums
+    full = NormalEquations(XtY.shape[-1], freqs)
+    full.XtX, full.XtY, full.YtY, full.n = XtX.sum(axis=0), XtY.sum(axis=0), YtY.sum(axis=0), n.sum()
+
+    if method == "jackknife":
+        if len(days) < 2:
+            raise ValueError("The jackknife needs at least two days of data, not {0}".format(len(days)))
+        worker = jackknifeBatch
+        tasks = [(first, min(first + batchSize, len(days))) for first in range(0, len(days), batchSize)]
+    elif method == "bootstrap":
+        worker = bootstrapBatch
+        seeds = np.random.SeedSequence(seed).spawn(int(np.ceil(replicas / batchSize)))
+        tasks = [(seeds[i], min(batchSize, replicas - i * batchSize)) for i in range(len(seeds))]
+    else:
+        raise ValueError("Unknown resampling method {0}".format(method))
+
+    if jobs > 1 and len(tasks) > 1:
+        with multiprocessing.Pool(min(jobs, len(tasks)), initializer=setDailySums, initargs=(sums,)) as pool:
+            batches = pool.map(worker, tasks)
+    else:
+        setDailySums(sums)
+        batches = [worker(task) for task in tasks]
+    values = {name: np.concatenate([batch[name] for batch in batches]) for name in batches[0]}
+    return SinusResampling(method, values, full.solve())
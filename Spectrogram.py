@@ -0,0 +1,162 @@
+"""
+Time-resolved average spectrum (dynamic spectrum) of the frames of AverageFrames.py.
+
+Spectrogram accumulates the dBm/Hz spectra of every antenna and channel in a preallocated array of shape
+(time bins, antennas, channels, frequency bins). The bins are either fixed intervals of UTC time between
+a start and an end, or bins of local sidereal time at the station. The mean and the variance of every
+cell are updated online with Welford's algorithm, so no spectrum is kept after it has been added and the
+memory only depends on the binning. The frames are buffered in blocks of blockSize, so the bins of a block
+are computed at once (one astropy call for the sidereal times, as in SiderealFold.py). Accumulators with the
+same binning (other files, other workers) are merged with the parallel version of the update. The result
+is written as float32 arrays in a .npz file.
+"""
+
+import numpy as np
+
+from SiderealFold import localSiderealTime
+
+
+class Spectrogram():
+
+    # mode "time": nbBins = (end - start) / binWidth bins of UTC time, binWidth a pandas-like span ("1h")
+    # or a np.timedelta64. mode "lst": nbBins bins of local sidereal time over 24 h.
+    def __init__(self, shape, mode="lst", nbBins=96, start=None, end=None, binWidth=None, blockSize=1024):
+        self.mode = mode
+        if mode == "time":
+            self.start = np.datetime64(start, "ns")
+            self.binWidth = toTimedelta(binWidth)
+            nbBins = int(np.ceil((np.datetime64(end, "ns") - self.start) / self.binWidth))
+        elif mode == "lst":
+            self.start = None
+            self.binWidth = None
+        else:
+            raise ValueError("Unknown spectrogram mode {0}".format(mode))
+        self.counts = np.zeros((nbBins,) + tuple(shape), dtype=np.int32)
+        self.mean = np.zeros((nbBins,) + tuple(shape))
+        self.M2 = np.zeros((nbBins,) + tuple(shape))
+        self.outside = 0  # Frames outside the time range
+
+        # Frames not yet added to the statistics
+        self.blockSize = blockSize
+        self.times = []
+        self.spectra = []
+
+    @property
+    def nbBins(self):
+        return self.counts.shape[0]
+
+    # Bins of an array of times (datetime64 or int64 ns since the epoch), -1 for the times outside the range
+    def timeBins(self, time):
+        time = np.asarray(time).astype("datetime64[ns]")
+        if self.mode == "lst":
+            lst = localSiderealTime(time, useCache=False)
+            return (lst / 24. * self.nbBins).astype(np.int64) % self.nbBins
+        index = (time - self.start) // self.binWidth
+        return np.where((index >= 0) & (index < self.nbBins), index, -1)
+
+    # Adds the spectrum (antennas, channels, frequency bins) of one frame. Non finite values (e.g. the
+    # dBm/Hz of an empty bin) are skipped.
+    def add(self, time, spectrum):
+        self.times.append(np.datetime64(time, "ns"))
+        self.spectra.append(np.array(spectrum))
+        if len(self.times) == self.blockSize:
+            self.flush()
+
+    # Adds the buffered frames to the statistics
+    def flush(self):
+        if not self.times:
+            return
+        for index, spectrum in zip(self.timeBins(np.array(self.times)), self.spectra):
+            self.update(index, spectrum)
+        self.times = []
+        self.spectra = []
+
+    def update(self, index, spectrum):
+        if index < 0:
+            self.outside += 1
+            return
+        valid = np.isfinite(spectrum)
+        spectrum = np.where(valid, spectrum, 0.)
+        counts, mean, M2 = self.counts[index], self.mean[index], self.M2[index]
+        counts += valid
+        delta = np.where(valid, spectrum - mean, 0.)
+        mean += delta / np.maximum(counts, 1)
+        M2 += delta * (spectrum - mean)
+
+    # Combines the statistics of another accumulator with the same binning (Chan et al. parallel update)
+    def merge(self, other):
+        if self.counts.shape != other.counts.shape or self.mode != other.mode \
+                or self.start != other.start or self.binWidth != other.binWidth:
+            raise ValueError("Only spectrograms with the same binning can be merged")
+        self.flush()
+        other.flush()
+        total = self.counts + other.counts
+        delta = other.mean - self.mean
+        with np.errstate(invalid="ignore", divide="ignore"):
+            weight = np.where(total > 0, other.counts / total, 0.)
+        self.mean += delta * weight
+        self.M2 += other.M2 + delta**2 * self.counts * weight
+        self.counts = total
+        self.outside += other.outside
+
+    @property
+    def variance(self):
+        self.flush()
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(self.counts > 1, self.M2 / (self.counts - 1), np.nan)
+
+    # Centers of the bins: hours of LST, or datetime64 times
+    @property
+    def binCenters(self):
+        if self.mode == "lst":
+            return (np.arange(self.nbBins) + 0.5) * 24. / self.nbBins
+        return self.start + self.binWidth * np.arange(self.nbBins) + self.binWidth // 2
+
+    def save(self, output, freqs=None):
+        self.flush()
+        mean = np.where(self.counts > 0, self.mean, np.nan)
+        np.savez(output, mode=self.mode, bins=self.binCenters, counts=self.counts,
+                 mean=mean.astype(np.float32), std=np.sqrt(self.variance).astype(np.float32),
+                 M2=self.M2, outside=self.outside,
+                 freqs=np.empty(0) if freqs is None else np.asarray(freqs))
+
+
+# np.timedelta64 of a span given as "1h", "15min", "1D" ... or as a timedelta64
+def toTimedelta(span):
+    if isinstance(span, np.timedelta64):
+        return span.astype("timedelta64[ns]")
+    import pandas as pd
+    return pd.Timedelta(span).to_timedelta64()
+
+
+# Waterfall of the mean spectrum of every antenna and channel: bins along x, frequency along y
+def plotWaterfall(spectrogram, freqs, plot_filename="spectrogram.png"):
+    import matplotlib.pyplot as plt
+
+    spectrogram.flush()
+    nbAntennas, nbChannels = spectrogram.counts.shape[1:3]
+    mean = np.where(spectrogram.counts > 0, spectrogram.mean, np.nan)
+    fig, axes = plt.subplots(figsize=[20, 15], nrows=nbAntennas, ncols=nbChannels, sharex=True, sharey=True,
+                             squeeze=False)
+    if spectrogram.mode == "lst":
+        extent = [0, 24, freqs[0], freqs[-1]]
+        xlabel = "Local sidereal time [h]"
+    else:
+        import matplotlib.dates
+        first = spectrogram.start.astype("datetime64[s]").astype(object)
+        last = (spectrogram.start + spectrogram.binWidth * spectrogram.nbBins).astype("datetime64[s]").astype(object)
+        extent = [matplotlib.dates.date2num(first), matplotlib.dates.date2num(last), freqs[0], freqs[-1]]
+        xlabel = "Time"
+    for iant in range(nbAntennas):
+        for ich in range(nbChannels):
+            ax = axes[iant, ich]
+            image = ax.imshow(mean[:, iant, ich].T, origin="lower", aspect="auto", extent=extent, interpolation="nearest")
+            fig.colorbar(image, ax=ax, label="Spectral power [dBm/Hz]")
+            ax.set_title(f"Antenna {iant+1}, Channel {ich+1}")
+            ax.set_ylabel("Frequency [MHz]")
+            if spectrogram.mode == "time":
+                ax.xaxis_date()
+    for ax in axes[-1]:
+        ax.set_xlabel(xlabel)
+    plt.tight_layout()
+    fig.savefig(plot_filename)
@@ -9,27 +9,14 @@ import numpy as np
 import sys
 import argparse
 
-# Input i3 file with the data 
-parser = argparse.ArgumentParser()
-parser.add_argument("input", type=str, nargs="+", default=[], help="List of i3 files")
-args = parser.parse_args()
+from FrameCatalog import writeTimes
 
-filename = args.input
 
-tray = I3Tray()
-
-tray.AddModule("I3Reader", "reader",
-         FilenameList = filename)
- 
 # Choosing soft trigger data 
 def select_soft(frame):
     trigger_info = frame['SurfaceFilters']
     return trigger_info["soft_flag"].condition_passed
 
-# add module to the tray
-tray.Add(select_soft, "select_soft",
-         streams=[icetray.I3Frame.DAQ])
-
 # Module that saves the Taxi_time data 
 class TaxiTimeData(icetray.I3Module):
     
@@ -41,10 +28,12 @@ class TaxiTimeData(icetray.I3Module):
     self.inputName = ""
     self.timeValues = [] # Array to store SNR values
     self.AddParameter("InputName", "Input antenna data map", self.inputName)
+    self.AddParameter("Output", "Name of the output text file", "time_values.txt")
    
 # The configure retrieves the user-defined parameter value for inputName using GetParameter() and assigns it to the corresponding class attribute.
   def Configure(self):
     self.inputName = self.GetParameter("InputName")
+    self.output = self.GetParameter("Output")
   
 # to get information from the Q frames you would do so in the DAQ class function
   def DAQ(self, frame):
@@ -55,9 +44,34 @@ class TaxiTimeData(icetray.I3Module):
 # save all the time values in a txt file
   def Finish(self):
         time_values = [str(time) for time in self.timeValues]
-        with open('time_values.txt', 'w') as file:
+        with open(self.output, 'w') as file:
             file.write('\n'.join(time_values))    
-    
-tray.AddModule(TaxiTimeData, "Savingtimevalues", InputName="RadioTaxiTime")
 
-tray.Execute() 
+
+if __name__ == "__main__":
+    # Input i3 file with the data 
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input", type=str, nargs="+", default=[], help="List of i3 files")
+    parser.add_argument("--catalog", action="store_true", help="Read the times from the frame catalogs (built if missing) instead of the frames")
+    parser.add_argument("--output", type=str, default="time_values.txt", help="Name of the output text file")
+    args = parser.parse_args()
+
+    filename = args.input
+
+    # The catalogs hold the times of the soft trigger frames, the waveforms are never read
+    if args.catalog:
+        writeTimes(filename, args.output, soft=True, traceLength=None)
+        sys.exit()
+
+    tray = I3Tray()
+
+    tray.AddModule("I3Reader", "reader",
+             FilenameList = filename)
+
+    # add module to the tray
+    tray.Add(select_soft, "select_soft",
+             streams=[icetray.I3Frame.DAQ])
+
+    tray.AddModule(TaxiTimeData, "Savingtimevalues", InputName="RadioTaxiTime", Output=args.output)
+
+    tray.Execute()
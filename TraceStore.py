@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+Memory-mappable store of the filtered traces of NPZ.py, to rerun the noise statistics without IceTray.
+
+TraceWriter appends the filtered time series of every frame, as float32 blocks of shape (antennas, channels,
+samples), to a store directory in fixed-size chunks, together with the int64 times (ns since the epoch):
+    layout.json     antennas and channels ids, number of samples and binning in ns
+    time.i8         times of the frames, shape (frames,)
+    traces.f4       filtered traces, shape (frames, antennas, channels, samples)
+loadTraces memory maps the two arrays, so a statistic pass over the store reads it in chunks at disk speed.
+The subtraces RMS (any subtrace length, number of kept subtraces, mean or median) and the noise histograms are
+then computed from the store instead of running the median and bandpass filters again. The values are the
+float32 traces, so they agree with a full run to about 1e-6 relative.
+
+Run with command:
+./NPZ.py I3_FILE_NAMES --traceStore TRACE_STORE
+./TraceStore.py rms TRACE_STORE --lengthSubTraces 128 --keepSubTraces 5 --statistic median --output OUTPUT_NAME.npz
+./TraceStore.py histograms TRACE_STORE --output histograms.npz
+"""
+
+import argparse
+import json
+import os
+
+import numpy as np
+
+from NoiseHistogram import NoiseHistogram, QuantileSketch, saveHistograms
+from NoiseTools import cutTraces, traceRms
+from RmsStore import saveRms
+
+
+# Statistics of the kept subtraces RMS values of a trace
+STATISTICS = {"mean": np.mean, "median": np.median}
+
+
+class TraceWriter():
+
+    # antennas and channels are the ids of the frames (FrameArray.antennas and channels), by default antennas
+    # are numbered from 1 and channels from 0
+    def __init__(self, directory, nbAntennas=3, nbChannels=2, nbSamples=1024, binning=None, chunkSize=1024,
+                 antennas=None, channels=None):
+        self.directory = directory
+        self.chunkSize = chunkSize
+        if os.path.exists(os.path.join(directory, "layout.json")):
+            raise IOError("{0} already holds a trace store, remove it first".format(directory))
+        os.makedirs(directory, exist_ok=True)
+        antennas = list(range(1, nbAntennas + 1)) if antennas is None else [int(antenna) for antenna in antennas]
+        channels = list(range(nbChannels)) if channels is None else [int(channel) for channel in channels]
+        layout = {"antennas": antennas, "channels": channels,
+                  "samples": nbSamples, "binning": None if binning is None else float(binning)}
+        with open(os.path.join(directory, "layout.json"), "w") as file:
+            json.dump(layout, file)
+        self.timeFile = open(os.path.join(directory, "time.i8"), "ab")
+        self.traceFile = open(os.path.join(directory, "traces.f4"), "ab")
+
+        self.times = np.empty(chunkSize, dtype=np.int64)
+        self.traces = np.empty((chunkSize, len(antennas), len(channels), nbSamples), dtype=np.float32)
+        self.counts = 0
+
+    # time in ns since the epoch, traces with shape (antennas, channels, samples)
+    def append(self, time, traces):
+        self.times[self.counts] = time
+        self.traces[self.counts] = traces
+        self.counts += 1
+        if self.counts == self.chunkSize:
+            self.flush()
+
+    def flush(self):
+        if self.counts == 0:
+            return
+        # The traces go first, so a time is never written without its traces
+        self.traceFile.write(self.traces[:self.counts].tobytes())
+        self.timeFile.write(self.times[:self.counts].tobytes())
+        for file in (self.traceFile, self.timeFile):
+            file.flush()
+            os.fsync(file.fileno())
+        self.counts = 0
+
+    def close(self):
+        self.flush()
+        self.timeFile.close()
+        self.traceFile.close()
+
+
+# Content of a trace store: times (datetime64[ns]) and memory-mapped float32 traces
+class TraceData():
+
+    def __init__(self, time, traces, antennas, channels, binning):
+        self.time = time
+        self.traces = traces
+        self.antennas = antennas
+        self.channels = channels
+        self.binning = binning
+
+    def __len__(self):
+        return len(self.time)
+
+    # Slices of at most chunkSize frames, (time, traces) with the traces read from the disk
+    def chunks(self, chunkSize=2048):
+        for lo in range(0, len(self), chunkSize):
+            yield self.time[lo:lo + chunkSize], np.asarray(self.traces[lo:lo + chunkSize])
+
+
+# Memory maps a trace store. Frames only partially written by a crash are ignored.
+def loadTraces(directory):
+    with open(os.path.join(directory, "layout.json")) as file:
+        layout = json.load(file)
+    antennas = np.array(layout["antennas"])
+    channels = np.array(layout["channels"])
+    shape = (len(antennas), len(channels), layout["samples"])
+    timeName = os.path.join(directory, "time.i8")
+    traceName = os.path.join(directory, "traces.f4")
+    counts = min(os.path.getsize(timeName) // 8, os.path.getsize(traceName) // (4 * int(np.prod(shape))))
+    if counts == 0:
+        return TraceData(np.empty(0, dtype="datetime64[ns]"), np.empty((0,) + shape, dtype=np.float32),
+                         antennas, channels, layout["binning"])
+    time = np.memmap(timeName, dtype=np.int64, mode="r", shape=(counts,)).view("datetime64[ns]")
+    traces = np.memmap(traceName, dtype=np.float32, mode="r", shape=(counts,) + shape)
+    return TraceData(time, traces, antennas, channels, layout["binning"])
+
+
+# Subtraces RMS of every frame of the store, shape (frames, antennas, channels): the statistic ("mean" as
+# in NPZ.py or "median" as in Histograms.py) of the keep lowest subtraces of length lengthSubTraces
+def subTracesNoise(data, lengthSubTraces=64, keep=10, statistic="mean", chunkSize=2048):
+    noise = np.empty(data.traces.shape[:3], dtype=np.float32)
+    lo = 0
+    for time, traces in data.chunks(chunkSize):
+        rms = cutTraces(traces, lengthSubTraces=lengthSubTraces, keep=keep)
+        noise[lo:lo + len(time)] = STATISTICS[statistic](rms, axis=-1)
+        lo += len(time)
+    return noise
+
+
+# Histograms of the noise levels of Histograms.py (standard RMS window and median of the subtraces)
+def noiseHistograms(data, lengthSubTraces=64, keep=10, valueRange=(0., 200.), nbBins=4000,
+                    sketchAccuracy=None, chunkSize=2048):
+    shape = (2,) + data.traces.shape[1:3]
+    histogram = NoiseHistogram(shape, valueRange, nbBins)
+    sketch = None if sketchAccuracy is None else QuantileSketch(shape, sketchAccuracy)
+    for time, traces in data.chunks(chunkSize):
+        rms = cutTraces(traces, lengthSubTraces=lengthSubTraces, keep=keep)
+        values = np.stack([traceRms(traces), np.median(rms, axis=-1)], axis=1)
+        histogram.add(values)
+        if sketch is not None:
+            sketch.add(values)
+    return histogram, sketch
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    rms = subparsers.add_parser("rms", help="Write the subtraces RMS values of the stored traces in an NPZ")
+    histograms = subparsers.add_parser("histograms", help="Write the noise level histograms of the stored traces")
+    for subparser in (rms, histograms):
+        subparser.add_argument("store", type=str, help="Trace store directory written by NPZ.py --traceStore")
+        subparser.add_argument("--output", type=str, required=True, help="Name of the output .npz file")
+        subparser.add_argument("--lengthSubTraces", type=int, default=64, help="Length of the subtraces")
+        subparser.add_argument("--keepSubTraces", type=int, default=10, help="Number of lowest subtraces that are kept")
+        subparser.add_argument("--chunkSize", type=int, default=2048, help="Number of frames read at once")
+    rms.add_argument("--statistic", type=str, choices=sorted(STATISTICS), default="mean", help="Statistic of the kept subtraces")
+    histograms.add_argument("--histogramRange", type=float, nargs=2, default=[0., 200.], help="Range of the histograms in ADC")
+    histograms.add_argument("--histogramBins", type=int, default=4000, help="Number of bins of the histograms")
+    histograms.add_argument("--sketchAccuracy", type=float, default=None, help="Also keep a quantile sketch with this relative accuracy (e.g. 0.01)")
+    args = parser.parse_args()
+
+    data = loadTraces(args.store)
+    print("{0} frames in {1}".format(len(data), args.store))
+    if args.command == "rms":
+        noise = subTracesNoise(data, args.lengthSubTraces, args.keepSubTraces, args.statistic, args.chunkSize)
+        saveRms(args.output, data.time, noise, data.antennas, data.channels)
+    else:
+        histogram, sketch = noiseHistograms(data, args.lengthSubTraces, args.keepSubTraces, args.histogramRange,
+                                            args.histogramBins, args.sketchAccuracy, args.chunkSize)
+        saveHistograms(args.output, histogram, sketch)
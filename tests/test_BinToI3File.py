@@ -0,0 +1,36 @@
+import os
+
+from BinToI3File_UsingTAXIScripts import findInputs, isUpToDate, outputFiles, outputName
+
+
+def touch(name, mtime):
+    with open(name, "w"):
+        pass
+    os.utime(name, (mtime, mtime))
+
+
+# Input and output in the same directory: the input must not be taken for its own output
+def test_inputNextToOutput(tmp_path):
+    directory = str(tmp_path)
+    for name in ["RUN1.bin", "RUN2.bin.tgz"]:
+        touch(os.path.join(directory, name), 1000)
+    inputs = findInputs([directory])
+    assert [os.path.basename(name) for name in inputs] == ["RUN1.bin", "RUN2.bin.tgz"]
+    for infilename in inputs:
+        output = outputName(infilename, directory)
+        assert outputFiles(output) == []
+        assert not isUpToDate(infilename, output)
+
+    output = outputName(inputs[0], directory)
+    touch(output + ".i3.gz", 2000)
+    assert outputFiles(output) == [output + ".i3.gz"]
+    assert isUpToDate(inputs[0], output)
+    # An output older than its input is converted again
+    os.utime(output + ".i3.gz", (500, 500))
+    assert not isUpToDate(inputs[0], output)
+    assert not isUpToDate(inputs[1], outputName(inputs[1], directory))
+
+
+def test_outputName():
+    assert outputName("/data/RUN.bin.tgz", "out") == os.path.join("out", "RUN")
+    assert outputName("RUN.bin", ".") == os.path.join(".", "RUN")
@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+from ChunkedFit import chunkedFit
+from RmsStore import saveRms
+from SinusFit import SIDEREAL_FREQUENCY, toSeconds
+
+pytest.importorskip("matplotlib")
+pytest.importorskip("astropy")
+from CurveFit import BackgroundOscillation
+
+
+def writeRms(filename, count=3000, seed=0):
+    rng = np.random.default_rng(seed)
+    time = np.datetime64("2023-04-01", "ns") + np.sort(rng.choice(20 * 86400, count, replace=False)).astype("timedelta64[s]")
+    t = toSeconds(time)
+    rms = 25. + 2. * np.sin(2 * np.pi * SIDEREAL_FREQUENCY * t)[:, np.newaxis, np.newaxis] + rng.normal(0, 1, (count, 3, 2))
+    # Transients removed by the cleaning
+    rms[rng.choice(count, 30, replace=False)] += 40.
+    saveRms(filename, time, rms.astype(np.float32))
+
+
+# Fit of CurveFit.py: processData (cleanData and movingAverage), setTimeWindow and fitAll on the whole series
+def inMemoryFit(filename, startTime, endTime, window, statistic):
+    background = BackgroundOscillation(filename)
+    background.setWindow(window, statistic)
+    background.processData()
+    background.setTimeWindow(startTime, endTime)
+    background.fitAll()
+    return background.fit
+
+
+@pytest.mark.parametrize("window, statistic", [(150, "mean"), ("2h", "mean"), (50, "median")])
+def test_chunkedFitMatchesInMemoryFit(tmp_path, window, statistic):
+    filename = str(tmp_path / "rms.npz")
+    writeRms(filename)
+    startTime, endTime = "2023-04-03", "2023-04-18"
+    reference = inMemoryFit(filename, startTime, endTime, window, statistic)
+    fit, fold = chunkedFit(filename, startTime, endTime, window=window, statistic=statistic, chunkSize=257)
+    assert fold is None
+    assert fit.n == reference.n
+    assert np.allclose(fit.coef, reference.coef, rtol=1e-6, atol=1e-8)
+    assert np.allclose(fit.ampErr, reference.ampErr, rtol=1e-5)
+
+
+def test_chunkedFoldDoesNotKeepTheSiderealTimes(tmp_path):
+    import SiderealFold
+    filename = str(tmp_path / "rms.npz")
+    writeRms(filename)
+    SiderealFold.lstCache.clear()
+    fit, fold = chunkedFit(filename, "2023-04-03", "2023-04-18", chunkSize=257, foldBins=24)
+    assert fold.counts.sum() > 0
+    assert not SiderealFold.lstCache
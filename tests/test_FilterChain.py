@@ -0,0 +1,72 @@
+import numpy as np
+
+from FilterChain import FilterChain, FilterValidation, butterworthResponse, engineError, isValidated, medianFrequencyFilter
+
+
+# Median of the amplitudes in the window cut at the edges, computed bin by bin
+def bruteForceMedian(spectrum, width):
+    amplitude = np.abs(spectrum)
+    half = width // 2
+    median = np.array([np.median(amplitude[..., max(0, i - half):i + half + 1], axis=-1)
+                       for i in range(amplitude.shape[-1])])
+    median = np.moveaxis(median, 0, -1)
+    return np.where(amplitude > 0, spectrum * median / amplitude, median)
+
+
+def test_medianFrequencyFilter():
+    rng = np.random.default_rng(0)
+    spectrum = rng.normal(size=(4, 513)) + 1j * rng.normal(size=(4, 513))
+    for width in [1, 4, 20, 21]:
+        assert np.allclose(medianFrequencyFilter(spectrum, width), bruteForceMedian(spectrum, width))
+
+
+# The responses are shared per trace geometry, filter order and limits
+def test_butterworthResponseIsCachedPerGeometry():
+    response = butterworthResponse(1024, 1., 6, (30., 80.))
+    assert butterworthResponse(1024, 1., 6, (30., 80.)) is response
+    assert not response.flags.writeable
+    assert not np.array_equal(butterworthResponse(1024, 1., 6, (140., 190.)), response)
+    assert not np.array_equal(butterworthResponse(1024, 1., 4, (30., 80.)), response)
+    assert butterworthResponse(2048, 1., 6, (30., 80.)).shape == (1025,)
+
+
+def test_applyBandsMatchesApply():
+    rng = np.random.default_rng(1)
+    traces = rng.normal(size=(5, 3, 2, 1024))
+    bands = [(30., 80.), (140., 190.), (190., 250.)]
+    filtered = FilterChain(batchSize=7).applyBands(traces, 2., bands)
+    assert filtered.shape == (5, 3, 2, 3, 1024)
+    for i, band in enumerate(bands):
+        assert np.allclose(filtered[..., i, :], FilterChain(filterLimits=band).apply(traces, 2.))
+
+
+def test_validationRecord(tmp_path):
+    filename = str(tmp_path / "validation.json")
+    limits = (140, 190)
+    assert not isValidated(20, 13, limits, filename)
+    assert engineError("numpy", 20, 13, [limits], filename) is not None
+    assert engineError("radcube", 20, 13, [limits], filename) is None
+
+    validation = FilterValidation(FilterChain(20, 13, limits))
+    validation.save(filename)
+    # No frame compared, the validation did not pass
+    assert not isValidated(20, 13, limits, filename)
+
+    validation.counts, validation.noiseDeviation = 100, 1e-4
+    validation.save(filename)
+    assert isValidated(20, 13, limits, filename)
+    assert engineError("numpy", 20, 13, [limits], filename) is None
+    assert not isValidated(20, 9, limits, filename)
+
+    # Other filter limits need their own validation
+    assert not isValidated(20, 13, (30, 80), filename)
+    assert engineError("numpy", 20, 13, [(30, 80), limits], filename) is not None
+    other = FilterValidation(FilterChain(20, 13, (30, 80)))
+    other.counts, other.noiseDeviation = 100, 1e-4
+    other.save(filename)
+    assert engineError("numpy", 20, 13, [(30, 80), limits], filename) is None
+
+    validation.noiseDeviation = 1e-2
+    validation.save(filename)
+    assert not isValidated(20, 13, limits, filename)
+    assert isValidated(20, 13, (30, 80), filename)
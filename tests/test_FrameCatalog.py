@@ -0,0 +1,29 @@
+import numpy as np
+
+from FrameCatalog import NO_TIME, FrameCatalog, catalogName, loadCatalog, selectedTimes
+
+
+def writeCatalog(tmp_path):
+    filename = str(tmp_path / "run.i3.gz")
+    with open(filename, "wb") as file:
+        file.write(b"frames")
+    time = np.datetime64("2023-04-05T12:00:00", "ns").astype(np.int64) + np.arange(4) * 10**9
+    time[2] = NO_TIME
+    catalog = FrameCatalog(np.arange(4), time, [True, False, True, True], [1024, 1024, 1024, 0],
+                       [2023, 2023, 0, 2023], [1, 2, 0, 4])
+    catalog.save(catalogName(filename), 6)
+    return filename
+
+
+def test_roundTrip(tmp_path):
+    filename = writeCatalog(tmp_path)
+    catalog = loadCatalog(filename)
+    assert np.array_equal(catalog.daqTime, [1, 2, 0, 4])
+    assert np.array_equal(catalog.select(True, 1024), [True, False, True, False])
+
+
+def test_selectedTimesDropsFramesWithoutTime(tmp_path):
+    filename = writeCatalog(tmp_path)
+    time = selectedTimes([filename], soft=True)
+    expected = np.datetime64("2023-04-05T12:00:00", "ns") + np.array([0, 3], dtype="timedelta64[s]")
+    assert np.array_equal(time, expected)
@@ -0,0 +1,44 @@
+import numpy as np
+
+from NoiseHistogram import NoiseHistogram, QuantileSketch
+
+
+def histogramOf(values, shape=(2, 3, 2)):
+    histogram = NoiseHistogram(shape, (0., 10.), 100)
+    histogram.add(values)
+    return histogram
+
+
+def test_mergeIsAssociative():
+    rng = np.random.default_rng(0)
+    a, b, c = [rng.normal(5, 3, size=(50, 2, 3, 2)) for _ in range(3)]
+    left = histogramOf(a)
+    left.merge(histogramOf(b))
+    left.merge(histogramOf(c))
+    bc = histogramOf(b)
+    bc.merge(histogramOf(c))
+    right = histogramOf(a)
+    right.merge(bc)
+    assert np.array_equal(left.counts, right.counts)
+    assert np.allclose(left.sums, right.sums)
+    assert np.array_equal(left.counts, histogramOf(np.concatenate([a, b, c])).counts)
+
+
+def test_underflowAndOverflow():
+    histogram = histogramOf(np.array([[-1.], [0.5], [3.], [10.5], [12.], [np.nan]]), shape=(1,))
+    assert histogram.underflow[0] == 1
+    assert histogram.overflow[0] == 2
+    assert histogram.total[0] == 5
+    counts, edges = histogram.rebinned(10)
+    assert counts.sum() == 2 and len(edges) == 11
+
+
+def test_quantiles():
+    rng = np.random.default_rng(1)
+    values = rng.uniform(1., 9., size=(20000, 3))
+    histogram = NoiseHistogram((3,), (0., 10.), 1000)
+    histogram.add(values)
+    assert np.allclose(histogram.quantile(0.5), np.quantile(values, 0.5, axis=0), atol=0.02)
+    sketch = QuantileSketch((3,), 0.01)
+    sketch.add(values)
+    assert np.all(np.abs(sketch.quantile(0.9) / np.quantile(values, 0.9, axis=0) - 1) < 0.011)
@@ -0,0 +1,217 @@
+import numpy as np
+import pytest
+
+from NoiseTools import FrameArray, cacheStatistics, cutTraces, dbmHzFromAmplitude, geometryCache, linearDbmHzOffset, subTraceRms, traceRms
+
+
+# Stand-ins for the radcube calls of the original loop: GetSubset(start, stop) gives the samples
+# start ... stop - 1 and GetRMS the standard RMS
+class Trace():
+
+    def __init__(self, values):
+        self.values = values
+
+    def __len__(self):
+        return len(self.values)
+
+    def GetSubset(self, start, stop):
+        return self.values[start:stop]
+
+
+def GetRMS(values):
+    return np.sqrt(np.mean(np.asarray(values)**2))
+
+
+# Subtraces method of the original NPZ.py, one trace at a time
+def baselineCutTraces(radTrace, lengthSubTraces=64, mode="rms"):
+    steps = np.arange(0, len(radTrace), lengthSubTraces)
+    nbSubTraces = len(radTrace) / lengthSubTraces
+    temp = []
+    for i in range(int(nbSubTraces)-1):
+        chopped = radTrace.GetSubset(int(steps[i]), int(steps[i + 1]))
+        temp.append(GetRMS(chopped))
+        temp.sort()
+    return temp
+
+
+@pytest.mark.parametrize("nbSamples", [1024, 1000, 3 * 64 + 5])
+def test_cutTracesMatchesBaselineLoop(nbSamples):
+    rng = np.random.default_rng(nbSamples)
+    traces = rng.normal(0, 20, size=(3, 2, nbSamples))
+    # Some RFI in a few subtraces
+    traces[0, 1, 100:180] *= 10
+    noise = np.mean(cutTraces(traces, lengthSubTraces=64, keep=10), axis=-1)
+    for iant in range(3):
+        for ich in range(2):
+            noises = baselineCutTraces(Trace(traces[iant, ich]), lengthSubTraces=64)
+            assert noise[iant, ich] == pytest.approx(np.mean(noises[:10]), rel=1e-12)
+
+
+def test_subTraceRmsDropsTheLastWindow():
+    traces = np.arange(10 * 64, dtype=float)
+    rms = subTraceRms(traces, 64)
+    assert rms.shape == (9,)
+    assert rms[-1] == pytest.approx(traceRms(traces[8 * 64:9 * 64]))
+    with pytest.raises(ValueError):
+        subTraceRms(np.ones(100), 64)
+
+
+# Spectral power in dBm/Hz of a Fourier amplitude, with the amplitude scaled per unit bandwidth
+def referenceDbmHz(amplitude, binning, resistance):
+    return 10 * np.log10(amplitude**2 * binning / resistance / 1e-3)
+
+
+def test_linearDbmHzOffset():
+    offset = linearDbmHzOffset(referenceDbmHz, 1e-3, 50.)
+    amplitudes = np.array([1e-3, 0.5, 2., 1e4])
+    assert np.allclose(20 * np.log10(amplitudes) + offset, referenceDbmHz(amplitudes, 1e-3, 50.))
+    with pytest.raises(ValueError):
+        linearDbmHzOffset(lambda amplitude, binning, resistance: 10 * np.log10(amplitude), 1e-3, 50.)
+
+
+def test_dbmHzFromAmplitudeMatchesRadcube():
+    radcube = pytest.importorskip("icecube.radcube")
+    amplitudes = np.array([[1e-3, 0.5], [2., 0.]])
+    expected = [[radcube.GetDbmHzFromFourierAmplitude(value, 1e-3, 50.) for value in row] for row in amplitudes[:, :1]]
+    assert np.allclose(dbmHzFromAmplitude(amplitudes[:, :1], 1e-3, 50.), expected)
+    assert dbmHzFromAmplitude(amplitudes, 1e-3, 50.)[1, 1] == -np.inf
+
+
+def test_offsetIsCachedPerBinningAndResistance():
+    calls = []
+
+    @geometryCache(maxsize=2)
+    def referenceOffset(binning, resistance):
+        calls.append((binning, resistance))
+        return linearDbmHzOffset(referenceDbmHz, binning, resistance)
+
+    assert referenceOffset(1e-3, 50.) == referenceOffset(1e-3, 50.)
+    assert referenceOffset(1e-3, 75.) != referenceOffset(1e-3, 50.)
+    assert calls == [(1e-3, 50.), (1e-3, 75.)]
+    # A third key evicts the least recently used one, (1e-3, 75.)
+    referenceOffset(2e-3, 50.)
+    referenceOffset(1e-3, 50.)
+    referenceOffset(1e-3, 75.)
+    assert calls == [(1e-3, 50.), (1e-3, 75.), (2e-3, 50.), (1e-3, 75.)]
+
+
+
+def test_geometryCacheHitsMissesAndEviction():
+    calls = []
+
+    @geometryCache(maxsize=2)
+    def rampOfGeometry(nbSamples, binning):
+        calls.append((nbSamples, binning))
+        return np.arange(nbSamples) * binning
+
+    first = rampOfGeometry(8, 0.5)
+    assert rampOfGeometry(8, 0.5) is first
+    # Every argument is part of the key
+    rampOfGeometry(8, 1.)
+    rampOfGeometry(16, 0.5)
+    info = cacheStatistics()["rampOfGeometry"]
+    assert (info.hits, info.misses, info.currsize, info.maxsize) == (1, 3, 2, 2)
+    # (8, 0.5) was the least recently used entry when (16, 0.5) was added
+    assert rampOfGeometry(8, 0.5) is not first
+    assert calls == [(8, 0.5), (8, 1.), (16, 0.5), (8, 0.5)]
+    assert rampOfGeometry(16, 0.5) is rampOfGeometry(16, 0.5)
+
+
+def test_geometryCacheArraysAreReadOnly():
+    @geometryCache()
+    def onesOfGeometry(nbSamples):
+        return np.ones(nbSamples)
+
+    with pytest.raises(ValueError):
+        onesOfGeometry(4)[0] = 2.
+    assert np.array_equal(onesOfGeometry(4), np.ones(4))
+
+# Antenna data map of a frame: antenna keys, channel maps and FFT data holding a time series and a spectrum
+class AntennaKey():
+
+    def __init__(self, antenna):
+        self.antenna = antenna
+
+
+class RadTrace():
+
+    def __init__(self, values, binning):
+        self.values = values
+        self.binning = binning
+
+
+class FFTData():
+
+    def __init__(self, timeSeries, spectrum):
+        self.timeSeries = timeSeries
+        self.spectrum = spectrum
+
+    def GetTimeSeries(self):
+        return self.timeSeries
+
+    def GetFrequencySpectrum(self):
+        return self.spectrum
+
+
+class ChannelData():
+
+    def __init__(self, fftData):
+        self.fftData = fftData
+
+    def GetFFTData(self):
+        return self.fftData
+
+
+class DataMap(dict):
+
+    def keys(self):
+        return list(dict.keys(self))
+
+
+# RadTraceToPythonList gives the values of a trace
+class ListFrameArray(FrameArray):
+
+    @staticmethod
+    def traceValues(radTrace):
+        return list(radTrace.values)
+
+
+def antennaDataMap(rng, antennas, channels, nbSamples=16):
+    values = {}
+    dataMap = DataMap()
+    for antenna in antennas:
+        channelMap = DataMap()
+        for channel in channels:
+            timeSeries = rng.normal(size=nbSamples)
+            spectrum = np.fft.rfft(timeSeries)
+            values[antenna, channel] = timeSeries, spectrum
+            channelMap[channel] = ChannelData(FFTData(RadTrace(timeSeries, 0.5), RadTrace(spectrum, 0.25)))
+        dataMap[AntennaKey(antenna)] = channelMap
+    return dataMap, values
+
+
+def test_frameArrayLayout():
+    rng = np.random.default_rng(0)
+    frameArray = ListFrameArray()
+    antennas, channels = [2, 5, 1], [0, 1]
+    dataMap, values = antennaDataMap(rng, antennas, channels)
+    traces = frameArray.timeSeries(dataMap)
+    assert traces.shape == (3, 2, 16)
+    assert np.array_equal(frameArray.antennas, antennas)
+    assert np.array_equal(frameArray.channels, channels)
+    assert frameArray.binning == 0.5
+    for iant, antenna in enumerate(antennas):
+        for ich, channel in enumerate(channels):
+            assert np.array_equal(traces[iant, ich], values[antenna, channel][0])
+
+    # The buffer is reused by the next frame with the same shape
+    dataMap, values = antennaDataMap(rng, antennas, channels)
+    assert frameArray.timeSeries(dataMap) is traces
+    assert np.array_equal(traces[1, 0], values[5, 0][0])
+
+    amplitudes, binning = frameArray.amplitudeSpectrum(dataMap)
+    assert amplitudes.shape == (3, 2, 9)
+    assert binning == 0.25
+    for iant, antenna in enumerate(antennas):
+        for ich, channel in enumerate(channels):
+            assert np.allclose(amplitudes[iant, ich], np.abs(values[antenna, channel][1]))
@@ -0,0 +1,41 @@
+import numpy as np
+
+from Periodogram import lombScargle
+from SinusFit import DAY, SIDEREAL_FREQUENCY
+
+
+def series(count=4000, seed=0, freq=SIDEREAL_FREQUENCY):
+    rng = np.random.default_rng(seed)
+    t = 1.68e9 + np.sort(rng.uniform(0, 400 * DAY, count))
+    rms = np.stack([2. * np.sin(2 * np.pi * freq * t + 0.3) + 25., rng.normal(30, 1, count)], axis=1)
+    rms[:, 0] += rng.normal(0, 1.5, count)
+    return t, rms
+
+
+# Floating-mean Lomb-Scargle power from a least squares fit at every frequency
+def bruteForcePower(t, y, freqs):
+    t = t - t.min()
+    power = []
+    for freq in freqs:
+        X = np.stack([np.sin(2 * np.pi * freq * t), np.cos(2 * np.pi * freq * t), np.ones_like(t)], axis=1)
+        residual = y - X @ np.linalg.lstsq(X, y, rcond=None)[0]
+        power.append(1 - np.sum(residual**2) / np.sum((y - y.mean())**2))
+    return np.array(power)
+
+
+def test_matchesBruteForce():
+    t, rms = series(1500)
+    periodogram = lombScargle(t, rms, oversampling=5)
+    assert periodogram.power.shape == (2, len(periodogram.freqs))
+    selected = slice(None, None, 37)
+    for ich in range(2):
+        expected = bruteForcePower(t, rms[:, ich], periodogram.freqs[selected])
+        assert np.allclose(periodogram.power[ich, selected], expected, atol=1e-3)
+
+
+def test_peakAtTheSiderealFrequency():
+    t, rms = series()
+    freqs, power, fap = lombScargle(t, rms).peaks()
+    assert abs(freqs[0] - SIDEREAL_FREQUENCY) < 1 / (400 * DAY)
+    assert fap[0] < 1e-10
+    assert fap[1] > 1e-3
@@ -0,0 +1,91 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+pytest.importorskip("icecube.radcube")
+pytest.importorskip("I3Tray")
+
+import Pipeline
+from Pipeline import HistogramsSink, RmsSink, SpectrumSink, TimesSink, runPipeline
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# Tray recording the names of the modules, in the order they are added
+class RecordingTray():
+
+    def __init__(self):
+        self.names = []
+        self.parameters = {}
+
+    def AddModule(self, module, name, **parameters):
+        self.names.append(name)
+        self.parameters[name] = parameters
+
+    Add = AddModule
+
+    def Execute(self):
+        pass
+
+
+def recordPipeline(monkeypatch, sinks, config=Pipeline.CONFIG):
+    tray = RecordingTray()
+    monkeypatch.setattr(Pipeline, "I3Tray", lambda: tray)
+    monkeypatch.setattr(Pipeline, "catalogSelection", lambda filename, traceLength: (filename, None))
+    runPipeline(["run.i3"], sinks, config)
+    return tray
+
+
+def test_artifactsAreRemovedOnceForAllTheSinks(monkeypatch):
+    sinks = [RmsSink(Output="rms.npz"), SpectrumSink(), TimesSink(Output="times.txt"), HistogramsSink(Output="histograms.npz")]
+    tray = recordPipeline(monkeypatch, sinks)
+    assert tray.names == ["reader", "select_soft", "Savingtimevalues", "select_nonEmpty", "ArtifactRemover", "splitter",
+                          "Plotter", "MedianFilter", "filter", "TheNoiseCalculator", "TheGalaxyObserverDeconvolved"]
+    assert "BaselineValue" not in tray.parameters["ArtifactRemover"]
+    assert tray.parameters["TheGalaxyObserverDeconvolved"]["InputName"] == "FilteredMap"
+
+
+def test_stagesOnlyRunForTheirSinks(monkeypatch):
+    assert recordPipeline(monkeypatch, [TimesSink(Output="times.txt")]).names == ["reader", "select_soft", "Savingtimevalues"]
+    assert "MedianFilter" not in recordPipeline(monkeypatch, [SpectrumSink()]).names
+    tray = recordPipeline(monkeypatch, [HistogramsSink(Output="histograms.npz")], dict(Pipeline.CONFIG, engine="numpy"))
+    assert "MedianFilter" not in tray.names
+    assert tray.parameters["TheNoiseCalculator"]["InputName"] == "ArtifactsRemoved"
+
+
+def run(script, arguments, cwd):
+    subprocess.run([sys.executable, os.path.join(REPO, script)] + arguments, cwd=str(cwd), check=True)
+
+
+# One pass of the pipeline against the separate scripts, on the i3 files given by NOISE_TEST_I3FILES
+# (separated by os.pathsep)
+def test_pipelineMatchesTheSeparateScripts(tmp_path):
+    files = [name for name in os.environ.get("NOISE_TEST_I3FILES", "").split(os.pathsep) if name]
+    if not files:
+        pytest.skip("NOISE_TEST_I3FILES is not set")
+    scripts, pipeline = tmp_path / "scripts", tmp_path / "pipeline"
+    scripts.mkdir()
+    pipeline.mkdir()
+    run("TimeValues.py", files + ["--output", "times.txt"], scripts)
+    run("AverageFrames.py", files + ["--spectrogram", "lst"], scripts)
+    run("Histograms.py", files + ["--output", "histograms.npz"], scripts)
+    run("NPZ.py", files + ["--output", "rms.npz"], scripts)
+    run("Pipeline.py", files + ["--times", "times.txt", "--spectrum", "--spectrogram", "lst",
+                                "--histograms", "histograms.npz", "--rms", "rms.npz"], pipeline)
+
+    with open(scripts / "times.txt") as first, open(pipeline / "times.txt") as second:
+        assert first.read() == second.read()
+    for name in ["histograms.npz", "rms.npz"]:
+        with np.load(scripts / name) as first, np.load(pipeline / name) as second:
+            assert sorted(first.files) == sorted(second.files)
+            for key in first.files:
+                assert np.array_equal(first[key], second[key])
+    # The baseline of AverageFrames.py only changes the zero frequency bin
+    with np.load(scripts / "spectrogram.npz") as first, np.load(pipeline / "spectrogram.npz") as second:
+        for key in ["counts", "bins", "freqs"]:
+            assert np.array_equal(first[key], second[key])
+        for key in ["mean", "std"]:
+            assert np.allclose(first[key][..., 1:], second[key][..., 1:], equal_nan=True)
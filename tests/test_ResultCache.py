@@ -0,0 +1,71 @@
+import os
+
+import ResultCache
+
+
+def test_keyDependsOnContentConfigAndVersion(tmp_path, monkeypatch):
+    filename = tmp_path / "run.i3.gz"
+    filename.write_bytes(b"frames")
+    cache = ResultCache.ResultCache(str(tmp_path / "cache"))
+    key = cache.key(str(filename), {"medianWindow": 20})
+    assert cache.key(str(filename), {"medianWindow": 20}) == key
+    assert cache.key(str(filename), {"medianWindow": 21}) != key
+    monkeypatch.setattr(ResultCache, "CACHE_VERSION", ResultCache.CACHE_VERSION + 1)
+    assert cache.key(str(filename), {"medianWindow": 20}) != key
+    monkeypatch.undo()
+    filename.write_bytes(b"other frames")
+    assert cache.key(str(filename), {"medianWindow": 20}) != key
+
+
+# Worker writing the names of its files as the partial result, and counting its calls
+class Worker():
+
+    def __init__(self):
+        self.files = []
+
+    def __call__(self, task):
+        files, output, config = task
+        self.files += files
+        with open(output, "w") as file:
+            file.write("\n".join(files))
+        return output
+
+
+def test_runFilesTakesTheUnchangedFilesFromTheCache(tmp_path):
+    filenames = []
+    for i in range(4):
+        filename = tmp_path / "run{0}.i3.gz".format(i)
+        filename.write_bytes(b"frames %d" % i)
+        filenames.append(str(filename))
+    cache = ResultCache.ResultCache(str(tmp_path / "cache"))
+    worker = Worker()
+    partials = ResultCache.runFiles(filenames, {"window": 20}, worker, str(tmp_path), cache)
+    assert worker.files == filenames
+    assert [open(partial).read() for partial in partials] == filenames
+
+    (tmp_path / "run2.i3.gz").write_bytes(b"new frames")
+    worker = Worker()
+    cache = ResultCache.ResultCache(str(tmp_path / "cache"))
+    partials = ResultCache.runFiles(filenames, {"window": 20}, worker, str(tmp_path), cache)
+    assert worker.files == [filenames[2]]
+    assert [open(partial).read() for partial in partials] == filenames
+    # The digests are written once per run
+    assert set(ResultCache.ResultCache(str(tmp_path / "cache")).digests) == set(os.path.realpath(name) for name in filenames)
+
+    worker = Worker()
+    ResultCache.runFiles(filenames, {"window": 30}, worker, str(tmp_path), cache)
+    assert worker.files == filenames
+
+
+def test_evictRemovesTheLeastRecentlyUsedEntries(tmp_path):
+    cache = ResultCache.ResultCache(str(tmp_path / "cache"), maxBytes=2500)
+    for i, key in enumerate(["a", "b", "c"]):
+        name = tmp_path / "{0}.npz".format(key)
+        name.write_bytes(b"0" * 1000)
+        cache.store(key, str(name))
+        os.utime(cache.path(key), (1000 + i, 1000 + i))
+    # Using "a" makes "b" the least recently used entry
+    assert cache.load("a") == cache.path("a")
+    cache.evict()
+    assert sorted(os.path.basename(name) for name in cache.entries()) == ["a.npz", "c.npz"]
+    assert cache.load("b") is None
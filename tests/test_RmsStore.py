@@ -0,0 +1,166 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+from RmsStore import RMS_KEYS, RmsData, RmsDataset, RmsWriter, framesOfDays, loadRms, mergeRms, readSpool, targetDays, writeNpz
+
+
+def frames(count, seed=0, shape=(3, 2)):
+    rng = np.random.default_rng(seed)
+    time = np.datetime64("2023-04-05T20:00:00", "ns") + np.sort(rng.choice(2 * 86400, count, replace=False)).astype("timedelta64[s]")
+    return time, rng.uniform(10, 50, size=(count,) + shape).astype(np.float32)
+
+
+def test_writerRoundTrip(tmp_path):
+    output = str(tmp_path / "rms.npz")
+    time, rms = frames(250)
+    writer = RmsWriter(output, chunkSize=64, antennas=[1, 2, 4], channels=[0, 1])
+    for t, values in zip(time, rms):
+        writer.append(t.astype(np.int64), values)
+    writer.close()
+    data = loadRms(output)
+    assert not os.path.exists(output + ".spool")
+    assert np.array_equal(data.time, time)
+    assert np.array_equal(data.rms, rms)
+    assert np.array_equal(data.antennas, [1, 2, 4])
+    assert np.array_equal(data.channels, [0, 1])
+
+
+def test_writerRoundTripWithBands(tmp_path):
+    output = str(tmp_path / "rms.npz")
+    bands = [(30., 80.), (140., 190.)]
+    time, rms = frames(10, shape=(2, 3, 2))
+    writer = RmsWriter(output, chunkSize=4, bands=bands)
+    for t, values in zip(time, rms):
+        writer.append(t.astype(np.int64), values)
+    writer.close()
+    data = loadRms(output)
+    assert np.array_equal(data.bands, bands)
+    assert np.array_equal(data.band(1).rms, rms[:, 1])
+    assert np.array_equal(data.antennas, [1, 2, 3])
+
+
+def test_interruptedRunKeepsTheFlushedChunks(tmp_path):
+    output = str(tmp_path / "rms.npz")
+    time, rms = frames(100)
+    writer = RmsWriter(output, chunkSize=32)
+    for t, values in zip(time, rms):
+        writer.append(t.astype(np.int64), values)
+    # The run stops without close: the three full chunks are on disk, the last partial one is lost
+    with pytest.raises(IOError):
+        RmsWriter(output)
+    writeNpz(output + ".spool", output)
+    data = loadRms(output)
+    assert np.array_equal(data.time, time[:96])
+    assert np.array_equal(data.rms, rms[:96])
+
+
+def test_truncatedSpoolChunk(tmp_path):
+    spool = tmp_path / "rms.npz.spool"
+    spool.mkdir()
+    time, rms = frames(5)
+    with open(spool / "layout.json", "w") as file:
+        json.dump({"antennas": [1, 2, 3], "channels": [0, 1]}, file)
+    time.astype(np.int64).tofile(spool / "time.i8")
+    rms.tofile(spool / "rms.f4")
+    # A chunk partially written by a crash is ignored
+    with open(spool / "rms.f4", "ab") as file:
+        file.write(b"\0" * 8)
+    assert len(readSpool(str(spool))) == 5
+    writeNpz(str(spool), str(tmp_path / "recovered.npz"))
+    data = loadRms(str(tmp_path / "recovered.npz"))
+    assert np.array_equal(data.rms, rms)
+    assert np.array_equal(data.antennas, [1, 2, 3])
+
+
+def test_legacyLoader(tmp_path):
+    time, rms = frames(20)
+    # Layout of the first NPZ.py: datetime objects and one array per antenna and channel
+    np.savez(str(tmp_path / "legacy.npz"), time=np.asarray(time.astype("datetime64[us]").astype(object)),
+             **{key: rms[:, iant, ich] for key, (iant, ich) in zip(RMS_KEYS, np.ndindex(3, 2))})
+    with pytest.raises(ValueError):
+        np.load(str(tmp_path / "legacy.npz"))["time"]
+    data = loadRms(str(tmp_path / "legacy.npz"))
+    assert data.version == 1
+    assert np.array_equal(data.time, time)
+    assert np.array_equal(data.rms, rms)
+    assert np.array_equal(data.antennas, [1, 2, 3])
+    assert np.array_equal(data.channels, [0, 1])
+
+
+def test_datasetQuery(tmp_path):
+    dataset = RmsDataset(str(tmp_path / "dataset"))
+    time, rms = frames(200)
+    dataset.add(RmsData(time[:120], rms[:120]))
+    # Overlapping frames are replaced by the new ones
+    dataset.add(RmsData(time[100:], rms[100:]))
+    data = RmsDataset(str(tmp_path / "dataset")).query()
+    assert np.array_equal(data.time, time)
+    assert np.array_equal(data.rms, rms)
+    start, end = time[50], time[150]
+    part = dataset.query(start, end)
+    assert np.array_equal(part.time, time[50:150])
+
+
+def test_datasetIgnoresEmptyDataAndRejectsOtherIds(tmp_path):
+    dataset = RmsDataset(str(tmp_path / "dataset"))
+    dataset.add(RmsData(np.empty(0, dtype="datetime64[ns]"), np.empty((0, 3, 2), dtype=np.float32)))
+    assert len(dataset.days) == 0
+    time, rms = frames(20)
+    dataset.add(RmsData(time, rms))
+    with pytest.raises(ValueError):
+        dataset.add(RmsData(time, rms, antennas=np.array([1, 2, 4])))
+    assert np.array_equal(RmsDataset(str(tmp_path / "dataset")).query().rms, rms)
+
+
+def writeFrames(output, time, rms, **kwargs):
+    writer = RmsWriter(output, chunkSize=16, **kwargs)
+    for t, values in zip(time, rms):
+        writer.append(t.astype(np.int64), values)
+    writer.close()
+    return output
+
+
+def test_mergedShardsMatchTheSerialOutput(tmp_path):
+    time, rms = frames(100)
+    # Frames with the same time at the boundary of two files keep the order of the file list
+    time[40] = time[39]
+    bounds = [0, 25, 40, 70, 100]
+    serial = loadRms(writeFrames(str(tmp_path / "serial.npz"), time, rms, antennas=[1, 2, 4]))
+    partials = [writeFrames(str(tmp_path / "part_{0:05d}.npz".format(lo)), time[lo:hi], rms[lo:hi], antennas=[1, 2, 4])
+                for lo, hi in zip(bounds[:-1], bounds[1:])]
+    mergeRms(partials, str(tmp_path / "merged.npz"))
+    merged = loadRms(str(tmp_path / "merged.npz"))
+    for name in ["time", "rms", "antennas", "channels"]:
+        assert np.array_equal(getattr(merged, name), getattr(serial, name))
+    assert merged.bands is None
+
+
+def test_mergeRejectsOtherIds(tmp_path):
+    time, rms = frames(20)
+    partials = [writeFrames(str(tmp_path / "a.npz"), time[:10], rms[:10]),
+                writeFrames(str(tmp_path / "b.npz"), time[10:], rms[10:], antennas=[1, 2, 4])]
+    with pytest.raises(ValueError):
+        mergeRms(partials, str(tmp_path / "merged.npz"))
+
+
+def test_targetDays():
+    days = targetDays(["2023-04-07", "2023-04-05"], [("2023-04-06", "2023-04-08"), ("2023-05-01", "2023-05-01")])
+    assert np.array_equal(days, np.array(["2023-04-05", "2023-04-06", "2023-04-07", "2023-04-08", "2023-05-01"], dtype="datetime64[D]"))
+    assert len(targetDays()) == 0
+
+
+# Selection of the frames of the target days in the original PlottingRMS.py, on datetime objects
+def test_framesOfDaysMatchesTheDateLoop():
+    rng = np.random.default_rng(0)
+    start = np.datetime64("2023-04-04T00:00:00", "us")
+    time = np.sort(start + rng.integers(0, 6 * 86400 * 10**6, 500).astype("timedelta64[us]"))
+    # Frames on both sides of midnight
+    time[:4] = np.array(["2023-04-05T23:59:59.999999", "2023-04-06T00:00:00", "2023-04-04T23:59:59.999999",
+                         "2023-04-07T00:00:00.000001"], dtype="datetime64[us]")
+    target_days = targetDays(["2023-04-06"], [("2023-04-08", "2023-04-09")])
+    expected = [index for index, dt in enumerate(time.astype(object)) if dt.date() in [day.astype(object) for day in target_days]]
+    assert np.array_equal(framesOfDays(time.astype("datetime64[ns]"), target_days), expected)
+    assert 1 in expected and 0 not in expected
@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+from SiderealFold import LstFold
+
+
+def signal(count=20000, seed=0):
+    rng = np.random.default_rng(seed)
+    lst = rng.uniform(0, 72, count) % 24.
+    model = 20. + 5. * np.sin(2 * np.pi * lst / 24.)[:, np.newaxis] + np.array([0., 10.])
+    return lst, model + rng.normal(0, 0.5, size=model.shape)
+
+
+def test_foldOfAnLstPeriodicSignal():
+    lst, rms = signal()
+    rms[:50, 1] = np.nan
+    fold = LstFold(nbBins=24, nbChannels=2, valueRange=(0., 50.), nbValueBins=5000)
+    fold.add(lst, rms)
+    lstBin = np.floor(lst).astype(int)
+    for ibin in range(24):
+        for ich in range(2):
+            values = rms[lstBin == ibin, ich]
+            values = values[np.isfinite(values)]
+            assert fold.counts[ibin, ich] == len(values)
+            assert np.isclose(fold.mean[ibin, ich], values.mean())
+            assert np.isclose(fold.std[ibin, ich], values.std())
+            assert abs(fold.median[ibin, ich] - np.median(values)) < 50. / 5000
+    # The folded curve follows the sinus, averaged over the width of a bin
+    expected = 20. + 5. * np.sinc(1. / 24) * np.sin(2 * np.pi * fold.binCenters / 24.)
+    assert np.allclose(fold.mean[:, 0], expected, atol=0.1)
+    assert np.allclose(fold.mean[:, 1], expected + 10., atol=0.1)
+
+
+def test_mergedFoldsEqualTheFoldOfTheConcatenation(tmp_path):
+    lst, rms = signal()
+    whole = LstFold(nbBins=48, nbChannels=2)
+    whole.add(lst, rms)
+    first, second = LstFold(nbBins=48, nbChannels=2), LstFold(nbBins=48, nbChannels=2)
+    first.add(lst[:7000], rms[:7000])
+    second.add(lst[7000:], rms[7000:])
+    second.save(str(tmp_path / "second.npz"))
+    first.merge(LstFold.load(str(tmp_path / "second.npz")))
+    assert np.array_equal(first.counts, whole.counts)
+    assert np.array_equal(first.histogram, whole.histogram)
+    assert np.allclose(first.sums, whole.sums)
+    assert np.allclose(first.sums2, whole.sums2)
+    assert np.array_equal(first.median, whole.median)
+
+
+def test_mergeNeedsTheSameBinning():
+    with pytest.raises(ValueError):
+        LstFold(nbBins=48, nbChannels=2).merge(LstFold(nbBins=96, nbChannels=2))
+    with pytest.raises(ValueError):
+        LstFold(nbChannels=2).merge(LstFold(nbChannels=2, valueRange=(0., 50.)))
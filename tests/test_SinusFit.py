@@ -0,0 +1,112 @@
+import numpy as np
+import pytest
+from scipy.optimize import curve_fit
+
+from SinusFit import DAY, SIDEREAL_FREQUENCY, SOLAR_FREQUENCY, NormalEquations, fitSinus, resampleSinus, trackSinus
+
+
+def series(count=3000, seed=0):
+    rng = np.random.default_rng(seed)
+    t = 1.68e9 + np.sort(rng.uniform(0, 60 * 86400, count))
+    model = np.stack([
+        3. * np.sin(2 * np.pi * SIDEREAL_FREQUENCY * t + 0.4) + 1. * np.sin(2 * np.pi * SOLAR_FREQUENCY * t - 1.2) + 20.,
+        1.5 * np.sin(2 * np.pi * SIDEREAL_FREQUENCY * t - 2.) + 0.5 * np.sin(2 * np.pi * SOLAR_FREQUENCY * t + 2.5) + 30.,
+    ], axis=1)
+    return t, model + rng.normal(0, 0.8, size=model.shape)
+
+
+# Model of CurveFit.py before the linear fit
+def sinus(t, amp, phase, mean, amp2, phase2):
+    return amp * np.sin(2 * np.pi * SIDEREAL_FREQUENCY * t + phase) + amp2 * np.sin(2 * np.pi * SOLAR_FREQUENCY * t + phase2) + mean
+
+
+def test_fitSinusMatchesCurveFit():
+    t, rms = series()
+    fit = fitSinus(t, rms)
+    for ich in range(rms.shape[1]):
+        p0 = [fit.amp[ich] * 1.1, fit.phase[ich] + 0.1, fit.mean[ich], fit.amp2[ich] * 0.9, fit.phase2[ich] - 0.1]
+        popt, pcov = curve_fit(sinus, t, rms[:, ich], p0=p0)
+        values = [fit.amp[ich], fit.phase[ich], fit.mean[ich], fit.amp2[ich], fit.phase2[ich]]
+        errors = [fit.ampErr[ich], fit.phaseErr[ich], fit.meanErr[ich], fit.amp2Err[ich], fit.phase2Err[ich]]
+        assert np.allclose(popt, values, rtol=1e-5, atol=1e-6)
+        assert np.allclose(np.sqrt(np.diag(pcov)), errors, rtol=1e-3)
+
+
+def test_normalEquationsMatchFitSinus():
+    t, rms = series()
+    reference = fitSinus(t, rms - 25.)
+    first, second = NormalEquations(2), NormalEquations(2)
+    first.add(t[:1000], rms[:1000])
+    second.add(t[1000:], rms[1000:])
+    # Samples added then removed leave the sums unchanged
+    second.add(t[:10], rms[:10])
+    second.remove(t[:10], rms[:10])
+    first.merge(second)
+    first.subtract(np.full(2, 25.))
+    fit = first.solve()
+    assert np.allclose(fit.coef, reference.coef, rtol=1e-7, atol=1e-9)
+    assert np.allclose(fit.ampErr, reference.ampErr, rtol=1e-6)
+    assert np.allclose(fit.mse, reference.mse, rtol=1e-6)
+
+
+def test_nonFiniteSamplesAreLeftOut():
+    t, rms = series()
+    rms[:100, 0] = np.nan
+    assert np.allclose(fitSinus(t, rms).coef, fitSinus(t[100:], rms[100:]).coef)
+
+
+def test_jackknifeMatchesLeaveOneDayOutFits():
+    t, rms = series(count=800)
+    t, rms = t[t < t[0] + 12 * DAY], rms[t < t[0] + 12 * DAY]
+    days = np.floor(t / DAY)
+    refits = [fitSinus(t[days != day], rms[days != day]) for day in np.unique(days)]
+    resampling = resampleSinus(t, rms, method="jackknife", batchSize=5)
+    nbDays = len(refits)
+    for name in ["amp", "phase", "amp2", "phase2", "mean"]:
+        values = np.array([getattr(fit, name) for fit in refits])
+        if name.startswith("phase"):
+            center = getattr(resampling.fit, name)
+            values = center + np.angle(np.exp(1j * (values - center)))
+        assert np.allclose(resampling.values(name), values, rtol=1e-7, atol=1e-9)
+        error = np.sqrt((nbDays - 1) / nbDays * np.sum((values - values.mean(axis=0))**2, axis=0))
+        assert np.allclose(resampling.standardError(name), error, rtol=1e-6)
+
+
+def test_bootstrapDoesNotDependOnTheJobs():
+    t, rms = series(count=800)
+    single = resampleSinus(t, rms, replicas=30, batchSize=8, seed=3)
+    pooled = resampleSinus(t, rms, replicas=30, batchSize=8, seed=3, jobs=2)
+    assert single.values("amp").shape == (30, 2)
+    for name in ["amp", "phase", "mean"]:
+        assert np.array_equal(single.values(name), pooled.values(name))
+    low, high = single.interval("amp")
+    assert np.all(low < single.fit.amp) and np.all(single.fit.amp < high)
+
+
+def test_resamplingNeedsReplicas():
+    t, rms = series(count=800)
+    with pytest.raises(ValueError):
+        resampleSinus(t, rms, replicas=0)
+    with pytest.raises(ValueError):
+        resampleSinus(t[:3], rms[:3], method="jackknife")
+
+
+def test_trackSinusMatchesTheFitOfEachWindow():
+    t, rms = series()
+    # A gap of a week leaves windows with too few samples
+    kept = (t < t[0] + 20 * DAY) | (t > t[0] + 27 * DAY)
+    t, rms = t[kept], rms[kept]
+    window, step = 5 * DAY, 0.05 * DAY
+    track = trackSinus(t, rms, window, step)
+    # More steps than the refresh period, so the sums are rebuilt at least once
+    assert len(track.time) > 1000
+    assert np.any(np.isnan(track.amp)) and np.any(np.isfinite(track.amp))
+    for k, center in enumerate(track.time):
+        inside = (t >= center - window / 2) & (t < center + window / 2)
+        assert track.n[k] == np.count_nonzero(inside)
+        if track.n[k] < 50:
+            assert np.all(np.isnan(track.amp[k]))
+            continue
+        fit = fitSinus(t[inside], rms[inside])
+        for name in ["amp", "amp2", "mean", "ampErr"]:
+            assert np.allclose(getattr(track, name)[k], getattr(fit, name), rtol=1e-6, atol=1e-8)
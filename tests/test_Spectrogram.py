@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+from Spectrogram import Spectrogram
+
+
+def frames(seed, count=300):
+    rng = np.random.default_rng(seed)
+    time = np.datetime64("2023-04-05", "ns") + rng.integers(0, 4 * 86400, count).astype("timedelta64[s]")
+    spectra = rng.normal(-160, 5, size=(count, 3, 2, 8))
+    spectra[rng.random(spectra.shape) < 0.05] = -np.inf
+    return time, spectra
+
+
+def fill(spectrogram, time, spectra):
+    for t, spectrum in zip(time, spectra):
+        spectrogram.add(t, spectrum)
+    return spectrogram
+
+
+def test_timeBinsMatchDirectStatistics():
+    time, spectra = frames(0)
+    spectrogram = fill(Spectrogram((3, 2, 8), "time", start="2023-04-05", end="2023-04-08", binWidth="1D", blockSize=64),
+                       time, spectra)
+    variance = spectrogram.variance
+    day = (time - np.datetime64("2023-04-05", "ns")) // np.timedelta64(1, "D")
+    assert spectrogram.outside == np.sum(day >= 3)
+    for index in range(3):
+        values = np.where(np.isfinite(spectra[day == index]), spectra[day == index], np.nan)
+        assert np.array_equal(spectrogram.counts[index], np.sum(np.isfinite(values), axis=0))
+        assert np.allclose(spectrogram.mean[index], np.nanmean(values, axis=0))
+        assert np.allclose(variance[index], np.nanvar(values, axis=0, ddof=1))
+
+
+def test_mergeMatchesSingleAccumulator():
+    options = dict(mode="time", start="2023-04-05", end="2023-04-09", binWidth="6h", blockSize=50)
+    (time1, spectra1), (time2, spectra2) = frames(1), frames(2)
+    merged = fill(Spectrogram((3, 2, 8), **options), time1, spectra1)
+    merged.merge(fill(Spectrogram((3, 2, 8), **options), time2, spectra2))
+    single = fill(Spectrogram((3, 2, 8), **options), np.concatenate([time1, time2]), np.concatenate([spectra1, spectra2]))
+    assert np.array_equal(merged.counts, single.counts)
+    assert np.allclose(merged.mean, single.mean)
+    assert np.allclose(merged.variance, single.variance, equal_nan=True)
+
+
+def test_lstBinsUseTheSiderealTime():
+    pytest.importorskip("astropy")
+    from SiderealFold import localSiderealTime
+    time, spectra = frames(3, 50)
+    spectrogram = Spectrogram((3, 2, 8), "lst", nbBins=24)
+    expected = (localSiderealTime(time) // 1).astype(np.int64)
+    assert np.array_equal(spectrogram.timeBins(time), expected)
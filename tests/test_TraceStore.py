@@ -0,0 +1,39 @@
+import numpy as np
+
+from NoiseTools import cutTraces, traceRms
+from TraceStore import TraceWriter, loadTraces, noiseHistograms, subTracesNoise
+
+
+def writeStore(directory, count=37):
+    rng = np.random.default_rng(0)
+    time = np.datetime64("2023-04-05", "ns") + np.arange(count).astype("timedelta64[s]")
+    traces = rng.normal(0, 20, size=(count, 3, 2, 1024)).astype(np.float32)
+    writer = TraceWriter(directory, nbSamples=1024, binning=1., chunkSize=8, antennas=[1, 2, 4], channels=[0, 1])
+    for t, frame in zip(time, traces):
+        writer.append(t.astype(np.int64), frame)
+    writer.close()
+    return time, traces
+
+
+def test_roundTrip(tmp_path):
+    time, traces = writeStore(str(tmp_path / "store"))
+    data = loadTraces(str(tmp_path / "store"))
+    assert np.array_equal(data.time, time)
+    assert np.array_equal(data.traces, traces)
+    assert np.array_equal(data.antennas, [1, 2, 4])
+    assert np.array_equal(data.channels, [0, 1])
+    assert data.binning == 1.
+
+
+def test_statisticsMatchDirectComputation(tmp_path):
+    time, traces = writeStore(str(tmp_path / "store"))
+    data = loadTraces(str(tmp_path / "store"))
+    rms = cutTraces(traces, lengthSubTraces=128, keep=5)
+    assert np.allclose(subTracesNoise(data, 128, 5, "median", chunkSize=10), np.median(rms, axis=-1), rtol=1e-5)
+    assert np.allclose(subTracesNoise(data, 128, 5, "mean", chunkSize=10), np.mean(rms, axis=-1), rtol=1e-5)
+
+    histogram, sketch = noiseHistograms(data, 64, 10, chunkSize=10, sketchAccuracy=0.01)
+    assert np.all(histogram.total == len(time))
+    window = traceRms(traces)
+    assert np.allclose(histogram.mean[0], window.mean(axis=0), rtol=1e-5)
+    assert np.all(np.abs(sketch.quantile(0.5)[0] / np.median(window, axis=0) - 1) < 0.011)